@@ -0,0 +1,120 @@
+""" microbenchmark of blockmap segment allocation
+
+    Measures the time to allocate and release segments on blockmaps with an increasing number of blocks.  The blockmap
+    is fragmented first, so that the largest run of available blocks is short compared to the size of the blockmap,
+    which is the worst case for a linear search for the largest run.
+
+    The legacy column times the original search for the largest run, which looked for a run of every size from the
+    size of the blockmap down to 1 with str.find.  It is only run on the smaller blockmaps because it is quadratic in
+    the number of blocks.
+
+    Run from the root of the project with
+
+        python benchmarks/bench_blockmap.py
+"""
+
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import os
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from superftp.blockmap import Blockmap     # noqa: E402  pylint: disable=C0413
+
+
+# --------------------------------------------------
+#    Constants
+# --------------------------------------------------
+BLOCKSIZE = 1024
+BLOCK_COUNTS = [1024, 4096, 16384, 65536, 262144, 1048576]
+LEGACY_MAX_BLOCKS = 16384
+ITERATIONS = 200
+
+
+# --------------------------------------------------
+#    Functions
+# --------------------------------------------------
+def _create_fragmented_blockmap(temp_dir, blocks):
+    """ create a blockmap where every 64th block is downloaded
+
+        Args:
+            temp_dir - directory to create the blockmap in
+            blocks - number of blocks in the blockmap
+
+        Returns:
+            the blockmap
+    """
+    blockmap = Blockmap('bench', os.path.join(temp_dir, 'bench_%d' % blocks), lambda _: blocks * BLOCKSIZE,
+                        min_blocks_per_segment=1, max_blocks_per_segment=8, initial_blocksize=BLOCKSIZE,
+                        checkpoint_interval=3600, checkpoint_blocks=sys.maxsize)
+    blockmap.init_blockmap()
+    for i in range(0, blocks, 64):
+        blockmap.change_block_range_status(i * BLOCKSIZE, 1, Blockmap.DOWNLOADED)
+    return blockmap
+
+
+def _legacy_largest_run(blockstr):
+    """ the original search for the largest run of available blocks """
+    for segment_size in range(len(blockstr), 0, -1):
+        start_block = blockstr.find(Blockmap.AVAILABLE * segment_size)
+        if start_block >= 0:
+            return start_block, segment_size
+    return None
+
+
+def _bench_allocate_release(blockmap):
+    """ time allocating a segment to a worker and releasing it again
+
+        Returns:
+            (microseconds per allocation, microseconds per release)
+    """
+    allocate_time = 0
+    release_time = 0
+    for _ in range(0, ITERATIONS):
+        t = time.time()
+        blockmap.allocate_segments(['0'])
+        allocate_time = allocate_time + time.time() - t
+        t = time.time()
+        blockmap.change_status('0', Blockmap.AVAILABLE)
+        release_time = release_time + time.time() - t
+    return allocate_time / ITERATIONS * 1e6, release_time / ITERATIONS * 1e6
+
+
+def _bench_largest_run(blockmap):
+    """ time a query for the largest run of available blocks, returns microseconds per iteration """
+    return timeit.timeit(blockmap._free_runs.largest, number=ITERATIONS) / ITERATIONS * 1e6  # pylint: disable=W0212
+
+
+def _bench_legacy_largest_run(blockmap):
+    """ time the legacy search for the largest run of available blocks, returns microseconds per iteration """
+    blockstr = str(blockmap)
+    iterations = 3
+    return timeit.timeit(lambda: _legacy_largest_run(blockstr), number=iterations) / iterations * 1e6
+
+
+def main():
+    """ run the benchmark and print a table of the results """
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print('%10s %18s %18s %18s %18s' % ('blocks', 'largest run (us)', 'allocate (us)', 'release (us)',
+                                            'legacy search (us)'))
+        for blocks in BLOCK_COUNTS:
+            blockmap = _create_fragmented_blockmap(temp_dir, blocks)
+            legacy = '-'
+            if blocks <= LEGACY_MAX_BLOCKS:
+                legacy = '%0.1f' % _bench_legacy_largest_run(blockmap)
+            allocate_time, release_time = _bench_allocate_release(blockmap)
+            print('%10d %18.2f %18.1f %18.1f %18s' % (blocks, _bench_largest_run(blockmap), allocate_time,
+                                                      release_time, legacy))
+            blockmap.delete_blockmap()
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+""" microbenchmark of the receive path of a download thread
+
+    Measures the time to receive data from a local socket pair and cut it into blocks, comparing the original path,
+    which grew a bytes buffer with data = data + chunk and sliced blocks off the front of it, with receiving straight
+    into pooled block buffers with socket.recv_into.
+
+    Run from the root of the project with
+
+        python benchmarks/bench_receive.py
+"""
+
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from superftp.block_buffer_pool import BlockBufferPool     # noqa: E402  pylint: disable=C0413
+
+
+# --------------------------------------------------
+#    Constants
+# --------------------------------------------------
+BLOCKSIZE = 1024 * 1024
+TOTAL_BYTES = 256 * 1024 * 1024
+
+
+# --------------------------------------------------
+#    Functions
+# --------------------------------------------------
+def _send(sock):
+    """ send TOTAL_BYTES over the socket then close it """
+    chunk = b'x' * BLOCKSIZE
+    for _ in range(0, TOTAL_BYTES // BLOCKSIZE):
+        sock.sendall(chunk)
+    sock.close()
+
+
+def _legacy_receive(sock):
+    """ the original receive path, returns the number of blocks received """
+    blocks = 0
+    data = b''
+    while True:
+        chunk = sock.recv(BLOCKSIZE * 8)
+        if chunk:
+            data = data + chunk
+        while (len(data) > BLOCKSIZE) or not chunk:
+            _block = data[:BLOCKSIZE]
+            data = data[BLOCKSIZE:]
+            blocks = blocks + 1
+            if not chunk:
+                break
+        if not chunk:
+            return blocks
+
+
+def _pooled_receive(sock):
+    """ the recv_into receive path, returns the number of blocks received """
+    blocks = 0
+    pool = BlockBufferPool(BLOCKSIZE)
+    buf = pool.acquire()
+    view = memoryview(buf)
+    filled = 0
+    while True:
+        received = sock.recv_into(view[filled:], BLOCKSIZE - filled)
+        filled = filled + received
+        if filled == BLOCKSIZE or (received == 0 and filled > 0):
+            blocks = blocks + 1
+            # the manager would release the buffer after writing it, release it straight away here
+            pool.release(buf)
+            buf = pool.acquire()
+            view = memoryview(buf)
+            filled = 0
+        if received == 0:
+            return blocks
+
+
+def _bench(receive_func):
+    """ time a receive function, returns MB/sec """
+    a, b = socket.socketpair()
+    sender = threading.Thread(target=_send, args=(a,))
+    sender.start()
+    t = time.time()
+    receive_func(b)
+    elapsed = time.time() - t
+    sender.join()
+    b.close()
+    return TOTAL_BYTES / elapsed / 1024 / 1024
+
+
+def main():
+    """ run the benchmark and print the results """
+    print('%-12s %12s' % ('path', 'MB/sec'))
+    print('%-12s %12.1f' % ('legacy', _bench(_legacy_receive)))
+    print('%-12s %12.1f' % ('recv_into', _bench(_pooled_receive)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,644 @@
+""" download engine which runs every download connection as a coroutine on one asyncio event loop """
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import asyncio
+import concurrent.futures
+from contextlib import closing
+from ftplib import all_errors, error_perm, error_proto, error_reply, error_temp, parse227, parse229
+import os
+import socket
+import sys
+from threading import Lock, Thread
+import time
+# disable pylint for relative-import below, no way to make it work with sphinx and nosetests and comply with pylint
+
+if sys.version_info >= (3, 0):
+    from .ftp_connection_pool import FtpConnectionPool
+    from .rate_limiter import TokenBucket
+    from .segment_state import SegmentState, SmallFilesState
+else:
+    from ftp_connection_pool import FtpConnectionPool           # pylint: disable=E0401
+    from rate_limiter import TokenBucket                        # pylint: disable=E0401
+    from segment_state import SegmentState, SmallFilesState     # pylint: disable=E0401
+
+
+# --------------------------------------------------
+#    Constants
+# --------------------------------------------------
+ASYNC_ERRORS = all_errors + (asyncio.TimeoutError,)     # asyncio.TimeoutError is not an OSError before python 3.11
+
+
+# --------------------------------------------------
+#    Functions
+# --------------------------------------------------
+def _remove_file(path):
+    """ remove a local file if it exists, run on the default executor of the event loop
+
+        Args:
+            path - path of the local file
+    """
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _replace_file(part_path, local_path):
+    """ replace a local file with the partial file it has been fetched into, run on the default executor of the event
+        loop
+
+        Args:
+            part_path - path of the partial file
+            local_path - path of the local file
+    """
+    _remove_file(local_path)
+    os.rename(part_path, local_path)
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+class AsyncFtpConnection:
+    """ ftp control connection which speaks the ftp protocol on an asyncio stream
+
+        The replies are checked the same way ftplib checks them and the same ftplib exceptions are raised, so the
+        errors of the asyncio engine read the same as the errors of the thread engine.  Data connections are plain
+        non-blocking sockets, so that the download coroutines can receive straight into a block buffer with
+        loop.sock_recv_into.
+    """
+    # --------------------------------------------------
+    # Constants
+    # --------------------------------------------------
+    TIMEOUT = 30.0          # seconds to wait for the server before the connection is given up on
+    ENCODING = 'utf-8'
+
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, reader, writer):
+        """ Initialize the class, use AsyncFtpConnection.open to open a connection
+
+            Args:
+                reader - StreamReader of the control connection
+                writer - StreamWriter of the control connection
+        """
+        self._reader = reader
+        self._writer = writer
+        self.returned_time = None       # time the connection was returned to the pool
+
+    # --------------------------------------------------
+    # Private Functions
+    # --------------------------------------------------
+    async def _get_reply(self):
+        """ read a reply from the server, a multi-line reply is returned as one string
+
+            Returns:
+                the reply without the line endings
+        """
+        line = await self._read_line()
+        if line[3:4] == '-':
+            code = line[0:3]
+            while True:
+                next_line = await self._read_line()
+                line = line + '\n' + next_line
+                if next_line[0:3] == code and next_line[3:4] != '-':
+                    break
+        return line
+
+    async def _read_line(self):
+        """ return the next line from the server without the line ending """
+        line = await asyncio.wait_for(self._reader.readline(), self.TIMEOUT)
+        if not line:
+            raise EOFError('the server closed the control connection')
+        return line.decode(self.ENCODING, 'replace').rstrip('\r\n')
+
+    def _send(self, cmd):
+        """ send a command to the server """
+        self._writer.write((cmd + '\r\n').encode(self.ENCODING))
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def close(self):
+        """ close the control connection """
+        try:
+            self._writer.close()
+        except all_errors as _:
+            pass
+
+    async def drain(self, max_replies):
+        """ abort the transfer in progress and read replies until the reply to NOOP, see FtpConnectionPool._drain
+
+            Args:
+                max_replies - number of replies read while looking for the reply to NOOP
+
+            Raises:
+                EOFError if the server does not reply to NOOP
+        """
+        self._send('ABOR')
+        self._send('NOOP')
+        for _ in range(0, max_replies):
+            if (await self._get_reply()).startswith('200'):
+                return
+        raise EOFError('no reply to NOOP while draining the connection')
+
+    @classmethod
+    async def open(cls, host, port, username, password):
+        """ open a control connection, log in and switch to binary mode
+
+            Args:
+                host - host name of the ftp server
+                port - port number of the ftp server
+                username - username to login to ftp server with
+                password - password to login to ftp server with
+
+            Returns:
+                a logged in AsyncFtpConnection in binary mode
+        """
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), cls.TIMEOUT)
+        ftp = cls(reader, writer)
+        try:
+            await ftp.void_response()
+            resp = await ftp.send_command('USER ' + username)
+            if resp[0] == '3':
+                resp = await ftp.send_command('PASS ' + password)
+            if resp[0] != '2':
+                raise error_reply(resp)
+            await ftp.void_command('TYPE I')
+        except ASYNC_ERRORS as e:
+            ftp.close()
+            raise e
+        return ftp
+
+    async def send_command(self, cmd):
+        """ send a command and return the reply, see ftplib.FTP.sendcmd
+
+            Args:
+                cmd - command to send
+
+            Returns:
+                the reply, a reply starting with 4 raises error_temp and a reply starting with 5 raises error_perm
+        """
+        self._send(cmd)
+        resp = await self._get_reply()
+        if resp[0:1] == '4':
+            raise error_temp(resp)
+        if resp[0:1] == '5':
+            raise error_perm(resp)
+        if resp[0:1] not in ('1', '2', '3'):
+            raise error_proto(resp)
+        return resp
+
+    async def size(self, remote_path):
+        """ return the size of a file in bytes, or None if the server does not reply with a size, see ftplib.FTP.size
+
+            Args:
+                remote_path - path to the file on the ftp server
+        """
+        resp = await self.send_command('SIZE ' + remote_path)
+        if resp[:3] != '213':
+            return None
+        return int(resp[3:].strip())
+
+    async def transfer(self, cmd, rest=None):
+        """ start a transfer and return the data connection, see ftplib.FTP.transfercmd
+
+            Args:
+                cmd - transfer command, for example RETR
+                rest - byte offset to start the transfer at, or None
+
+            Returns:
+                the data connection, a connected non-blocking socket
+        """
+        # the address in the reply to PASV is ignored the same way ftplib ignores it
+        peer = self._writer.get_extra_info('peername')
+        family = self._writer.get_extra_info('socket').family
+        if family == socket.AF_INET:
+            host, port = parse227(await self.send_command('PASV'))
+            host = peer[0]
+        else:
+            host, port = parse229(await self.send_command('EPSV'), peer)
+
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.setblocking(False)
+            await asyncio.wait_for(loop.sock_connect(sock, (host, port)), self.TIMEOUT)
+            if rest is not None:
+                await self.send_command('REST %s' % rest)
+            resp = await self.send_command(cmd)
+            if resp[0] == '2':
+                resp = await self._get_reply()
+            if resp[0] != '1':
+                raise error_reply(resp)
+        except ASYNC_ERRORS as e:
+            sock.close()
+            raise e
+        return sock
+
+    async def void_command(self, cmd):
+        """ send a command and raise error_reply if the reply is not a 2xx reply """
+        resp = await self.send_command(cmd)
+        if resp[0] != '2':
+            raise error_reply(resp)
+        return resp
+
+    async def void_response(self):
+        """ read a reply and raise error_reply if it is not a 2xx reply """
+        resp = await self._get_reply()
+        if resp[0:1] == '4':
+            raise error_temp(resp)
+        if resp[0:1] == '5':
+            raise error_perm(resp)
+        if resp[0] != '2':
+            raise error_reply(resp)
+        return resp
+
+
+class _AsyncTask:
+    """ handle of a download coroutine running on the event loop of the engine, it has the start, is_alive and join
+        methods of a thread so the manager keeps track of it like a download thread """
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, loop, target, args):
+        """ Initialize the class
+
+            Args:
+                loop - event loop to run the coroutine on
+                target - coroutine function
+                args - arguments of the coroutine function
+        """
+        self._loop = loop
+        self._target = target
+        self._args = args
+        self._future = None
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def is_alive(self):
+        """ return True if the coroutine has been started and has not finished """
+        return self._future is not None and not self._future.done()
+
+    def join(self, timeout=None):
+        """ wait until the coroutine has finished
+
+            Args:
+                timeout - maximum number of seconds to wait, None to wait forever
+        """
+        if self._future is not None:
+            concurrent.futures.wait([self._future], timeout)
+
+    def start(self):
+        """ schedule the coroutine on the event loop """
+        self._future = asyncio.run_coroutine_threadsafe(self._target(*self._args), self._loop)
+
+
+class AsyncEngine:
+    """ runs the download connections as coroutines on one asyncio event loop instead of one thread per connection
+
+        The event loop runs in a single background thread.  The coroutines speak the same channel protocol as the
+        download threads of the thread engine, so the manager, the blockmap and the scheduling policy are shared by
+        both engines, and only the transfers themselves move to the event loop.  Hundreds of connections then cost
+        one socket each instead of one thread stack each.
+
+        The engine keeps its own pool of logged in connections, with the same rules as FtpConnectionPool.  TLS is not
+        supported by the engine.
+    """
+    # --------------------------------------------------
+    # Constants
+    # --------------------------------------------------
+    DATA_TIMEOUT = 30.0     # seconds to wait for data on a data connection before the transfer is given up on
+    KILL_POLL = 0.25        # seconds a download coroutine waits for data before checking for messages
+
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, server_url, port, username, password, small_file_size, buffer_wait=0.1,
+                 small_file_chunk=65536, rate_limiter=None):
+        """ Initialize the class and start the event loop thread
+
+            Args:
+                server_url - url to the ftp server
+                port - port number to use for the ftp connection to the server
+                username - username to login to ftp server with
+                password - password to login to ftp server with
+                small_file_size - a small file larger than this many bytes is handed back to the manager
+                buffer_wait - seconds a coroutine sleeps while the buffer budget is exhausted before checking for
+                              messages
+                small_file_chunk - size in bytes of the buffer small files are received into
+                rate_limiter - TokenBucket which caps the total download speed, None for no cap
+        """
+        self._server_url = server_url
+        self._port = port
+        self._username = username
+        self._password = password
+        self._small_file_size = small_file_size
+        self._buffer_wait = buffer_wait
+        self._small_file_chunk = small_file_chunk
+        self._rate_limiter = rate_limiter or TokenBucket()
+        self._idle_connections = []         # connections waiting to be reused, only touched on the event loop
+        self._opening = 0                   # number of standby connections being opened, guarded by the lock
+        self._lock = Lock()
+        self._closed = False
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = Thread(target=self._tw_run_loop)
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+
+    # --------------------------------------------------
+    # Private Functions
+    # --------------------------------------------------
+    async def _acquire(self):
+        """ return a connection from the pool of the engine, a new connection is opened if the pool is empty, see
+            FtpConnectionPool.acquire """
+        while self._idle_connections:
+            ftp = self._idle_connections.pop()
+            idle = time.time() - ftp.returned_time
+            if idle <= FtpConnectionPool.VALIDATE_IDLE:
+                return ftp
+
+            # a connection which has waited for a while may have been dropped, it is replaced if it does not reply
+            if idle <= FtpConnectionPool.IDLE_TIMEOUT:
+                try:
+                    await asyncio.wait_for(ftp.void_command('NOOP'), FtpConnectionPool.DRAIN_TIMEOUT)
+                    return ftp
+                except ASYNC_ERRORS as _:
+                    pass
+            ftp.close()
+        return await AsyncFtpConnection.open(self._server_url, self._port, self._username, self._password)
+
+    async def _close_connections(self):
+        """ close every connection in the pool of the engine """
+        self._closed = True
+        for ftp in self._idle_connections:
+            ftp.close()
+        self._idle_connections = []
+
+    async def _open_standby(self):
+        """ open a standby connection and put it into the pool, errors are ignored since the connection will be opened
+            again when it is needed """
+        try:
+            ftp = await AsyncFtpConnection.open(self._server_url, self._port, self._username, self._password)
+        except ASYNC_ERRORS as _:
+            ftp = None
+        with self._lock:
+            self._opening = self._opening - 1
+        if ftp is not None:
+            await self._release(ftp)
+
+    async def _recv_into(self, sock, view, timeout=DATA_TIMEOUT):
+        """ receive data from a data connection straight into a buffer
+
+            Args:
+                sock - non-blocking data connection
+                view - memoryview of the buffer to receive into
+                timeout - maximum number of seconds to wait for data
+
+            Returns:
+                number of bytes received, 0 at the end of the file
+        """
+        return await asyncio.wait_for(self._loop.sock_recv_into(sock, view), timeout)
+
+    async def _receive_segment(self, remote_path, sock, state, channel_in, buffer_pool):
+        """ receive the blocks of a segment until the end of the segment, the end of the file, or a kill from the
+            manager
+
+            Args:
+                remote_path - path to the remote file
+                sock - non-blocking data connection of the segment
+                state - SegmentState of the download coroutine
+                channel_in - Channel of control messages from the manager
+                buffer_pool - BlockBufferPool to receive the blocks into
+
+            Returns:
+                True at the end of the file
+        """
+        buf = None
+        view = None
+        try:
+            while state.byte_offset < state.end_byte_offset:
+                # check for control messages from the manager
+                next_range = state.poll_control_messages(channel_in)
+                if next_range is not None:
+                    state.next_segment = await self._start_next_segment(remote_path, *next_range)
+                if state.killed:
+                    return False
+
+                # wait for tokens while the download is over the max rate
+                delay = state.throttle_delay(self._buffer_wait)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    state.on_wait()
+                    continue
+
+                # the event loop must never block, so the buffer budget is polled
+                if buf is None:
+                    buf = buffer_pool.acquire(0)
+                    if buf is None:
+                        await asyncio.sleep(self._buffer_wait)
+                        state.on_wait(reset_speed=True)
+                        continue
+                    view = memoryview(buf)
+
+                # receive the data into the rest of the block buffer, the wait for data is given up on after KILL_POLL
+                # seconds so that a kill from the manager is noticed while the server is not sending anything, the
+                # transfer is only given up on after DATA_TIMEOUT
+                try:
+                    received = await self._recv_into(sock, view[state.filled:], self.KILL_POLL)
+                except asyncio.TimeoutError as e:
+                    if state.stalled(self.DATA_TIMEOUT):
+                        raise e
+                    continue
+
+                # send the buffer once the block is full, or at the end of the file where the last block is short
+                if state.on_received(received):
+                    state.send_block(buf)
+                    buf = None
+                if received == 0:
+                    return True
+            return False
+        finally:
+            if buf is not None:
+                buffer_pool.release(buf)
+
+    async def _recv_small_file(self, sock, view, state):
+        """ receive the data of a small file into a buffer, after waiting while the download is over the max rate
+
+            Args:
+                sock - non-blocking data connection
+                view - memoryview of the buffer to receive into
+                state - SmallFilesState of the download coroutine
+
+            Returns:
+                number of bytes received, 0 at the end of the file
+        """
+        delay = state.throttle_delay(self._buffer_wait)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = state.throttle_delay(self._buffer_wait)
+        received = await self._recv_into(sock, view)
+        state.on_received(received)
+        return received
+
+    async def _release(self, ftp, abort=False):
+        """ return a connection to the pool of the engine, see FtpConnectionPool.release """
+        if abort:
+            try:
+                await asyncio.wait_for(ftp.drain(FtpConnectionPool.MAX_DRAIN_REPLIES), FtpConnectionPool.DRAIN_TIMEOUT)
+            except ASYNC_ERRORS as _:
+                ftp.close()
+                return
+        if self._closed:
+            ftp.close()
+            return
+        ftp.returned_time = time.time()
+        self._idle_connections.append(ftp)
+
+    async def _start_next_segment(self, remote_path, byte_offset, end_byte_offset):
+        """ start the transfer of the next segment of a download coroutine on a second connection, see
+            FtpDownloadThreads._start_next_segment
+
+            Returns:
+                [ftp connection, data connection, byte_offset, end_byte_offset] of the next segment, or None if the
+                transfer could not be started
+        """
+        try:
+            ftp = await self._acquire()
+        except ASYNC_ERRORS as _:
+            return None
+        try:
+            sock = await ftp.transfer('RETR %s' % remote_path, byte_offset)
+        except ASYNC_ERRORS as _:
+            ftp.close()
+            return None
+        return [ftp, sock, byte_offset, end_byte_offset]
+
+    def _tw_run_loop(self):
+        """ thread worker which runs the event loop until the engine is closed """
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def close(self):
+        """ close the connections of the engine and stop the event loop """
+        if self._loop.is_closed():
+            return
+        future = asyncio.run_coroutine_threadsafe(self._close_connections(), self._loop)
+        concurrent.futures.wait([future], FtpConnectionPool.DRAIN_TIMEOUT)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join(FtpConnectionPool.DRAIN_TIMEOUT)
+        if not self._loop_thread.is_alive():
+            self._loop.close()
+
+    async def download_segment(self, remote_path, _local_path, byte_offset, blocks, blocksize, worker_id, channel_in,
+                               channel_out, buffer_pool):
+        """ download coroutine to download a segment of a file, see FtpDownloadThreads._tw_ftp_download_segment """
+        # errors from the server, for example too many connections, end the coroutine and are reported to the manager
+        state = SegmentState(worker_id, byte_offset, blocks, blocksize, self._rate_limiter, channel_out)
+        ftp = None
+        sock = None
+        try:
+            ftp = await self._acquire()
+            sock = await ftp.transfer('RETR %s' % remote_path, byte_offset)
+
+            # each pass downloads one segment
+            while True:
+                eof = await self._receive_segment(remote_path, sock, state, channel_in, buffer_pool)
+
+                # return the connection to the pool
+                sock.close()
+                sock = None
+                if eof:
+                    await ftp.void_response()
+                await self._release(ftp, abort=not eof)
+                ftp = None
+
+                # move on to the next segment
+                if state.next_segment is None:
+                    break
+                ftp, sock = state.move_to_next_segment()
+
+            # set the coroutine to be idle
+            state.finish()
+        except ASYNC_ERRORS as e:
+            if sock is not None:
+                sock.close()
+            if ftp is not None:
+                ftp.close()
+            if state.next_segment is not None:
+                state.next_segment[1].close()
+                state.next_segment[0].close()
+            state.fail(e)
+
+    async def download_small_files(self, files, worker_id, channel_in, channel_out):
+        """ download coroutine to fetch a batch of small files one after the other on one connection, see
+            FtpDownloadThreads._tw_ftp_download_small_files """
+        state = SmallFilesState(worker_id, files, self._small_file_size, self._rate_limiter, channel_out)
+        ftp = None
+        part_path = None
+        try:
+            ftp = await self._acquire()
+            view = memoryview(bytearray(self._small_file_chunk))
+            for remote_path, local_path, size in state.pending_files(channel_in):
+                # hand the file back if it turns out to be too large
+                if size is None:
+                    size = await ftp.size(remote_path)
+                if state.deferred(remote_path, local_path, size):
+                    continue
+
+                # fetch the file into a partial file, which replaces the local file once the whole file has arrived.
+                # The local file is written on the default executor so that the event loop never waits for the disk
+                part_path = local_path + '.part'
+                sock = await ftp.transfer('RETR %s' % remote_path)
+                with closing(sock):
+                    f = await self._loop.run_in_executor(None, open, part_path, 'wb')
+                    try:
+                        received = await self._recv_small_file(sock, view, state)
+                        while received > 0:
+                            await self._loop.run_in_executor(None, f.write, view[:received])
+                            received = await self._recv_small_file(sock, view, state)
+                    finally:
+                        await self._loop.run_in_executor(None, f.close)
+                await ftp.void_response()
+                await self._loop.run_in_executor(None, _replace_file, part_path, local_path)
+                part_path = None
+                state.file_done(remote_path, local_path, size)
+
+            # return the connection to the pool, every transfer on it has been completed, then set the coroutine to
+            # be idle
+            await self._release(ftp)
+            ftp = None
+            state.finish()
+        except Exception as e:     # pylint: disable=W0703
+            if ftp is not None:
+                ftp.close()
+            if part_path is not None:
+                await self._loop.run_in_executor(None, _remove_file, part_path)
+            state.fail(e)
+
+    def prewarm(self, count):
+        """ open connections in the background until at least count connections are waiting in the pool
+
+            Args:
+                count - number of standby connections to keep in the pool
+        """
+        with self._lock:
+            needed = 0 if self._closed else count - len(self._idle_connections) - self._opening
+            self._opening = self._opening + max(0, needed)
+        for _ in range(0, needed):
+            asyncio.run_coroutine_threadsafe(self._open_standby(), self._loop)
+
+    def task(self, target, args):
+        """ return a handle of a download coroutine which is run on the event loop once it is started
+
+            Args:
+                target - download_segment or download_small_files
+                args - arguments of the coroutine function
+
+            Returns:
+                _AsyncTask with the start, is_alive and join methods of a thread
+        """
+        return _AsyncTask(self._loop, target, args)
@@ -0,0 +1,226 @@
+""" pool of reusable buffers to receive blocks into """
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+from collections import deque
+from threading import Condition
+import time
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+class BlockBufferPool:
+    """ pool of preallocated bytearrays, each the size of one block
+
+        The download threads receive data straight into a buffer from the pool with socket.recv_into.  A full buffer
+        is passed to the manager without copying it, and is released back to the pool once it has been written to disk,
+        so the same few buffers are reused for the whole download.
+
+        If the pool has a budget, no more than max_bytes of buffers are ever allocated at once.  acquire blocks while
+        the budget is exhausted, so a download thread stops reading from its socket until the data which has already
+        been received has been written to disk.  The pools of files with different blocksizes may share one
+        BufferBudget, so that the buffers of all of the pools together are held to the budget.
+    """
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, blocksize, max_bytes=None, budget=None):
+        """ Initialize the class
+
+            Args:
+                blocksize - size of each buffer in bytes
+                max_bytes - budget in bytes for the buffers of this pool, at least one buffer is always allowed, None
+                            for no budget.  Ignored if budget is given
+                budget - BufferBudget shared with other pools, None for a budget of max_bytes for this pool alone
+        """
+        self._blocksize = blocksize
+        self._budget = budget if budget is not None else BufferBudget(max_bytes)
+        self._free_buffers = deque()
+        self._allocated = 0
+        self._in_use = 0
+        self._condition = self._budget.condition
+        self._budget.add_pool(self)
+
+    # --------------------------------------------------
+    # Properties
+    # --------------------------------------------------
+    @property
+    def allocated(self):
+        """ return the number of buffers which have been allocated by the pool and not dropped """
+        return self._allocated
+
+    @property
+    def blocksize(self):
+        """ return the size of each buffer in bytes """
+        return self._blocksize
+
+    @property
+    def budget(self):
+        """ return the BufferBudget of the pool """
+        return self._budget
+
+    @property
+    def exhausted(self):
+        """ return True if acquire would wait for the budget """
+        with self._condition:
+            return not self._free_buffers and not self._budget.fits(self)
+
+    @property
+    def free(self):
+        """ return the number of buffers waiting in the pool to be reused """
+        return len(self._free_buffers)
+
+    @property
+    def in_use(self):
+        """ return the number of buffers which have been handed out and not released yet """
+        return self._in_use
+
+    @property
+    def max_buffers(self):
+        """ return the maximum number of buffers which can be handed out at once, or None if there is no budget """
+        if self._budget.max_bytes is None:
+            return None
+        return max(1, int(self._budget.max_bytes // self._blocksize))
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def acquire(self, timeout=None):
+        """ return a buffer from the pool, a new buffer is allocated if the pool is empty.  Blocks while the budget is
+            exhausted
+
+            Args:
+                timeout - maximum number of seconds to wait for the budget, None to wait forever
+
+            Returns:
+                a bytearray of blocksize bytes, its contents are undefined, or None if the timeout expired
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while not self._free_buffers and not self._budget.reserve(self):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+            self._in_use = self._in_use + 1
+            if self._free_buffers:
+                return self._free_buffers.pop()
+            self._allocated = self._allocated + 1
+        return bytearray(self._blocksize)
+
+    def drop_free(self):
+        """ drop a buffer waiting to be reused to make room in the budget for the buffers of another pool, the lock of
+            the budget must be held """
+        self._free_buffers.pop()
+        self._allocated = self._allocated - 1
+
+    def release(self, buf):
+        """ return a buffer to the pool so that it can be reused
+
+            Args:
+                buf - buffer which was returned by acquire
+        """
+        with self._condition:
+            self._free_buffers.append(buf)
+            self._in_use = self._in_use - 1
+            # the waiting threads may be waiting for other pools which share the budget
+            self._condition.notify_all()
+
+
+class BufferBudget:
+    """ budget in bytes for the buffers of one or more block buffer pools
+
+        The pools share the lock of the budget.  A pool only allocates a new buffer while the buffers of all of the
+        pools, handed out or waiting to be reused, fit in the budget, and the buffers waiting in the other pools are
+        dropped to make room, so the files with different blocksizes do not each get a budget of their own.
+    """
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, max_bytes=None):
+        """ Initialize the class
+
+            Args:
+                max_bytes - budget in bytes for the buffers of the pools, at least one buffer is always allowed, None
+                            for no budget
+        """
+        self._max_bytes = max_bytes
+        self._allocated_bytes = 0
+        self._pools = []
+        self._condition = Condition()
+
+    # --------------------------------------------------
+    # Private Functions
+    # --------------------------------------------------
+    def _held_bytes(self, pool):
+        """ return the number of bytes allocated by the pools which can not be dropped to make room for a new buffer
+            of a pool, the lock must be held
+
+            Args:
+                pool - pool which needs a new buffer
+        """
+        return self._allocated_bytes - sum(p.free * p.blocksize for p in self._pools if p is not pool)
+
+    # --------------------------------------------------
+    # Properties
+    # --------------------------------------------------
+    @property
+    def allocated_bytes(self):
+        """ return the number of bytes allocated by the pools """
+        return self._allocated_bytes
+
+    @property
+    def condition(self):
+        """ return the Condition which guards the budget and its pools """
+        return self._condition
+
+    @property
+    def max_bytes(self):
+        """ return the budget in bytes, or None if there is no budget """
+        return self._max_bytes
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def add_pool(self, pool):
+        """ add a pool to the pools which share the budget
+
+            Args:
+                pool - BlockBufferPool to add
+        """
+        with self._condition:
+            self._pools.append(pool)
+
+    def fits(self, pool):
+        """ return True if a new buffer of a pool fits in the budget once the buffers waiting in the other pools have
+            been dropped, the lock must be held
+
+            Args:
+                pool - pool which needs a new buffer
+        """
+        if self._max_bytes is None:
+            return True
+        held = self._held_bytes(pool)
+        return held == 0 or held + pool.blocksize <= self._max_bytes
+
+    def reserve(self, pool):
+        """ reserve the room for a new buffer of a pool, the buffers waiting in the other pools are dropped until the
+            buffer fits, the lock must be held
+
+            Args:
+                pool - pool which needs a new buffer
+
+            Returns:
+                True if the room was reserved, False if the budget is exhausted
+        """
+        if not self.fits(pool):
+            return False
+        if self._max_bytes is not None:
+            for other in self._pools:
+                while (other is not pool and other.free and
+                       self._allocated_bytes + pool.blocksize > self._max_bytes):
+                    other.drop_free()
+                    self._allocated_bytes = self._allocated_bytes - other.blocksize
+        self._allocated_bytes = self._allocated_bytes + pool.blocksize
+        return True
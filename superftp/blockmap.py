@@ -3,8 +3,14 @@
 # --------------------------------------------------
 #    Imports
 # --------------------------------------------------
+import bisect
 import math
+import mmap
 import os
+import re
+import struct
+import time
+import zlib
 
 
 # --------------------------------------------------
@@ -14,11 +20,169 @@ class BlockmapException(Exception):
     """ Blockmap Exception Class """
 
 
+class RunIndex:
+    """ interval index of the runs of blocks in a blockmap which share a state, for example the available blocks or the
+        blocks allocated to one worker
+
+        The runs are kept sorted by starting block and by length so that finding the run containing a block, adding or
+        removing a range of blocks, and finding the largest run are binary searches instead of scans of the whole
+        blockmap.  Adjacent runs are always merged, so every run in the index is a maximal run of blocks.
+    """
+    def __init__(self):
+        """ initialize an empty index """
+        self._starts = []       # sorted list of the starting block of each run
+        self._lengths = {}      # starting block of each run -> number of blocks in the run
+        self._by_length = []    # sorted list of (-length, starting block) so the largest, leftmost run is first
+        self._blocks = 0        # total number of blocks in all of the runs
+
+    def __len__(self):
+        """ number of runs in the index """
+        return len(self._starts)
+
+    def _delete_run(self, i):
+        """ delete the i-th run (in starting block order) from the index """
+        start = self._starts.pop(i)
+        length = self._lengths.pop(start)
+        del self._by_length[bisect.bisect_left(self._by_length, (-length, start))]
+        self._blocks = self._blocks - length
+
+    def _insert_run(self, start, length):
+        """ insert a run which does not overlap or touch any other run in the index """
+        bisect.insort(self._starts, start)
+        self._lengths[start] = length
+        bisect.insort(self._by_length, (-length, start))
+        self._blocks = self._blocks + length
+
+    @property
+    def blocks(self):
+        """ total number of blocks in all of the runs """
+        return self._blocks
+
+    def add(self, start, length):
+        """ add a range of blocks to the index, merging it with the neighbouring runs
+
+            Args:
+                start - starting block of the range
+                length - number of blocks in the range
+        """
+        if length <= 0:
+            return
+        end = start + length
+
+        # merge with the run on the left if it overlaps or touches the new range
+        i = bisect.bisect_right(self._starts, start) - 1
+        if i >= 0 and self._starts[i] + self._lengths[self._starts[i]] >= start:
+            start = self._starts[i]
+            end = max(end, start + self._lengths[start])
+            self._delete_run(i)
+        else:
+            i = i + 1
+
+        # merge with the runs on the right that overlap or touch the new range
+        while i < len(self._starts) and self._starts[i] <= end:
+            end = max(end, self._starts[i] + self._lengths[self._starts[i]])
+            self._delete_run(i)
+
+        self._insert_run(start, end - start)
+
+    def find(self, block):
+        """ return the run which contains a block
+
+            Args:
+                block - block to look for
+
+            Returns:
+                (starting block, number of blocks) or None if the block is not in any run
+        """
+        i = bisect.bisect_right(self._starts, block) - 1
+        if i >= 0 and self._starts[i] + self._lengths[self._starts[i]] > block:
+            return self._starts[i], self._lengths[self._starts[i]]
+        return None
+
+    def largest(self):
+        """ return the largest run of blocks, the leftmost run is returned if there is a tie
+
+            Returns:
+                (starting block, number of blocks) or None if the index is empty
+        """
+        if not self._by_length:
+            return None
+        neg_length, start = self._by_length[0]
+        return start, -neg_length
+
+    def remove(self, start, length):
+        """ remove a range of blocks from the index, splitting the runs it overlaps
+
+            Args:
+                start - starting block of the range
+                length - number of blocks in the range
+
+            Returns:
+                number of blocks which were removed from the index
+        """
+        if length <= 0:
+            return 0
+        end = start + length
+        blocks = self._blocks
+
+        # find the first run which overlaps the range
+        i = bisect.bisect_right(self._starts, start) - 1
+        if i < 0 or self._starts[i] + self._lengths[self._starts[i]] <= start:
+            i = i + 1
+
+        # remove the overlapping runs, and add back the pieces which are outside of the range
+        pieces = []
+        while i < len(self._starts) and self._starts[i] < end:
+            run_start = self._starts[i]
+            run_end = run_start + self._lengths[run_start]
+            if run_start < start:
+                pieces.append((run_start, start - run_start))
+            if run_end > end:
+                pieces.append((end, run_end - end))
+            self._delete_run(i)
+        for piece in pieces:
+            self._insert_run(*piece)
+        return blocks - self._blocks
+
+    def runs(self):
+        """ return a list of (starting block, number of blocks) of each run sorted by starting block """
+        return [(start, self._lengths[start]) for start in self._starts]
+
+
 class Blockmap:
     """ class used to keep track of which blocks in the file have been downloaded, which are currently pending download
         by which connections, and which blocks are available.
 
-        The blockmap is always read from disk and never kept in memory
+        The blockmap is stored on disk as a snapshot in a versioned binary format, a fixed size header followed by one
+        state code per block, plus an append-only journal of the blocks which have been downloaded since the snapshot.
+        The snapshot is memory mapped as a private copy so that a change in the status of a block is a single in place
+        byte store in the mapping, and the mapping is the authoritative copy while a download is in progress.
+
+        Every range of blocks marked as downloaded is appended to the journal.  A checkpoint writes a new snapshot to a
+        temporary file, renames it over the old snapshot and truncates the journal, so a crash can never leave a
+        partially written blockmap behind.  A checkpoint is taken every checkpoint_interval seconds or after
+        checkpoint_blocks blocks have been journaled, whichever comes first.  Call checkpoint() to force one, for
+        example on abort or exit.  When the blockmap is loaded after a crash the journal is replayed over the snapshot
+        to recover the exact set of downloaded blocks.
+
+        The durability level controls when the journal and snapshots are fsync'd
+
+            DURABILITY_NONE - never fsync, survives a crash of the process but not of the operating system
+            DURABILITY_CHECKPOINT - fsync the downloaded file before its blocks are journaled, and the snapshot on
+                                    every checkpoint.  A crash of the operating system may lose the last records of
+                                    the journal, their blocks are downloaded again
+            DURABILITY_JOURNAL - also fsync the journal every time blocks are journaled, nothing is lost
+
+        A journal record is only trusted on replay because the blocks it marks as downloaded were fsync'd to the
+        downloaded file before the record was written, except with DURABILITY_NONE.
+
+        Blocks can be allocated to any number of workers.  A worker id is a hexadecimal string, for example '0', 'a',
+        or '1f', ids which differ only in case are the same worker.  The ownership of the pending blocks is kept in an
+        index of the runs of blocks allocated to each worker, the state code of a pending block only records that the
+        block is pending and is shown as the last hexadecimal digit of the id of its worker.
+
+        Blockmaps saved in the original text format (the blocksize on the first line followed by one character per
+        block) are migrated to the binary format when they are loaded.
     """
     # --------------------------------------------------
     # Constants
@@ -26,13 +190,24 @@ class Blockmap:
     DOWNLOADED = '*'                # block has been saved to the disk
     AVAILABLE = '.'                 # block is available to be allocated to a worker thread for downloading
     SAVING = '_'                    # data for block has been received and is in the queue waiting to be written to disk
-    PENDING = '0123456789ABCDEF'    # block has been allocated to one of the worker threads (16 possible)
+    PENDING = '0123456789ABCDEF'    # block has been allocated to a worker thread, shown as the worker id modulo 16
+    STATES = AVAILABLE + DOWNLOADED + SAVING + PENDING      # all of the valid states of a block
+
+    FILE_MAGIC = b'SFBM'            # magic bytes at the start of a binary blockmap file
+    FILE_VERSION = 1                # version of the binary blockmap file format
+    FILE_HEADER = struct.Struct('<4sB3xQQ')     # magic, version, padding, blocksize, number of blocks
+    JOURNAL_RECORD = struct.Struct('<QQcI')     # starting block, number of blocks, new state code, crc32
+
+    DURABILITY_NONE = 'none'                # never fsync the blockmap
+    DURABILITY_CHECKPOINT = 'checkpoint'    # fsync the downloaded file on every journaled change and the snapshot
+    DURABILITY_JOURNAL = 'journal'          # also fsync the journal on every journaled change
 
     # --------------------------------------------------
     # Init
     # --------------------------------------------------
     def __init__(self, remote_path, local_path, file_size_func, min_blocks_per_segment=8, max_blocks_per_segment=512,
-                 initial_blocksize=1048576):
+                 initial_blocksize=1048576, checkpoint_interval=5.0, checkpoint_blocks=64,
+                 durability=DURABILITY_CHECKPOINT):
         """ initialize the blockmap
 
             Check if a local blockmap exists in the local_path location, if it does not exist, try to contact the FTP
@@ -54,6 +229,12 @@ class Blockmap:
                 min_blocks_per_segment - minimum number of blocks per download segment, default is 8
                 max_blocks_per_segment - maximum number of blocks per download segment, default is 512
                 initial_blocksize - size of each block in bytes if creating a new blockmap, default is 1MB
+                checkpoint_interval - maximum number of seconds between checkpoints of the blockmap to disk, default
+                                      is 5 seconds
+                checkpoint_blocks - maximum number of downloaded blocks journaled between checkpoints of the blockmap
+                                    to disk, default is 64
+                durability - one of DURABILITY_NONE, DURABILITY_CHECKPOINT, or DURABILITY_JOURNAL, default is
+                             DURABILITY_CHECKPOINT
         """
         self._initial_blocksize = initial_blocksize
         self._remote_path = remote_path
@@ -61,11 +242,32 @@ class Blockmap:
         self._file_size_func = file_size_func
         self._min_blocks_per_segment = min_blocks_per_segment
         self._max_blocks_per_segment = max_blocks_per_segment
+        self._checkpoint_interval = checkpoint_interval
+        self._checkpoint_blocks = checkpoint_blocks
+        if durability not in (self.DURABILITY_NONE, self.DURABILITY_CHECKPOINT, self.DURABILITY_JOURNAL):
+            raise BlockmapException('durability of "%s" is not a valid durability level' % durability)
+        self._durability = durability
+
+        # private memory mapping of the snapshot and the journal, opened on first use
+        self._mmap = None
+        self._journal_fd = None
+        self._blocksize = None
+        self._blocks = None
+        self._dirty_blocks = 0
+        self._journal_blocks = 0
+        self._last_checkpoint_time = time.time()
+
+        # index of the runs of available blocks, of the runs of blocks allocated to each worker, and the number of
+        # blocks in each state, rebuilt when the blockmap is opened and updated on every state change
+        self._free_runs = RunIndex()
+        self._worker_runs = {}
+        self._state_counts = {}
 
         # generate the blockmap_path
         if os.path.isdir(local_path):
             raise BlockmapException('Error! local path "%s" is a directory, must be a file' % local_path)
         self._blockmap_path = self._local_path + '.blockmap'
+        self._journal_path = self._blockmap_path + '.journal'
 
     def __repr__(self):
         """ string representation of the blockmap """
@@ -82,13 +284,86 @@ class Blockmap:
     # --------------------------------------------------
     # Private Functions
     # --------------------------------------------------
-    def _read_blockmap(self):
-        """ load the blockmap from the local copy on the disk
+    def _append_journal(self, start_block, blocks, code):
+        """ append a change in the status of a range of blocks to the journal, the blocks are fsync'd to the
+            downloaded file first since the record is trusted when the journal is replayed
+
+            Args:
+                start_block - first block of the range
+                blocks - number of blocks in the range
+                code - new state code of the blocks
+        """
+        if self._durability != self.DURABILITY_NONE:
+            self._fsync_path(self._local_path)
+        record = self.JOURNAL_RECORD.pack(start_block, blocks, code, 0)
+        record = record[:-4] + struct.pack('<I', zlib.crc32(record[:-4]) & 0xffffffff)
+        os.write(self._journal_fd, record)
+        if self._durability == self.DURABILITY_JOURNAL:
+            os.fsync(self._journal_fd)
+        self._journal_blocks = self._journal_blocks + blocks
+
+    def _close_blockmap(self):
+        """ unmap the snapshot and close the journal if they are open """
+        if self._mmap is not None:
+            self._mmap.close()
+        if self._journal_fd is not None:
+            os.close(self._journal_fd)
+        self._mmap = None
+        self._journal_fd = None
+        self._blocksize = None
+        self._blocks = None
+        self._dirty_blocks = 0
+        self._journal_blocks = 0
+        self._free_runs = RunIndex()
+        self._worker_runs = {}
+        self._state_counts = {}
+
+    @classmethod
+    def _fsync_path(cls, path, directory=False):
+        """ fsync a file or a directory if it exists, errors are ignored on platforms which can not fsync directories
+
+            Args:
+                path - path to the file or directory
+                directory - True if path is a directory
+        """
+        if not os.path.exists(path):
+            return
+        try:
+            fd = os.open(path, os.O_RDONLY if directory else os.O_RDWR)
+        except OSError as _:
+            return
+        try:
+            os.fsync(fd)
+        except OSError as _:
+            pass
+        finally:
+            os.close(fd)
+
+    def _get_block_range(self, byte_offset, blocks):
+        """ convert a byte offset and number of blocks to a slice of the memory mapping
+
+            Args:
+                byte_offset - starting byte offset of the block range, must be a multiple of the blocksize
+                blocks - number of blocks in the block range
+
+            Returns:
+                (start, end) indexes into the memory mapping
+        """
+        if byte_offset % self._blocksize != 0:
+            raise BlockmapException('byte_offset %d is not a multiple of block size %d' % (byte_offset,
+                                                                                           self._blocksize))
+        starting_block = int(byte_offset // self._blocksize)
+        if starting_block < 0 or blocks < 0 or starting_block + blocks > self._blocks:
+            raise BlockmapException('block range %d+%d is outside of the blockmap' % (starting_block, blocks))
+        return self.FILE_HEADER.size + starting_block, self.FILE_HEADER.size + starting_block + blocks
+
+    def _load_text_blockmap(self):
+        """ load a blockmap saved in the original text format
 
             skip the first line, which is the blocksize
 
             Returns:
-                string representation of the blockmap
+                (blocksize, string representation of the blockmap)
         """
         with open(self._blockmap_path, 'r') as f:
             s = f.read()
@@ -96,20 +371,235 @@ class Blockmap:
             s = s[s.find('\n') + 1:]
             return blocksize, s
 
+    def _mark_dirty(self, changed_blocks):
+        """ record that blocks have changed status, and checkpoint the blockmap to disk if the checkpoint interval has
+            elapsed or too many blocks have been journaled since the last checkpoint
+
+            Args:
+                changed_blocks - number of blocks which changed status
+        """
+        self._dirty_blocks = self._dirty_blocks + changed_blocks
+        if ((self._journal_blocks >= self._checkpoint_blocks) or
+                (self._journal_blocks > 0 and time.time() - self._last_checkpoint_time >= self._checkpoint_interval)):
+            self.checkpoint()
+
+    def _open_blockmap(self):
+        """ memory map the snapshot on the disk and replay the journal over it, migrating a text format blockmap to
+            the binary format """
+        if self._mmap is not None:
+            return
+
+        # migrate the blockmap if it was saved in the text format
+        with open(self._blockmap_path, 'rb') as f:
+            magic = f.read(len(self.FILE_MAGIC))
+            if magic != self.FILE_MAGIC:
+                blocksize, blockstr = self._load_text_blockmap()
+                self._persist_blockmap(blocksize, blockstr)
+                return
+
+            # map a private copy of the snapshot and sanity check the header
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        _magic, version, self._blocksize, self._blocks = self.FILE_HEADER.unpack_from(self._mmap, 0)
+        if version != self.FILE_VERSION or len(self._mmap) != self.FILE_HEADER.size + self._blocks:
+            self._close_blockmap()
+            raise BlockmapException('blockmap "%s" is corrupt or has an unsupported version' % self._blockmap_path)
+        self._rebuild_indexes()
+
+        # replay the journal, then open it for appending
+        self._replay_journal()
+        self._journal_fd = os.open(self._journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._last_checkpoint_time = time.time()
+
+    def _read_blockmap(self):
+        """ return a view of the blockmap, loading it from the disk if it has not been loaded yet
+
+            Returns:
+                (blocksize, string representation of the blockmap)
+        """
+        self._open_blockmap()
+        return self._blocksize, self._mmap[self.FILE_HEADER.size:].decode('ascii')
+
     def _persist_blockmap(self, blocksize, blockstr):
-        """ save the blockmap to disk
+        """ save the blockmap to disk as a new snapshot in the binary format, and memory map it
 
             Args:
+                blocksize - size of each block in bytes
                 blockstr - string representation of the blockmap to persist
         """
-        with open(self._blockmap_path, 'w') as f:
-            f.write(str(blocksize) + '\n' + blockstr)
+        self._close_blockmap()
+        self._write_snapshot(self.FILE_HEADER.pack(self.FILE_MAGIC, self.FILE_VERSION, blocksize, len(blockstr)) +
+                             blockstr.encode('ascii'))
+        if os.path.exists(self._journal_path):
+            os.remove(self._journal_path)
+        self._open_blockmap()
+
+    def _replay_journal(self):
+        """ apply the changes recorded in the journal to the blockmap, a torn or corrupt record at the end of the
+            journal is the result of a crash while appending and is ignored along with anything after it """
+        if not os.path.exists(self._journal_path):
+            return
+        with open(self._journal_path, 'rb') as f:
+            data = f.read()
+        for i in range(0, len(data) - self.JOURNAL_RECORD.size + 1, self.JOURNAL_RECORD.size):
+            record = data[i:i + self.JOURNAL_RECORD.size]
+            start_block, blocks, code, crc = self.JOURNAL_RECORD.unpack(record)
+            if (zlib.crc32(record[:-4]) & 0xffffffff) != crc or start_block + blocks > self._blocks:
+                break
+            self._set_block_range(self.FILE_HEADER.size + start_block, self.FILE_HEADER.size + start_block + blocks,
+                                  code, journal=False)
+        self._dirty_blocks = 0
+
+    def _write_snapshot(self, data):
+        """ atomically replace the snapshot on the disk by writing a temporary file and renaming it over the snapshot
+
+            Args:
+                data - contents of the snapshot
+        """
+        temp_path = self._blockmap_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            if self._durability != self.DURABILITY_NONE:
+                os.fsync(f.fileno())
+        getattr(os, 'replace', os.rename)(temp_path, self._blockmap_path)
+        if self._durability != self.DURABILITY_NONE:
+            self._fsync_path(os.path.dirname(os.path.abspath(self._blockmap_path)), directory=True)
+
+    def _find_runs(self, codes, start, end):
+        """ find the runs of identical state codes in a range of the memory mapping
+
+            Args:
+                codes - the state codes to look for
+                start - index into the memory mapping to start looking at
+                end - index into the memory mapping to stop looking at
+
+            Returns:
+                list of (start, end, code) of each run found, start and end are indexes into the memory mapping
+        """
+        pattern = re.compile(b'([' + re.escape(codes.encode('ascii')) + b'])\\1*')
+        return [(m.start(), m.end(), m.group(1)) for m in pattern.finditer(self._mmap, start, end)]
+
+    def _rebuild_indexes(self):
+        """ rebuild the index of the runs of available blocks, of the blocks allocated to each worker, and the number
+            of blocks in each state from a scan of the whole blockmap """
+        self._free_runs = RunIndex()
+        self._worker_runs = {}
+        self._state_counts = {}
+        for start, end, code in self._find_runs(self.STATES, self.FILE_HEADER.size, len(self._mmap)):
+            worker = int(code, 16) if code.decode('ascii') in self.PENDING else None
+            self._index_block_range(start, end, code, worker)
+
+    def _index_block_range(self, start, end, code, worker):
+        """ add a range of blocks to the indexes and counters for its state code
+
+            Args:
+                start - index into the memory mapping of the first block
+                end - index into the memory mapping after the last block
+                code - state code of the blocks
+                worker - number of the worker the blocks are allocated to, or None if the blocks are not pending
+        """
+        self._state_counts[code] = self._state_counts.get(code, 0) + (end - start)
+        if code == self.AVAILABLE.encode('ascii'):
+            self._free_runs.add(start - self.FILE_HEADER.size, end - start)
+        elif worker is not None:
+            if worker not in self._worker_runs:
+                self._worker_runs[worker] = RunIndex()
+            self._worker_runs[worker].add(start - self.FILE_HEADER.size, end - start)
+
+    def _parse_worker_id(self, worker_id):
+        """ convert a worker id to a worker number
+
+            Args:
+                worker_id - hexadecimal string id of the worker
 
-    def allocate_segments(self, worker_ids):
+            Returns:
+                the worker number
+        """
+        try:
+            worker = int(worker_id, 16)
+        except (TypeError, ValueError) as _:
+            raise BlockmapException('status of "%s" is not a valid status' % worker_id)
+        if worker < 0:
+            raise BlockmapException('status of "%s" is not a valid status' % worker_id)
+        return worker
+
+    def _set_block_range(self, start, end, code, worker=None, journal=True):
+        """ set the state code of a range of blocks and update the indexes, this only looks at the blocks in the range
+
+            Args:
+                start - index into the memory mapping of the first block
+                end - index into the memory mapping after the last block
+                code - new state code of the blocks
+                worker - number of the worker the blocks are allocated to, or None if the blocks are not pending
+                journal - append the change to the journal if the blocks have been downloaded
+        """
+        if start == end:
+            return
+
+        # remove the blocks from the indexes and counters of their old states
+        for run_start, run_end, old_code in self._find_runs(self.STATES, start, end):
+            self._unindex_block_range(run_start, run_end, old_code)
+
+        # set the status of the blocks with a single store into the mapping and index them under the new status
+        self._mmap[start:end] = code * (end - start)
+        self._index_block_range(start, end, code, worker)
+        if journal and code == self.DOWNLOADED.encode('ascii'):
+            self._append_journal(start - self.FILE_HEADER.size, end - start, code)
+        self._mark_dirty(end - start)
+
+    def _unindex_block_range(self, start, end, code):
+        """ remove a range of blocks from the indexes and counters for its state code
+
+            Args:
+                start - index into the memory mapping of the first block
+                end - index into the memory mapping after the last block
+                code - state code of the blocks
+        """
+        self._state_counts[code] = self._state_counts[code] - (end - start)
+        if self._state_counts[code] == 0:
+            del self._state_counts[code]
+        if code == self.AVAILABLE.encode('ascii'):
+            self._free_runs.remove(start - self.FILE_HEADER.size, end - start)
+        elif code.decode('ascii') in self.PENDING:
+            # only the workers whose id ends in the same hexadecimal digit as the state code can own the blocks
+            removed = 0
+            digit = int(code, 16)
+            for worker in [w for w in self._worker_runs if w % len(self.PENDING) == digit]:
+                removed = removed + self._worker_runs[worker].remove(start - self.FILE_HEADER.size, end - start)
+                if not self._worker_runs[worker]:
+                    del self._worker_runs[worker]
+                if removed == end - start:
+                    break
+
+    def _validate_status(self, status):
+        """ raise an exception if status is not a valid block status or worker id
+
+            Args:
+                status - status to check
+
+            Returns:
+                (the status encoded as a single byte state code, number of the worker or None if not a worker id)
+        """
+        if status in (self.AVAILABLE, self.DOWNLOADED, self.SAVING):
+            return status.encode('ascii'), None
+        worker = self._parse_worker_id(status)
+        return self.PENDING[worker % len(self.PENDING)].encode('ascii'), worker
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def allocate_segments(self, worker_ids, worker_speeds=None):
         """ allocate an available segment in the blockmap to the specified worker_id
 
+            The largest run of available blocks is split in proportion to the download speeds of the workers, so fast
+            workers get long segments and slow workers get short segments which are recycled quickly.  Workers without
+            a known speed are treated as average workers, if no speeds are known the run is split evenly.
+
             Args:
-                worker_id - list of worker ids to allocate the segment to
+                worker_id - list of hexadecimal worker ids to allocate the segment to
+                worker_speeds - optional dictionary of worker id -> recent download speed in bytes/sec, the speeds of
+                                busy workers can be included so that they keep a share of the run for when they are
+                                done
 
             Returns:
                 (starting_block, blocks)
@@ -120,27 +610,35 @@ class Blockmap:
 
         # find the largest available free block
         retval = {}
-        blocksize, blockmap = self._read_blockmap()
-        for segment_size in range(len(blockmap), 0, -1):
-            start_block = blockmap.find('.' * segment_size)
-            if start_block >= 0:
-                # calculate the optimal_segment_size
-                optimal_segment_size = int(math.ceil(float(segment_size) / len(worker_ids)))
+        self._open_blockmap()
+        blocksize = self._blocksize
+        largest = self._free_runs.largest()
+        if largest is not None:
+            start_block, segment_size = largest
+
+            # weight each worker by its speed, workers without a known speed get the average speed
+            worker_speeds = worker_speeds or {}
+            known_speeds = [speed for speed in worker_speeds.values() if speed > 0]
+            average_speed = float(sum(known_speeds)) / len(known_speeds) if known_speeds else 1.0
+            weights = [worker_speeds[k] if worker_speeds.get(k, 0) > 0 else average_speed for k in worker_ids]
+            total_weight = sum(weights) + sum(speed for k, speed in worker_speeds.items()
+                                              if k not in worker_ids and speed > 0)
+
+            # allocate to the worker_ids, the optimal_segment_size of each worker is its share of the run
+            x = start_block
+            total_size = segment_size
+            for k, weight in zip(worker_ids, weights):
+                optimal_segment_size = int(math.ceil(total_size * weight / total_weight))
                 optimal_segment_size = min(optimal_segment_size, self._max_blocks_per_segment)
                 optimal_segment_size = max(optimal_segment_size, self._min_blocks_per_segment)
-
-                # allocate to the worker_ids
-                x = start_block
-                for k in worker_ids:
-                    blocks = min(segment_size, optimal_segment_size)
-                    retval[k] = {'byte_offset': x * blocksize, 'blocks': blocks}
-                    x = x + blocks
-                    segment_size = segment_size - blocks
-                    assert segment_size >= 0
-                    self.change_block_range_status(retval[k]['byte_offset'], retval[k]['blocks'], k)
-                    if segment_size == 0:
-                        break
-                break
+                blocks = min(segment_size, optimal_segment_size)
+                retval[k] = {'byte_offset': x * blocksize, 'blocks': blocks}
+                x = x + blocks
+                segment_size = segment_size - blocks
+                assert segment_size >= 0
+                self.change_block_range_status(retval[k]['byte_offset'], retval[k]['blocks'], k)
+                if segment_size == 0:
+                    break
 
         # return the results
         return retval
@@ -152,14 +650,24 @@ class Blockmap:
                 old_status - status to search for
                 new_status - status to replace with
         """
-        if old_status not in (self.AVAILABLE, self.DOWNLOADED, self.SAVING) and old_status not in self.PENDING:
-            raise BlockmapException('status of "%s" is not a valid status' % old_status)
-        if new_status not in (self.AVAILABLE, self.DOWNLOADED, self.SAVING) and new_status not in self.PENDING:
-            raise BlockmapException('status of "%s" is not a valid status' % new_status)
+        old_code, old_worker = self._validate_status(old_status)
+        new_code, new_worker = self._validate_status(new_status)
+
+        # find the runs of blocks with the old status, available blocks and blocks allocated to a worker are looked
+        # up in the indexes so that blocks with other states are never touched
+        self._open_blockmap()
+        if old_code == self.AVAILABLE.encode('ascii'):
+            runs = self._free_runs.runs()
+        elif old_worker is not None:
+            runs = self._worker_runs[old_worker].runs() if old_worker in self._worker_runs else []
+        else:
+            runs = [(start - self.FILE_HEADER.size, end - start)
+                    for start, end, _code in self._find_runs(old_status, self.FILE_HEADER.size, len(self._mmap))]
 
-        blocksize, blockmap = self._read_blockmap()
-        blockmap = blockmap.replace(old_status, new_status)
-        self._persist_blockmap(blocksize, blockmap)
+        # update each run of blocks with the old status
+        for start_block, blocks in runs:
+            self._set_block_range(self.FILE_HEADER.size + start_block, self.FILE_HEADER.size + start_block + blocks,
+                                  new_code, new_worker)
 
     def change_block_range_status(self, byte_offset, blocks, status):
         """ change the status of a block range
@@ -167,42 +675,101 @@ class Blockmap:
             Args:
                 byte_offset - starting byte offset of the block.  NOTE: This is not a block number but a byte offset!
                 blocks - number of blocks to change status of.  NOTE: This is number of blocks, not bytes!
-                status - new status
+                status - new status, or the id of the worker the blocks are allocated to
         """
-        # read the blockmap
-        blocksize, blockmap = self._read_blockmap()
+        # make sure status is valid and byte_offset is a multiple of block size
+        self._open_blockmap()
+        code, worker = self._validate_status(status)
+        start, end = self._get_block_range(byte_offset, blocks)
+
+        # set the status of the blocks with a single store into the mapping
+        self._set_block_range(start, end, code, worker)
+
+    def checkpoint(self):
+        """ write a new snapshot of the blockmap and truncate the journal if the blockmap has changed since the last
+            checkpoint """
+        if self._mmap is not None and self._dirty_blocks > 0:
+            # the downloaded file must be on the disk before a snapshot which says its blocks have been downloaded
+            if self._durability != self.DURABILITY_NONE:
+                self._fsync_path(self._local_path)
+            self._write_snapshot(self._mmap[:])
+            os.ftruncate(self._journal_fd, 0)
+        self._dirty_blocks = 0
+        self._journal_blocks = 0
+        self._last_checkpoint_time = time.time()
 
-        # make sure byte_offset is a multiple of block size
-        if byte_offset % blocksize != 0:
-            raise BlockmapException('byte_offset %d is not a multiple of block size %d' % (byte_offset, blocksize))
+    def delete_blockmap(self):
+        """ delete the blockmap and its journal """
+        self._close_blockmap()
+        os.remove(self._blockmap_path)
+        if os.path.exists(self._journal_path):
+            os.remove(self._journal_path)
 
-        # make sure status is valid
-        if status not in (self.AVAILABLE, self.DOWNLOADED, self.SAVING) and status not in self.PENDING:
-            raise BlockmapException('status of "%s" is not a valid status' % status)
+    def get_block_status(self, byte_offset):
+        """ return the status of a single block
 
-        # set the status of the block
-        starting_block = byte_offset // blocksize
-        for i in range(0, blocks):
-            blockmap = blockmap[:starting_block + i] + status + blockmap[starting_block + i + 1:]
-        self._persist_blockmap(blocksize, blockmap)
+            Args:
+                byte_offset - byte offset of the block.  NOTE: This is not a block number but a byte offset!
 
-    def delete_blockmap(self):
-        """ delete the blockmap """
-        os.remove(self._blockmap_path)
+            Returns:
+                the status of the block, or the lowercase id of the worker the block is allocated to
+        """
+        self._open_blockmap()
+        start, _ = self._get_block_range(byte_offset, 1)
+        status = self._mmap[start:start + 1].decode('ascii')
+        if status in self.PENDING:
+            # only the workers whose id ends in the same hexadecimal digit as the state code can own the block
+            for worker in [w for w in self._worker_runs if w % len(self.PENDING) == int(status, 16)]:
+                if self._worker_runs[worker].find(start - self.FILE_HEADER.size) is not None:
+                    return format(worker, 'x')
+        return status
+
+    def get_state_counts(self):
+        """ return the number of blocks in each state, pending blocks are counted separately for each worker
+
+            Returns:
+                dictionary of status or lowercase worker id -> number of blocks, states without any blocks are not
+                included
+        """
+        self._open_blockmap()
+        retval = {}
+        for status in (self.AVAILABLE, self.DOWNLOADED, self.SAVING):
+            if status.encode('ascii') in self._state_counts:
+                retval[status] = self._state_counts[status.encode('ascii')]
+        for worker in self._worker_runs:
+            retval[format(worker, 'x')] = self._worker_runs[worker].blocks
+        return retval
+
+    def get_worker_segments(self, worker_id):
+        """ return the runs of blocks which are allocated to a worker
+
+            Args:
+                worker_id - hexadecimal id of the worker
+
+            Returns:
+                list of {'byte_offset': starting byte offset, 'blocks': number of blocks} sorted by byte offset
+        """
+        worker = self._parse_worker_id(worker_id)
+        self._open_blockmap()
+        if worker not in self._worker_runs:
+            return []
+        return [{'byte_offset': start * self._blocksize, 'blocks': blocks}
+                for start, blocks in self._worker_runs[worker].runs()]
 
     def get_statistics(self, dl_speed=0):
         """ return statistics about the blockmap
 
             returns a tuple of (non_downloaded_blocks, available blocks, number of blocks, blocklsize, eta)
         """
-        # read the blockmap
-        blocksize, blockmap = self._read_blockmap()
+        # read the counters of the blockmap
+        self._open_blockmap()
+        blocksize = self._blocksize
 
         # calculate non saved blocks
-        non_downloaded_blocks = len(blockmap) - blockmap.count('*')
+        non_downloaded_blocks = self._blocks - self._state_counts.get(self.DOWNLOADED.encode('ascii'), 0)
 
         # calcualte available blocks
-        available_blocks = blockmap.count('.')
+        available_blocks = self._state_counts.get(self.AVAILABLE.encode('ascii'), 0)
 
         # calculate ETA
         if dl_speed == 0:
@@ -217,7 +784,7 @@ class Blockmap:
             else:
                 eta = '%0.1f minutes' % (eta / 60)
 
-        return (non_downloaded_blocks, available_blocks, len(blockmap), blocksize, eta)
+        return (non_downloaded_blocks, available_blocks, self._blocks, blocksize, eta)
 
     def init_blockmap(self):
         """ initialize the blockmap if it does not exist, or clean it if it does exist """
@@ -225,21 +792,23 @@ class Blockmap:
         if not os.path.exists(self._blockmap_path):
             # create a new blockmap and save it
             filesize = self._file_size_func(self._remote_path)
-            blockmap = self.AVAILABLE * int(math.ceil(filesize / float(self._initial_blocksize)))
-            blocksize = self._initial_blocksize
+            self._persist_blockmap(self._initial_blocksize,
+                                   self.AVAILABLE * int(math.ceil(filesize / float(self._initial_blocksize))))
         else:
-            # clean the blockmap
-            blocksize, blockmap = self._read_blockmap()
-            chars = list(set(blockmap))
-            for c in chars:
-                if c != '*':
-                    blockmap = blockmap.replace(c, self.AVAILABLE)
-        self._persist_blockmap(blocksize, blockmap)
+            # clean the blockmap after replaying the journal, every block which has not been saved to disk becomes
+            # available again
+            self._open_blockmap()
+            region = self._mmap[self.FILE_HEADER.size:]
+            self._mmap[self.FILE_HEADER.size:] = re.sub(b'[^' + re.escape(self.DOWNLOADED.encode('ascii')) + b']',
+                                                        self.AVAILABLE.encode('ascii'), region)
+            self._rebuild_indexes()
+            self._dirty_blocks = self._blocks
+            self.checkpoint()
 
     def is_blockmap_complete(self):
         """ returns true if the blockmap shows that the entire file has been downloaded """
-        _blocksize, blockmap = self._read_blockmap()
-        return set(blockmap) == set('*')
+        self._open_blockmap()
+        return self._state_counts.get(self.DOWNLOADED.encode('ascii'), 0) == self._blocks
 
     def is_blockmap_already_exists(self):
         """ return true if a blockmap exists on the local disk """
@@ -0,0 +1,155 @@
+""" message records and single producer, single consumer channels between the download threads and the manager """
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+from collections import deque
+from threading import Event
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+# Message must be a new style class for __slots__ to work on python 2, and it is a plain record with no public methods
+class Message(object):     # pylint: disable=R0205,R0903
+    """ compact message record passed through a channel
+
+        The meaning of the fields depends on the kind of message
+
+            DATA_RECEIVED - byte_offset of the block, data is the buffer holding the block, length is the number of
+                            bytes in the buffer
+            DATA_SAVED - byte_offset of the first block written, value is the number of blocks written
+            DL_SPEED_UPDATE - value is the download speed in bytes/sec
+            ERROR - value is the error message
+            FILE_DEFERRED, FILE_DONE - value is (remote_path, local_path, size) of a small file which is too large to
+                                       be fetched whole, or which has been fetched
+            NEXT_SEGMENT - byte_offset of the next segment of the download thread, value is the number of blocks
+            SEGMENT_STARTED - byte_offset of the segment the download thread has moved on to
+            THROTTLED - value is the number of seconds the download thread waits for the max rate before it reads
+                        from the server again
+            TRUNCATE - byte_offset is the new end of the segment of the download thread
+            ABORTED, THREAD_FINISHED, KILL - no fields
+    """
+    # --------------------------------------------------
+    # Constants
+    # --------------------------------------------------
+    # download thread -> manager
+    ABORTED = 'aborted'
+    DATA_RECEIVED = 'data_received'
+    DL_SPEED_UPDATE = 'dl_speed_update'
+    ERROR = 'error'
+    FILE_DEFERRED = 'file_deferred'
+    FILE_DONE = 'file_done'
+    SEGMENT_STARTED = 'segment_started'
+    THREAD_FINISHED = 'thread_finished'
+    THROTTLED = 'throttled'
+
+    # file writer -> manager
+    DATA_SAVED = 'data_saved'
+
+    # manager -> download thread
+    KILL = 'kill'
+    NEXT_SEGMENT = 'next_segment'
+    TRUNCATE = 'truncate'
+
+    __slots__ = ('kind', 'worker_id', 'byte_offset', 'data', 'length', 'value')
+
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, kind, worker_id=None, byte_offset=None, data=None, length=None, value=None):
+        """ Initialize the class
+
+            Args:
+                kind - kind of message, one of the constants of this class
+                worker_id - id of the download thread which sent the message, or None
+                byte_offset - byte offset into the file
+                data - buffer holding a block
+                length - number of bytes in data
+                value - speed, error message, or number of blocks
+        """
+        self.kind = kind
+        self.worker_id = worker_id
+        self.byte_offset = byte_offset
+        self.data = data
+        self.length = length
+        self.value = value
+
+    def __repr__(self):
+        return 'Message(%s, worker_id=%s, byte_offset=%s, length=%s, value=%s)' % (self.kind, self.worker_id,
+                                                                                   self.byte_offset, self.length,
+                                                                                   self.value)
+
+
+class Doorbell:
+    """ wakes up the consumer of one or more channels when a message is put into any of them """
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self):
+        """ Initialize the class """
+        self._event = Event()
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def ring(self):
+        """ wake up the consumer """
+        self._event.set()
+
+    def wait(self, timeout):
+        """ wait until the doorbell rings or the timeout expires.  The doorbell is reset before returning, so the
+            channels must be read after wait returns and not before
+
+            Args:
+                timeout - maximum number of seconds to wait
+
+            Returns:
+                True if the doorbell rang
+        """
+        rang = self._event.wait(timeout)
+        self._event.clear()
+        return rang
+
+
+class Channel:
+    """ single producer, single consumer channel of messages
+
+        Only one thread puts messages into the channel and only one thread gets them, so the appends and pops of the
+        underlying deque, which are atomic, are all the synchronization needed.  Putting a message rings the doorbell
+        of the channel, if it has one.
+    """
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, doorbell=None):
+        """ Initialize the class
+
+            Args:
+                doorbell - Doorbell to ring when a message is put into the channel, or None
+        """
+        self._messages = deque()
+        self._doorbell = doorbell
+
+    def __len__(self):
+        """ number of messages waiting in the channel """
+        return len(self._messages)
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def get_nowait(self):
+        """ return the next message in the channel, or None if the channel is empty """
+        try:
+            return self._messages.popleft()
+        except IndexError as _:
+            return None
+
+    def put(self, message):
+        """ put a message into the channel
+
+            Args:
+                message - Message to put
+        """
+        self._messages.append(message)
+        if self._doorbell is not None:
+            self._doorbell.ring()
@@ -0,0 +1,135 @@
+""" class to tune the number of concurrent download connections """
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import time
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+class ConcurrencyController:
+    """ hill-climbing controller for the number of concurrent download connections
+
+        The controller measures the average total download speed over an interval, each measurement is weighted by the
+        time since the previous measurement so that a burst of measurements does not outweigh the rest of the interval.
+        While adding a connection keeps improving the speed by at least min_improvement, another connection is added
+        after each interval.  Once the speed plateaus the last connection is removed again, and after probe_intervals
+        intervals at the plateau another connection is tried in case the network has changed.  When the server returns
+        errors, for example because it has too many connections, the number of connections is halved.
+    """
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, initial_connections, max_connections, min_connections=1, interval=5.0, min_improvement=0.05,
+                 probe_intervals=6):
+        """ Initialize the class
+
+            Args:
+                initial_connections - number of connections to start with
+                max_connections - the number of connections is never increased above this ceiling
+                min_connections - the number of connections is never decreased below this floor
+                interval - number of seconds to measure the download speed for before changing the number of
+                           connections
+                min_improvement - fraction the download speed must improve by for an added connection to be kept
+                probe_intervals - number of intervals to stay at a plateau before trying another connection
+        """
+        # init
+        self._min_connections = max(1, min_connections)
+        self._max_connections = max(self._min_connections, max_connections)
+        self._connections = min(max(initial_connections, self._min_connections), self._max_connections)
+        self._interval = interval
+        self._min_improvement = min_improvement
+        self._probe_intervals = probe_intervals
+
+        self._baseline_speed = None     # average speed of the interval before the last change
+        self._increased = False         # True if a connection was added at the end of the last interval
+        self._plateau_intervals = 0     # number of intervals spent at the plateau
+        self._errors = 0                # number of errors since the end of the last interval
+        self._speed_sum = 0.0          # sum of the speeds of the interval times the seconds they were measured over
+        self._speed_seconds = 0.0
+        self._interval_start = None
+        self._last_update = None
+
+    # --------------------------------------------------
+    # Private Functions
+    # --------------------------------------------------
+    def _evaluate(self, speed):
+        """ decide on the number of connections at the end of an interval
+
+            Args:
+                speed - average download speed in bytes/sec over the interval
+        """
+        if self._errors > 0:
+            # multiplicative decrease when the server is refusing connections
+            self._connections = max(self._min_connections, self._connections // 2)
+            self._increased = False
+            self._plateau_intervals = 0
+            self._baseline_speed = None
+        elif self._baseline_speed is None or speed > self._baseline_speed * (1.0 + self._min_improvement):
+            # the speed is still improving, so try another connection
+            self._baseline_speed = speed
+            self._plateau_intervals = 0
+            self._increased = self._connections < self._max_connections
+            self._connections = min(self._connections + 1, self._max_connections)
+        elif self._increased:
+            # the last connection did not help, remove it and stay at the plateau
+            self._connections = max(self._min_connections, self._connections - 1)
+            self._increased = False
+            self._plateau_intervals = 0
+        else:
+            # at the plateau, probe with another connection once in a while
+            self._plateau_intervals = self._plateau_intervals + 1
+            if self._plateau_intervals >= self._probe_intervals and self._connections < self._max_connections:
+                self._baseline_speed = speed
+                self._connections = self._connections + 1
+                self._increased = True
+                self._plateau_intervals = 0
+        self._errors = 0
+
+    # --------------------------------------------------
+    # Properties
+    # --------------------------------------------------
+    @property
+    def connections(self):
+        """ return the number of concurrent connections to use """
+        return self._connections
+
+    @property
+    def max_connections(self):
+        """ return the ceiling on the number of concurrent connections """
+        return self._max_connections
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def on_error(self):
+        """ notify the controller that the server returned an error to one of the connections """
+        self._errors = self._errors + 1
+
+    def update(self, dl_speed, now=None):
+        """ add a measurement of the total download speed, the measurement stands for the time since the previous
+            measurement.  The number of connections is changed once at the end of each interval
+
+            Args:
+                dl_speed - total download speed of all of the connections in bytes/sec
+                now - current time in seconds, defaults to time.time()
+
+            Returns:
+                the number of concurrent connections to use
+        """
+        now = time.time() if now is None else now
+        if self._interval_start is None:
+            self._interval_start = now
+            self._last_update = now
+        self._speed_sum = self._speed_sum + dl_speed * (now - self._last_update)
+        self._speed_seconds = self._speed_seconds + (now - self._last_update)
+        self._last_update = now
+
+        # change the number of connections at the end of the interval
+        if now - self._interval_start >= self._interval:
+            self._evaluate(self._speed_sum / self._speed_seconds if self._speed_seconds > 0 else dl_speed)
+            self._speed_sum = 0.0
+            self._speed_seconds = 0.0
+            self._interval_start = now
+        return self._connections
@@ -0,0 +1,181 @@
+""" class to write downloaded blocks to disk on a dedicated thread """
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import os
+import sys
+from threading import Thread
+
+if sys.version_info >= (3, 0):
+    from queue import Queue, Empty
+else:
+    from Queue import Queue             # pylint: disable=E0401
+    from Queue import Empty             # pylint: disable=E0401
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+class FileWriter:
+    """ writes runs of blocks to the local file on a dedicated thread so that disk I/O never stalls the download
+        manager
+
+        The file is opened once and written with positional writes, os.pwritev where available so that adjacent runs
+        of blocks are written with a single system call without joining their buffers, os.pwrite or seek and write
+        otherwise.  Once a run has been written its buffers are returned to the buffer pool and on_saved is called
+        from the writer thread.
+    """
+    # --------------------------------------------------
+    # Constants
+    # --------------------------------------------------
+    MAX_IOV = 1024          # maximum number of buffers passed to a single os.pwritev call
+
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, local_path, buffer_pool, on_saved, fsync=False):
+        """ Initialize the class and start the writer thread
+
+            Args:
+                local_path - path of the local file to write to, the file must exist
+                buffer_pool - BlockBufferPool the buffers are returned to once they have been written
+                on_saved - function of type f(byte_offset, blocks) called from the writer thread once a run of blocks
+                           has been written
+                fsync - fsync the file after each batch of writes, before on_saved is called
+        """
+        self._fd = os.open(local_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        self._buffer_pool = buffer_pool
+        self._on_saved = on_saved
+        self._fsync = fsync
+        self._queue = Queue()
+        self._error = None
+        self._thread = Thread(target=self._tw_write)
+        self._thread.daemon = True
+        self._thread.start()
+
+    # --------------------------------------------------
+    # Private Functions
+    # --------------------------------------------------
+    def _pwritev(self, byte_offset, views):
+        """ write a list of buffers to the file starting at byte_offset, handling short writes
+
+            Args:
+                byte_offset - byte offset into the file to write the first buffer at
+                views - list of memoryviews to write
+        """
+        while views:
+            if hasattr(os, 'pwritev'):
+                written = os.pwritev(self._fd, views[:self.MAX_IOV], byte_offset)
+            elif hasattr(os, 'pwrite'):
+                written = os.pwrite(self._fd, views[0], byte_offset)
+            else:
+                # only the writer thread uses the file descriptor, so seek and write is safe
+                os.lseek(self._fd, byte_offset, os.SEEK_SET)
+                written = os.write(self._fd, views[0])
+            byte_offset = byte_offset + written
+
+            # drop the bytes which have been written
+            while written > 0:
+                if written >= len(views[0]):
+                    written = written - len(views[0])
+                    views.pop(0)
+                else:
+                    views[0] = views[0][written:]
+                    written = 0
+
+    def _tw_write(self):
+        """ thread worker which writes the queued runs of blocks, runs which are adjacent in the file are coalesced
+            into a single write """
+        while True:
+            # wait for a run, then take every other run which is already queued
+            runs = [self._queue.get()]
+            while True:
+                try:
+                    runs.append(self._queue.get_nowait())
+                except Empty as _:
+                    break
+            stop = None in runs
+            runs = sorted([run for run in runs if run is not None], key=lambda run: run[0])
+
+            try:
+                if self._error is None:
+                    self._write_runs(runs)
+            except (IOError, OSError) as e:
+                self._error = e
+
+            # return the buffers to the pool
+            for _, buffers in runs:
+                for buf, _ in buffers:
+                    self._buffer_pool.release(buf)
+            if stop:
+                return
+
+    def _write_runs(self, runs):
+        """ coalesce the adjacent runs and write each coalesced run with one positional write, then report each run as
+            saved
+
+            Args:
+                runs - list of (byte_offset, buffers) of the runs sorted by byte_offset
+        """
+        i = 0
+        while i < len(runs):
+            byte_offset = runs[i][0]
+            views = []
+            next_byte_offset = byte_offset
+            while i < len(runs) and runs[i][0] == next_byte_offset:
+                for buf, length in runs[i][1]:
+                    views.append(memoryview(buf)[:length])
+                    next_byte_offset = next_byte_offset + length
+                i = i + 1
+            self._pwritev(byte_offset, views)
+        if self._fsync and runs:
+            os.fsync(self._fd)
+
+        # report each run as saved
+        for byte_offset, buffers in runs:
+            self._on_saved(byte_offset, len(buffers))
+
+    # --------------------------------------------------
+    # Properties
+    # --------------------------------------------------
+    @property
+    def error(self):
+        """ return the IOError or OSError raised by a write which failed, or None if every write has succeeded """
+        return self._error
+
+    @property
+    def pending(self):
+        """ return the number of runs waiting to be written """
+        return self._queue.qsize()
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def close(self):
+        """ write every queued run, stop the writer thread and close the file
+
+            Raises:
+                the IOError or OSError raised by a write which failed
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if self._error is not None:
+            raise self._error
+
+    def write(self, byte_offset, buffers):
+        """ queue a run of blocks to be written, the buffers belong to the writer until they have been written
+
+            Args:
+                byte_offset - byte offset into the file of the first block
+                buffers - list of (buffer, number of bytes in the buffer) of each block in the run
+
+            Raises:
+                the IOError or OSError raised by an earlier write which failed
+        """
+        if self._error is not None:
+            raise self._error
+        self._queue.put((byte_offset, buffers))
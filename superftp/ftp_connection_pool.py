@@ -0,0 +1,211 @@
+""" pool of logged in ftp control connections which are reused across segments """
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+from ftplib import all_errors
+from threading import Lock, Thread
+import time
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+class FtpConnectionPool:
+    """ pool of logged in ftp control connections to one server with one set of credentials
+
+        Opening a control connection costs a TCP connect, an optional TLS handshake and the login, which is several
+        round trips to the server.  A download thread which has finished its segment returns its connection to the
+        pool and the next segment reuses it, so starting a segment only costs the PASV, REST and RETR commands.
+
+        The pool can also be asked to keep standby connections, which are opened in the background so that a new
+        download thread does not have to wait for the login either.
+
+        Every connection in the pool is in binary mode and in the directory it logged in to.  A connection whose
+        transfer was stopped before the end of the file is brought back to a known state with ABOR followed by NOOP
+        before it is reused, and a connection which can not be brought back to a known state is closed instead.  A
+        connection which has waited in the pool for a while is checked with NOOP before it is handed out, so that a
+        connection the server or the network has dropped is replaced instead of failing the next transfer, which
+        would be taken for an error of the server.
+    """
+    # --------------------------------------------------
+    # Constants
+    # --------------------------------------------------
+    IDLE_TIMEOUT = 30.0     # seconds a connection may wait in the pool before it is closed instead of reused
+    DRAIN_TIMEOUT = 5.0     # seconds to wait for the server to reply while a connection is returned to the pool
+    MAX_DRAIN_REPLIES = 8   # replies read while looking for the reply to NOOP before the connection is given up on
+    VALIDATE_IDLE = 1.0     # seconds a connection may wait in the pool before it is checked with NOOP when reused
+
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, connect, idle_timeout=IDLE_TIMEOUT, validate_idle=VALIDATE_IDLE):
+        """ Initialize the class, connections are only opened when they are needed
+
+            Args:
+                connect - function of type f() which returns a new logged in ftp connection
+                idle_timeout - seconds a connection may wait in the pool before it is closed instead of reused, servers
+                               close control connections which have been idle for too long
+                validate_idle - seconds a connection may wait in the pool before it is checked with NOOP when it is
+                                reused, a connection which has just finished a transfer is known to work
+        """
+        self._connect = connect
+        self._idle_timeout = idle_timeout
+        self._validate_idle = validate_idle
+        self._idle_connections = []         # list of (time the connection was returned, connection)
+        self._closed = False
+        self._opening = 0                   # number of standby connections being opened in the background
+        self._lock = Lock()
+
+    # --------------------------------------------------
+    # Private Functions
+    # --------------------------------------------------
+    def _drain(self, ftp):
+        """ abort the transfer in progress on a connection and read replies until the reply to NOOP, so that the next
+            command sent on the connection gets its own reply.  The data connection must already be closed
+
+            Args:
+                ftp - ftp connection whose transfer was stopped before the end of the file
+
+            Raises:
+                an ftplib error if the server does not reply to NOOP
+        """
+        # the server replies to ABOR with 426 and 226 if the transfer was still running, or with 225 or 226 if it
+        # had already finished, so the replies are skipped until the reply to NOOP
+        ftp.putcmd('ABOR')
+        ftp.putcmd('NOOP')
+        for _ in range(0, self.MAX_DRAIN_REPLIES):
+            if ftp.getmultiline().startswith('200'):
+                return
+        raise EOFError('no reply to NOOP while draining the connection')
+
+    def _open(self):
+        """ return a new logged in connection in binary mode """
+        ftp = self._connect()
+        try:
+            ftp.voidcmd('TYPE I')
+        except all_errors as e:
+            self.discard(ftp)
+            raise e
+        return ftp
+
+    def _validate(self, ftp):
+        """ return True if a connection which has waited in the pool still replies to NOOP, otherwise the connection
+            is closed
+
+            Args:
+                ftp - ftp connection from the pool
+        """
+        try:
+            timeout = ftp.sock.gettimeout()
+            ftp.sock.settimeout(self.DRAIN_TIMEOUT)
+            ftp.voidcmd('NOOP')
+            ftp.sock.settimeout(timeout)
+        except all_errors as _:
+            self.discard(ftp)
+            return False
+        return True
+
+    def _tw_open(self):
+        """ thread worker which opens a standby connection and puts it into the pool, errors are ignored since the
+            connection will be opened again when it is needed """
+        try:
+            ftp = self._open()
+        except all_errors as _:
+            ftp = None
+        with self._lock:
+            self._opening = self._opening - 1
+        if ftp is not None:
+            self.release(ftp)
+
+    # --------------------------------------------------
+    # Properties
+    # --------------------------------------------------
+    @property
+    def idle(self):
+        """ return the number of connections waiting in the pool to be reused """
+        return len(self._idle_connections)
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def acquire(self):
+        """ return a connection from the pool, a new connection is opened if the pool is empty
+
+            Returns:
+                a logged in ftp connection in binary mode
+        """
+        while True:
+            with self._lock:
+                stale = [ftp for t, ftp in self._idle_connections if time.time() - t > self._idle_timeout]
+                self._idle_connections = [(t, ftp) for t, ftp in self._idle_connections if ftp not in stale]
+                t, ftp = self._idle_connections.pop() if self._idle_connections else (None, None)
+            for s in stale:
+                self.discard(s)
+            if ftp is None:
+                break
+
+            # a connection which has waited for a while may have been dropped, it is replaced if it does not reply
+            if time.time() - t <= self._validate_idle or self._validate(ftp):
+                return ftp
+
+        # open a new connection
+        return self._open()
+
+    def close(self):
+        """ close every connection in the pool, connections which are returned afterwards are closed as well """
+        with self._lock:
+            self._closed = True
+            idle_connections = self._idle_connections
+            self._idle_connections = []
+        for _, ftp in idle_connections:
+            self.discard(ftp)
+
+    @classmethod
+    def discard(cls, ftp):
+        """ close a connection which is not returned to the pool, for example after an error
+
+            Args:
+                ftp - ftp connection to close
+        """
+        try:
+            ftp.close()
+        except all_errors as _:
+            pass
+
+    def prewarm(self, count):
+        """ open connections in the background until at least count connections are waiting in the pool
+
+            Args:
+                count - number of standby connections to keep in the pool
+        """
+        with self._lock:
+            needed = 0 if self._closed else count - len(self._idle_connections) - self._opening
+            self._opening = self._opening + max(0, needed)
+        for _ in range(0, needed):
+            t = Thread(target=self._tw_open)
+            t.daemon = True
+            t.start()
+
+    def release(self, ftp, abort=False):
+        """ return a connection to the pool so that it can be reused
+
+            Args:
+                ftp - ftp connection which was returned by acquire, its data connection must be closed
+                abort - True if the transfer on the connection was stopped before the end of the file, False if the
+                        transfer reached the end of the file or no transfer was started
+        """
+        if abort:
+            try:
+                timeout = ftp.sock.gettimeout()
+                ftp.sock.settimeout(self.DRAIN_TIMEOUT)
+                self._drain(ftp)
+                ftp.sock.settimeout(timeout)
+            except all_errors as _:
+                self.discard(ftp)
+                return
+
+        with self._lock:
+            if not self._closed:
+                self._idle_connections.append((time.time(), ftp))
+                return
+        self.discard(ftp)
@@ -0,0 +1,565 @@
+""" connections, state and thread workers of the download threads which move the data of the files """
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+from collections import OrderedDict
+from contextlib import closing
+import errno
+import os
+import select
+import socket
+import ssl
+import sys
+import time
+from ftplib import FTP, FTP_TLS, all_errors
+from threading import Thread
+# disable pylint for relative-import below, no way to make it work with sphinx and nosetests and comply with pylint
+
+if sys.version_info >= (3, 0):
+    from .blockmap import Blockmap
+    from .channels import Channel
+    from .ftp_connection_pool import FtpConnectionPool
+    from .rate_limiter import TokenBucket
+    from .segment_state import SegmentState, SmallFilesState
+else:
+    from blockmap import Blockmap                               # pylint: disable=E0401
+    from channels import Channel                                # pylint: disable=E0401
+    from ftp_connection_pool import FtpConnectionPool           # pylint: disable=E0401
+    from rate_limiter import TokenBucket                        # pylint: disable=E0401
+    from segment_state import SegmentState, SmallFilesState     # pylint: disable=E0401
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+# somewhere on stackoverflow is this code which fixes TLS
+class PatchedFTPTLS(FTP_TLS):
+    """Explicit FTPS, with shared TLS session"""
+    def ntransfercmd(self, cmd, rest=None):
+        conn, size = FTP.ntransfercmd(self, cmd, rest)
+        if self._prot_p:
+            session = self.sock.session
+            if isinstance(self.sock, ssl.SSLSocket):
+                session = self.sock.session
+            conn = self.context.wrap_socket(conn, server_hostname=self.host, session=session)  # this is the fix
+        return conn, size
+
+
+class FtpDownloadThreads:
+    """ the pool of logged in connections to the ftp server, the state of the download threads and their thread
+        workers, which move the data of the segments and of the small files and report to the manager over their
+        channels
+
+        FtpFileDownloader adds the manager which schedules the download threads, the worker processes of the process
+        engine run the download threads of an FtpDownloadThreads of their own.
+    """
+    # --------------------------------------------------
+    # Constants
+    # --------------------------------------------------
+    IDLE = 0                # download thread state - IDLE, waiting for allocation if available
+    ACTIVE = 1              # download thread state - ACTIVE, actively retrieving data from the remote FTP server
+    ABORTING = 2            # download thread state - ABORTING, thread is in the process of being aborted and killed
+
+    SPEED_FIFO_SIZE = 4     # depth of the FIFO to track download speeds
+
+    BUFFER_WAIT = 0.1       # seconds a download thread waits for the buffer budget before checking for messages
+
+    DATA_TIMEOUT = 30.0     # seconds to wait for data on a data connection before the transfer is given up on
+
+    KILL_POLL = 0.25        # seconds a download thread waits for data before checking for messages
+
+    SMALL_FILE_CHUNK = 65536    # size in bytes of the buffer small files are received into
+
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, server_url, username, password, port=21, concurrent_connections=4, enable_tls=False,
+                 durability=Blockmap.DURABILITY_CHECKPOINT, small_file_size=1048576, zero_copy=False, max_rate=0):
+        """ Initialize the class
+
+            Args:
+                server_url - url to the ftp server
+                username - username to login to ftp server with
+                password - password to login to ftp server with
+                port - port number to use for the ftp connection to the server
+                concurrent_connections - number of download threads
+                enable_tls - enable TLS encryption when connecting and downloading from the FTP server
+                durability - one of the Blockmap.DURABILITY_* levels, the blocks moved with zero copy are fsync'd
+                             unless it is Blockmap.DURABILITY_NONE
+                small_file_size - a small file larger than this many bytes is handed back to the manager
+                zero_copy - on Linux, move the data of plaintext transfers from the data connections straight into the
+                            local files with os.splice, see FtpFileDownloader
+                max_rate - maximum total download speed in MB/sec of the download threads, 0 for no maximum
+        """
+        self._server_url = server_url
+        self._username = username
+        self._password = password
+        self._port = port
+        self._enable_tls = enable_tls
+        self._durability = durability
+        self._small_file_size = small_file_size
+        self._zero_copy = zero_copy
+        self._connection_pool = FtpConnectionPool(self._ftp_connection)
+        self._rate_limiter = TokenBucket(max_rate * 1024 * 1024)
+
+        # setup the initial dead threads for each download connections
+        self._concurrent_connections = concurrent_connections
+        self._download_threads = OrderedDict([(format(k, 'x'), self._idle_thread())
+                                              for k in range(0, concurrent_connections)])
+
+    # --------------------------------------------------
+    # Private Functions
+    # --------------------------------------------------
+    def _ftp_connection(self):
+        """ throws an exception similar to ftplib.error_perm: 500 Unknown command: "AUTH TLS" if ftp server does not
+        support tls """
+        if self._enable_tls:
+            if sys.version_info >= (3, 0):
+                ftp = PatchedFTPTLS()
+            else:
+                # TLS does not work so good on python 2.7
+                ftp = FTP_TLS()
+        else:
+            ftp = FTP()
+
+        ftp.connect(self._server_url, self._port)
+
+        ftp.login(self._username, self._password)
+
+        if self._enable_tls:
+            ftp.prot_p()
+        return ftp
+
+    def _ftp_get_filesize(self, remote_path):
+        """ return the file size of an ftp file on the ftp server
+
+            Args:
+                remote_path - path to the file on the ftp server
+
+            Returns:
+                number of bytes in the file
+        """
+        # connections from the pool are already in binary mode
+        ftp = self._connection_pool.acquire()
+        try:
+            size = ftp.size(remote_path)    # Get size of file
+        except all_errors as e:
+            self._connection_pool.discard(ftp)
+            raise e
+        self._connection_pool.release(ftp)
+        return size
+
+    def _idle_thread(self, thread=None):
+        """ return a dead thread in the IDLE state to hold the place of a download thread which is not running
+
+            Args:
+                thread - thread to set up in the IDLE state, or None for a new dead thread
+        """
+        thread = thread or Thread()     # pylint: disable=W1506
+        thread.private_thread_state = self.IDLE
+        thread.private_dl_speed_fifo = [0] * self.SPEED_FIFO_SIZE
+        thread.private_recent_dl_speed = 0
+        thread.private_segment_offset = None
+        thread.private_next_segment_offset = None
+        thread.private_duplicate_of = None
+        thread.private_job = None
+        thread.private_small_files = []
+        thread.private_channel_in = Channel()
+        thread.private_channel_out = Channel()
+        return thread
+
+    def _receive_segment(self, remote_path, conn, state, channel_in, buffer_pool, blocksize, splice=None):
+        """ receive the blocks of a segment until the end of the segment, the end of the file, or a kill from the
+            manager
+
+            Args:
+                remote_path - path to the file to download on the ftp server
+                conn - data connection of the segment
+                state - SegmentState of the download thread
+                channel_in - Channel of control messages from the manager to this thread
+                buffer_pool - BlockBufferPool to receive the blocks into
+                blocksize - size of each block in bytes
+                splice - (fd, pipe) of the local file and of the pipe the data is moved through with zero copy, None
+                         to receive the data into block buffers
+
+            Returns:
+                True at the end of the file
+        """
+        eof = False
+        buf = None
+        view = None
+        try:
+            while not eof and state.byte_offset < state.end_byte_offset:
+                # check for control messages from the manager
+                next_range = state.poll_control_messages(channel_in)
+                if next_range is not None:
+                    state.next_segment = self._start_next_segment(remote_path, *next_range)
+                if state.killed:
+                    break
+
+                # wait for tokens while the download is over the max rate, the socket is not read while waiting so
+                # the server is slowed down by TCP flow control
+                delay = state.throttle_delay(self.BUFFER_WAIT)
+                if delay > 0:
+                    time.sleep(delay)
+                    state.on_wait()
+                    continue
+
+                # wait for a buffer if the buffer budget is exhausted, the socket is not read while waiting so the
+                # server is slowed down by TCP flow control, and the wait does not count towards the download speed
+                if splice is None and buf is None:
+                    buf = buffer_pool.acquire(self.BUFFER_WAIT)
+                    if buf is None:
+                        state.on_wait(reset_speed=True)
+                        continue
+                    view = memoryview(buf)
+
+                # receive the data into the rest of the block
+                received = self._recv_block(conn, view, state, blocksize, splice)
+                if received is None:
+                    continue
+
+                # send the buffer once the block is full, or at the end of the file where the last block is short, a
+                # block moved with zero copy is already in the local file
+                eof = received == 0
+                if state.on_received(received):
+                    if splice is not None and self._durability != Blockmap.DURABILITY_NONE:
+                        os.fsync(splice[0])
+                    state.send_block(buf)
+                    buf = None
+            return eof
+        finally:
+            if buf is not None:
+                buffer_pool.release(buf)
+
+    def _recv_block(self, conn, view, state, blocksize, splice):
+        """ receive data into the rest of the block being received.  The data connection times out after KILL_POLL
+            seconds so that a kill from the manager is noticed while the server is not sending anything, the transfer
+            is only given up on after DATA_TIMEOUT
+
+            Args:
+                conn - data connection of the segment
+                view - memoryview of the block buffer, not used with zero copy
+                state - SegmentState of the download thread
+                blocksize - size of each block in bytes
+                splice - (fd, pipe) of the local file and of the pipe the data is moved through with zero copy, or None
+
+            Returns:
+                number of bytes received, 0 at the end of the file, or None if no data arrived within KILL_POLL seconds
+        """
+        try:
+            if splice is not None:
+                # move the data into the rest of the block in the local file
+                return self._splice(conn, splice[1], splice[0], state.byte_offset + state.filled,
+                                    blocksize - state.filled)
+            # receive the data into the rest of the block buffer
+            return conn.recv_into(view[state.filled:], blocksize - state.filled)
+        except socket.timeout as e:
+            if state.stalled(self.DATA_TIMEOUT):
+                raise e
+            return None
+
+    def _recv_small_file(self, conn, view, state):
+        """ receive the data of a small file into a buffer, after waiting while the download is over the max rate
+
+            Args:
+                conn - data connection
+                view - memoryview of the buffer to receive into
+                state - SmallFilesState of the download thread
+
+            Returns:
+                number of bytes received, 0 at the end of the file
+        """
+        delay = state.throttle_delay(self.BUFFER_WAIT)
+        while delay > 0:
+            time.sleep(delay)
+            delay = state.throttle_delay(self.BUFFER_WAIT)
+        received = conn.recv_into(view)
+        state.on_received(received)
+        return received
+
+    def _remaining_time(self, blockmap, worker_id, worker_ids):
+        """ estimate the number of seconds a download thread needs to download the blocks it has left
+
+            Args:
+                blockmap - blockmap of the download
+                worker_id - id of the download thread
+                worker_ids - ids of the download threads being compared, threads which have not measured a speed yet
+                             are assumed to be as fast as the average of these threads
+
+            Returns:
+                estimated number of seconds
+        """
+        blocks = sum(segment['blocks'] for segment in blockmap.get_worker_segments(worker_id))
+        return float(blocks) / self._worker_speed(worker_id, worker_ids)
+
+    def _set_concurrent_connections(self, concurrent_connections):
+        """ change the number of concurrent download connections, idle download threads are added if needed
+
+            Args:
+                concurrent_connections - new number of concurrent download connections
+        """
+        while len(self._download_threads) < concurrent_connections:
+            self._download_threads[format(len(self._download_threads), 'x')] = self._idle_thread()
+        self._concurrent_connections = concurrent_connections
+
+    def _splice(self, conn, pipe, fd, byte_offset, count):
+        """ move data from a data connection straight into the local file through a pipe with os.splice, the data is
+            never copied into python.  If the local file system does not support splice the data is written from the
+            pipe with os.pwrite instead, and the next download threads do not use zero copy
+
+            Args:
+                conn - data connection, its timeout is the maximum number of seconds to wait for data
+                pipe - (read fd, write fd) of the pipe the data is moved through
+                fd - file descriptor of the local file
+                byte_offset - byte offset into the file to write the data at
+                count - maximum number of bytes to move
+
+            Returns:
+                number of bytes moved, 0 at the end of the file
+        """
+        # a socket with a timeout is non-blocking, so wait until there is data to move
+        while True:
+            if not select.select([conn], [], [], conn.gettimeout())[0]:
+                raise socket.timeout('timed out')
+            try:
+                received = os.splice(conn.fileno(), pipe[1], count)
+                break
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise e
+
+        # empty the pipe into the file
+        moved = 0
+        while moved < received:
+            if self._zero_copy:
+                try:
+                    moved = moved + os.splice(pipe[0], fd, received - moved, offset_dst=byte_offset + moved)
+                    continue
+                except (IOError, OSError) as e:
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                        raise e
+                    self._zero_copy = False
+            data = memoryview(os.read(pipe[0], received - moved))
+            while data:
+                written = os.pwrite(fd, data, byte_offset + moved)
+                moved = moved + written
+                data = data[written:]
+        return received
+
+    def _start_next_segment(self, remote_path, byte_offset, end_byte_offset):
+        """ start the transfer of the next segment of a download thread on a second connection, while the thread is
+            still downloading its current segment
+
+            Args:
+                remote_path - path to the file to download on the ftp server
+                byte_offset - byte offset into the file of the next segment
+                end_byte_offset - byte offset into the file of the end of the next segment
+
+            Returns:
+                [ftp connection, data connection, byte_offset, end_byte_offset] of the next segment, or None if the
+                transfer could not be started, the blocks of the segment are then released when the thread finishes
+        """
+        try:
+            ftp = self._connection_pool.acquire()
+        except all_errors as _:
+            return None
+        try:
+            conn = ftp.transfercmd('retr %s' % remote_path, byte_offset)
+            conn.settimeout(self.KILL_POLL)
+        except all_errors as _:
+            self._connection_pool.discard(ftp)
+            return None
+        return [ftp, conn, byte_offset, end_byte_offset]
+
+    def _stealable_workers(self, blockmap, min_blocks):
+        """ return the ids of the active download threads which have at least min_blocks blocks left to download,
+            duplicate downloads are never included since they do not own their blocks """
+        retval = []
+        for k in self._download_threads.keys():
+            if (self._download_threads[k].private_thread_state == self.ACTIVE and
+                    self._download_threads[k].private_duplicate_of is None):
+                segments = blockmap.get_worker_segments(k)
+                if segments and segments[-1]['blocks'] >= min_blocks:
+                    retval.append(k)
+        return retval
+
+    def _tw_ftp_download_segment(self, remote_path, local_path, byte_offset, blocks, blocksize, worker_id, channel_in,
+                                 channel_out, buffer_pool):
+        """ thread worker to download a segment of a file from teh ftp server
+
+            With zero copy the data is moved from the data connection straight into the local file by the kernel, and
+            the blocks are reported as saved instead of being passed to the file writer
+
+            Args:
+                remote_path - path to the file to download on the ftp server
+                local_path - path of the local file, only written to directly with zero copy
+                byte_offset - byte offset into the file to start downloading at
+                blocks - number of blocks to download, see self._blocksize for size of each block
+                worker_id - hexadecimal id of this worker thread
+                channel_in - Channel of control messages from the manager to this thread
+                channel_out - Channel of messages from this thread to the manager
+                buffer_pool - BlockBufferPool to receive the blocks into
+        """
+        # errors from the server, for example too many connections, end the thread and are reported to the manager
+        state = SegmentState(worker_id, byte_offset, blocks, blocksize, self._rate_limiter, channel_out)
+        ftp = None
+        conn = None
+        fd = None               # local file and pipe the data is moved through with zero copy
+        pipe = None
+        try:
+            # zero copy is only possible for plaintext data connections on systems with os.splice
+            if self._zero_copy and not self._enable_tls and hasattr(os, 'splice'):
+                fd = os.open(local_path, os.O_WRONLY)
+                pipe = os.pipe()
+
+            # get a logged in connection in binary mode from the pool, then initiate a transfer starting at the
+            # byte_offset
+            ftp = self._connection_pool.acquire()
+            conn = ftp.transfercmd('retr %s' % remote_path, byte_offset)
+            conn.settimeout(self.KILL_POLL)
+
+            # each pass downloads one segment, a thread which was given its next segment ahead of time moves straight
+            # on to the transfer of the next segment which has already been started.  The end of the segment moves
+            # closer if the manager gives the back of the segment to another worker
+            while True:
+                eof = self._receive_segment(remote_path, conn, state, channel_in, buffer_pool, blocksize,
+                                            (fd, pipe) if pipe is not None else None)
+
+                # return the connection to the pool, at the end of the file the server confirms the transfer, otherwise
+                # the transfer is aborted by the pool
+                conn.close()
+                conn = None
+                if eof:
+                    ftp.voidresp()
+                self._connection_pool.release(ftp, abort=not eof)
+                ftp = None
+
+                # move on to the next segment
+                if state.next_segment is None:
+                    break
+                ftp, conn = state.move_to_next_segment()
+
+            # set the thread to be idle
+            state.finish()
+        except all_errors as e:
+            if conn is not None:
+                conn.close()
+            if ftp is not None:
+                self._connection_pool.discard(ftp)
+            if state.next_segment is not None:
+                state.next_segment[1].close()
+                self._connection_pool.discard(state.next_segment[0])
+            state.fail(e)
+        finally:
+            if fd is not None:
+                os.close(fd)
+            if pipe is not None:
+                os.close(pipe[0])
+                os.close(pipe[1])
+
+    def _tw_ftp_download_small_files(self, files, worker_id, channel_in, channel_out):
+        """ thread worker to fetch a batch of small files one after the other on one connection, each file is fetched
+            with a single RETR straight into the local file
+
+            Args:
+                files - list of (remote_path, local_path, size) of the files, size is None if it is not known yet
+                worker_id - hexadecimal id of this worker thread
+                channel_in - Channel of control messages from the manager to this thread
+                channel_out - Channel of messages from this thread to the manager
+        """
+        # any error ends the thread and is reported to the manager, the files which have not been fetched are then
+        # downloaded in segments
+        state = SmallFilesState(worker_id, files, self._small_file_size, self._rate_limiter, channel_out)
+        ftp = None
+        part_path = None
+        try:
+            ftp = self._connection_pool.acquire()
+            view = memoryview(bytearray(self.SMALL_FILE_CHUNK))
+            for remote_path, local_path, size in state.pending_files(channel_in):
+                # hand the file back if it turns out to be too large, or if the server does not report its size
+                if size is None:
+                    size = ftp.size(remote_path)
+                if state.deferred(remote_path, local_path, size):
+                    continue
+
+                # fetch the file into a partial file, which replaces the local file once the whole file has arrived
+                # so that an interrupted fetch never looks like a downloaded file
+                part_path = local_path + '.part'
+                conn = ftp.transfercmd('retr %s' % remote_path)
+                with closing(conn):
+                    conn.settimeout(self.DATA_TIMEOUT)
+                    with open(part_path, 'wb') as f:
+                        received = self._recv_small_file(conn, view, state)
+                        while received > 0:
+                            f.write(view[:received])
+                            received = self._recv_small_file(conn, view, state)
+                ftp.voidresp()
+                if os.path.exists(local_path):
+                    os.remove(local_path)
+                os.rename(part_path, local_path)
+                part_path = None
+                state.file_done(remote_path, local_path, size)
+
+            # return the connection to the pool, every transfer on it has been completed, then set the thread to be
+            # idle
+            self._connection_pool.release(ftp)
+            ftp = None
+            state.finish()
+        except Exception as e:     # pylint: disable=W0703
+            if ftp is not None:
+                self._connection_pool.discard(ftp)
+            if part_path is not None and os.path.exists(part_path):
+                os.remove(part_path)
+            state.fail(e)
+
+    def _worker_speed(self, worker_id, worker_ids):
+        """ return the average download speed of a download thread in bytes per second
+
+            Args:
+                worker_id - id of the download thread
+                worker_ids - ids of the download threads being compared, if the thread has not measured a speed yet
+                             the average speed of these threads is returned instead
+
+            Returns:
+                speed in bytes per second, always greater than zero
+        """
+        fifo = [s for s in self._download_threads[worker_id].private_dl_speed_fifo if s > 0]
+        if fifo:
+            return sum(fifo) / float(len(fifo))
+        speeds = [s for k in worker_ids for s in self._download_threads[k].private_dl_speed_fifo if s > 0]
+        if speeds:
+            return sum(speeds) / float(len(speeds))
+        return 1.0
+
+    # --------------------------------------------------
+    # Properties
+    # --------------------------------------------------
+    @property
+    def concurrent_connections(self):
+        """ return the number of concurrent download connections """
+        return self._concurrent_connections
+
+    @property
+    def total_dl_speed(self):
+        """ return the total download speed of all the workers """
+        dl_speed = 0
+        for worker_id in self.worker_dl_speeds:
+            dl_speed = dl_speed + (sum(self.worker_dl_speeds[worker_id]) /
+                                   len(self.worker_dl_speeds[worker_id]))
+        return dl_speed
+
+    @property
+    def worker_dl_speeds(self):
+        """ return an estimate of the current worker download speeds """
+        retval = OrderedDict()
+        for k in self._download_threads.keys():
+            retval[k] = self._download_threads[k].private_dl_speed_fifo
+        return retval
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def close(self):
+        """ close the ftp connections which are kept open to be reused by the next download """
+        self._connection_pool.close()
@@ -2,43 +2,70 @@
 # --------------------------------------------------
 #    Imports
 # --------------------------------------------------
-from collections import OrderedDict
-from contextlib import closing
+import math
 import os
-import ssl
 import sys
 import time
-from ftplib import FTP, FTP_TLS, error_temp, error_perm
+from ftplib import all_errors, error_temp, error_perm
 from threading import Thread
 # disable pylint for relative-import below, no way to make it work with sphinx and nosetests and comply with pylint
 
 if sys.version_info >= (3, 0):
-    from queue import Queue, PriorityQueue, Empty
+    from .async_engine import AsyncEngine
     from .blockmap import Blockmap
+    from .block_buffer_pool import BlockBufferPool, BufferBudget
+    from .channels import Channel, Doorbell, Message
+    from .concurrency_controller import ConcurrencyController
+    from .file_writer import FileWriter
+    from .ftp_download_threads import FtpDownloadThreads
+    from .ftp_lister import FtpLister
+    from .kill_policy import AbsoluteKillPolicy, KillPolicy
+    from .process_engine import ProcessEngine
+    ENGINES_AVAILABLE = True
 else:
-    from Queue import Queue             # pylint: disable=E0401
-    from Queue import PriorityQueue     # pylint: disable=E0401
-    from Queue import Empty             # pylint: disable=E0401
     from blockmap import Blockmap       # pylint: disable=E0401
+    from block_buffer_pool import BlockBufferPool, BufferBudget   # pylint: disable=E0401
+    from channels import Channel, Doorbell, Message               # pylint: disable=E0401
+    from concurrency_controller import ConcurrencyController    # pylint: disable=E0401
+    from file_writer import FileWriter                          # pylint: disable=E0401
+    from ftp_download_threads import FtpDownloadThreads         # pylint: disable=E0401
+    from ftp_lister import FtpLister                            # pylint: disable=E0401
+    from kill_policy import AbsoluteKillPolicy, KillPolicy      # pylint: disable=E0401
+    ENGINES_AVAILABLE = False                                   # asyncio and multiprocessing contexts need python 3
 
 
 # --------------------------------------------------
 #    Classes
 # --------------------------------------------------
-# somewhere on stackoverflow is this code which fixes TLS
-class PatchedFTPTLS(FTP_TLS):
-    """Explicit FTPS, with shared TLS session"""
-    def ntransfercmd(self, cmd, rest=None):
-        conn, size = FTP.ntransfercmd(self, cmd, rest)
-        if self._prot_p:
-            session = self.sock.session
-            if isinstance(self.sock, ssl.SSLSocket):
-                session = self.sock.session
-            conn = self.context.wrap_socket(conn, server_hostname=self.host, session=session)  # this is the fix
-        return conn, size
-
-
-class FtpFileDownloader:
+# _FileJob is a plain record of the state of a file which the manager updates, so it has no public methods
+class _FileJob:     # pylint: disable=R0903
+    """ state of the download of one file, several files are downloaded at once when a directory is downloaded """
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, remote_path, local_path, blockmap, buffer_pool, file_writer, writer_channel):
+        """ Initialize the class
+
+            Args:
+                remote_path - path to the remote file
+                local_path - path of the local file
+                blockmap - blockmap of the file
+                buffer_pool - BlockBufferPool the download threads of the file receive blocks into
+                file_writer - FileWriter which writes the blocks of the file, None if the worker processes of the
+                              process engine write them
+                writer_channel - Channel the file writer reports saved blocks on
+        """
+        self.remote_path = remote_path
+        self.local_path = local_path
+        self.blockmap = blockmap
+        self.blocksize = blockmap.get_statistics()[3]
+        self.buffer_pool = buffer_pool
+        self.file_writer = file_writer
+        self.writer_channel = writer_channel
+        self.finished = False
+
+
+class FtpFileDownloader(FtpDownloadThreads):
     """ Performs downloading of a single file using FTP
 
         set the on_refresh_display to a function handler of type f(blockmap, byte_offset, worker_id)
@@ -46,22 +73,31 @@ class FtpFileDownloader:
     # --------------------------------------------------
     # Constants
     # --------------------------------------------------
-    HIGH_PRIORITY_MSG = -1  # MSG priority of a high priority message in the message queue
+    NUM_QUEUE_MSGS_THROTTLE = 100   # throttle download threads if the queue has too many messages
 
-    IDLE = 0                # download thread state - IDLE, waiting for allocation if available
-    ACTIVE = 1              # download thread state - ACTIVE, actively retrieving data from the remote FTP server
-    ABORTING = 2            # download thread state - ABORTING, thread is in the process of being aborted and killed
+    DRAIN_TIMEOUT = 5.0     # seconds to wait for download threads to stop and their received data to be saved
 
-    SPEED_FIFO_SIZE = 4     # depth of the FIFO to track download speeds
+    TIMER_INTERVAL = 0.1    # seconds between the kill checks, concurrency updates and display refreshes of the manager
 
-    NUM_QUEUE_MSGS_THROTTLE = 100   # throttle download threads if the queue has too many messages
+    MIN_STEAL_BLOCKS = 2    # an active segment must have at least this many blocks left to be split with an idle worker
+
+    SMALL_FILE_BATCH = 8    # number of small files given to a download thread at once
+
+    ENGINE_THREADS = 'threads'  # engine - one thread per download connection
+    ENGINE_ASYNCIO = 'asyncio'  # engine - every download connection is a coroutine on one asyncio event loop
+    ENGINE_PROCESSES = 'processes'  # engine - the download connections are spread over one worker process per core
 
     # --------------------------------------------------
     # Init
     # --------------------------------------------------
     def __init__(self, server_url, username, password, port=21, concurrent_connections=4,
                  min_blocks_per_segment=8, max_blocks_per_segment=128, initial_blocksize=1048576,
-                 kill_speed=0, clean=False, enable_tls=False):
+                 kill_speed=0, clean=False, enable_tls=False, checkpoint_interval=5.0, checkpoint_blocks=64,
+                 durability=Blockmap.DURABILITY_CHECKPOINT, endgame_blocks=0, auto_connections=False,
+                 max_connections=32, max_buffer_mb=256, standby_connections=0, pipeline_seconds=0,
+                 max_open_files=8, small_file_size=1048576, listing_cache=None,
+                 listing_cache_ttl=FtpLister.CACHE_TTL, engine=ENGINE_THREADS, zero_copy=False, kill_policy=None,
+                 max_rate=0):
         """
             Initialize the class.  The defaults are reasonable for a broadband connection in the 2 to 20 mbps range.
 
@@ -78,7 +114,8 @@ class FtpFileDownloader:
                 username - username to login to ftp server with
                 password - password to login to ftp server with
                 port - port number to use for the ftp connection to the server
-                concurrent_connections - number of concurrent download connections to use
+                concurrent_connections - number of concurrent download connections to use, or the number to start
+                                         with if auto_connections is True
                 min_blocks_per_segment - minimum number of blocks that should be allocated to a download connection
                 max_blocks_per_segment - maximum number of blocks that should be allocated to a download connection
                 initial_blocksize - for a new blockmap, size of blocks in bytes
@@ -86,294 +123,739 @@ class FtpFileDownloader:
                              kill the connection and try to create a new download connection
                 clean - erase files on disk if they already exist before redownloading them
                 enable_tls - enable TLS encryption when connecting and downloading from the FTP server
+                checkpoint_interval - maximum number of seconds between checkpoints of the blockmap to disk
+                checkpoint_blocks - maximum number of downloaded blocks journaled between checkpoints of the blockmap
+                                    to disk
+                durability - when the blockmap journal and checkpoints are fsync'd, one of the Blockmap.DURABILITY_*
+                             levels
+                endgame_blocks - when this many blocks or fewer are left to download, idle connections which have
+                                 nothing left to split also download the blocks of the slowest connections and the
+                                 first copy of a block to arrive is saved, 0 disables the end-game.  Opt-in since
+                                 the duplicated blocks cost bandwidth and server connections
+                auto_connections - keep adding download connections while the total download speed improves, and
+                                   remove connections when the speed plateaus or the server returns errors
+                max_connections - if auto_connections is True, the number of download connections is never increased
+                                  above this ceiling
+                max_buffer_mb - budget in MB shared by all of the download connections for data which has been
+                                received but not written to disk yet, connections stop reading from the server while
+                                the budget is exhausted, 0 for no budget
+                standby_connections - number of logged in connections kept open in the background, ready for the
+                                      next download thread which needs a connection
+                pipeline_seconds - when a download connection is expected to finish its segment within this many
+                                   seconds, its next segment is allocated and the transfer of the next segment is
+                                   started on a second connection, so that there is no gap between the segments, 0
+                                   disables pipelining
+                max_open_files - when a directory is downloaded, the download connections are shared by up to this
+                                 many files at once, so that connections which have nothing left to do in one file
+                                 download the next file
+                small_file_size - files of this many bytes or less are fetched whole with a single RETR straight into
+                                  the local file, without a blockmap, and a download connection fetches several small
+                                  files one after the other, 0 disables the small file path
+                listing_cache - path of a JSON file the directory listings are cached in, so that a directory tree
+                                which is downloaded again is not listed again, None to not cache the listings
+                listing_cache_ttl - seconds a cached directory listing is reused for
+                engine - ENGINE_THREADS to run each download connection in its own thread, ENGINE_ASYNCIO to run
+                         every download connection on one asyncio event loop, which scales to hundreds of
+                         connections, or ENGINE_PROCESSES to spread the download connections over one worker process
+                         per core, which scales TLS decryption across the cores.  The asyncio engine needs python 3 and
+                         does not support TLS, the process engine needs python 3
+                zero_copy - on Linux, move the data of plaintext transfers from the data connections straight into the
+                            local files with os.splice, without copying it through python.  Falls back to receiving
+                            into buffers when TLS is enabled, os.splice is not available or the local file system does
+                            not support it.  Not used by the asyncio engine
+                kill_policy - KillPolicy which decides which download connections are killed and reconnected, for
+                              example a RelativeKillPolicy, None to kill the connections which are slower than the
+                              kill_speed
+                max_rate - maximum total download speed in MB/sec of all of the download connections, across all of
+                           the files being downloaded, 0 for no maximum.  Can be changed during the download with
+                           set_max_rate
         """
         # init
-        self._server_url = server_url
-        self._username = username
-        self._password = password
+        FtpDownloadThreads.__init__(self, server_url, username, password, port, concurrent_connections, enable_tls,
+                                    durability, small_file_size, zero_copy, max_rate)
         self._initial_blocksize = initial_blocksize
-        self._concurrent_connections = concurrent_connections
-        self._port = port
         self._min_blocks_per_segment = min_blocks_per_segment
         self._max_blocks_per_segment = max_blocks_per_segment
         self._kill_speed = kill_speed
-        self._com_queue_in = None
-        self._com_queue_out = None
+        self._doorbell = None
+        self._buffer_pools = {}             # blocksize -> BlockBufferPool shared by the files with that blocksize
+        self._buffer_budget = None          # BufferBudget shared by the buffer pools
+        self._jobs = []                     # _FileJob of each file being downloaded
+        self._pending_files = []            # (remote_path, local_path, size, allow_small) of each waiting file
+        self._tree_progress = {'files_done': 0, 'files_total': 0, 'bytes_done': 0}
         self._clean = clean
-        self._enable_tls = enable_tls
+        self._checkpoint_interval = checkpoint_interval
+        self._checkpoint_blocks = checkpoint_blocks
+        self._endgame_blocks = endgame_blocks
+        self._max_buffer_mb = max_buffer_mb
+        self._standby_connections = standby_connections
+        self._pipeline_seconds = pipeline_seconds
+        self._max_open_files = max(1, max_open_files)
         self._abort_download = False
+        self._kill_policy = kill_policy or (AbsoluteKillPolicy(kill_speed) if kill_speed > 0 else KillPolicy())
+        self._concurrency_controller = None
+        if auto_connections:
+            self._concurrency_controller = ConcurrencyController(concurrent_connections, max_connections)
+        self._lister = FtpLister(listing_cache, listing_cache_ttl, '%s@%s:%d ' % (username, server_url, port))
+        self._engine = None
+        self._throttled = {}        # worker_id -> time the last wait of the download thread for the max rate ends
+        if engine == self.ENGINE_ASYNCIO:
+            if not ENGINES_AVAILABLE or enable_tls:
+                raise ValueError('the asyncio engine needs python 3 and does not support TLS')
+            self._engine = AsyncEngine(server_url, port, username, password, small_file_size, self.BUFFER_WAIT,
+                                       self.SMALL_FILE_CHUNK, self._rate_limiter)
+        elif engine == self.ENGINE_PROCESSES:
+            if not ENGINES_AVAILABLE:
+                raise ValueError('the process engine needs python 3')
+            self._engine = ProcessEngine(server_url, port, username, password, enable_tls, small_file_size,
+                                         FtpFileDownloader, max_buffer_mb, durability != Blockmap.DURABILITY_NONE,
+                                         zero_copy, max_rate=max_rate * 1024 * 1024)
+            # the worker processes share the token bucket of the engine
+            self._rate_limiter = self._engine.rate_limiter
+        elif engine != self.ENGINE_THREADS:
+            raise ValueError('unknown engine "%s"' % engine)
 
         # handlers
         self.on_refresh_display = lambda _ftp_file_downloader, _blockmap, _remote_filepath: None
 
-        # setup the initial dead threads for each download connections
-        self._download_threads = OrderedDict([(format(k, 'x'),
-                                               Thread()) for k in range(0,  # pylint: disable=W1506
-                                                                        concurrent_connections)])
-        for k in self._download_threads.keys():
-            self._download_threads[k].private_thread_state = self.IDLE
-            self._download_threads[k].private_start_time = time.time()
-            self._download_threads[k].private_dl_speed_fifo = [0] * self.SPEED_FIFO_SIZE
-
     # --------------------------------------------------
     # Private Functions
     # --------------------------------------------------
-    def _ftp_connection(self):
-        """ throws an exception similar to ftplib.error_perm: 500 Unknown command: "AUTH TLS" if ftp server does not
-        support tls """
-        if self._enable_tls:
-            if sys.version_info >= (3, 0):
-                ftp = PatchedFTPTLS()
+    def _allocate_segments(self, idle_download_workers):
+        """ allocate the available blocks of the open files to idle download threads, the files are served in the order
+            they were opened and the next file is opened while download threads are left idle
+
+            Args:
+                idle_download_workers - list of ids of the idle download threads
+
+            Returns:
+                list of ids of the download threads which are still idle
+        """
+        worker_speeds = dict((k, self._download_threads[k].private_recent_dl_speed)
+                             for k in self._download_threads.keys())
+        i = 0
+        while idle_download_workers:
+            if i == len(self._jobs):
+                if not self._open_next_job(idle_download_workers):
+                    break
+                continue
+            job = self._jobs[i]
+            i = i + 1
+            _, available_blocks, _, _, _ = job.blockmap.get_statistics()
+            if available_blocks > 0:
+                segments = job.blockmap.allocate_segments(idle_download_workers, worker_speeds)
+                for k in segments:
+                    self._start_download_thread(job, segments[k]['byte_offset'], segments[k]['blocks'], k)
+                idle_download_workers = [k for k in idle_download_workers if k not in segments]
+        return idle_download_workers
+
+    def _close_jobs(self):
+        """ close the files which are still open when the download stops, the blocks which have already been written
+            are marked as downloaded and the blockmaps are checkpointed so that the downloads can be resumed
+
+            Raises:
+                the IOError or OSError of the first file writer which failed
+        """
+        # wait for the file writers to write everything they have been given
+        error = None
+        for job in self._jobs:
+            try:
+                if job.file_writer is not None:
+                    job.file_writer.close()
+            except (IOError, OSError) as e:
+                error = error or e
+
+        # mark the written blocks as downloaded, then checkpoint the blockmaps
+        self._process_events(0)
+        for job in self._jobs:
+            if not job.blockmap.is_blockmap_complete():
+                job.blockmap.checkpoint()
+        if error is not None:
+            raise error
+
+    def _download_files(self, files):
+        """ download a list of files, several files are downloaded at once so that the download connections which
+            have nothing left to do in one file are given blocks of the next file
+
+            Args:
+                files - list of (remote_path, local_path, size) of the files to download, size is None if it is not
+                        known yet
+        """
+        # setup the communication channels and the files waiting to be opened, files which have already been
+        # downloaded are skipped
+        self._doorbell = Doorbell()             # rung when a download thread or a file writer has a message
+        self._buffer_pools = {}
+        self._buffer_budget = BufferBudget(self._max_buffer_mb * 1024 * 1024 if self._max_buffer_mb else None)
+        self._jobs = []
+        self._tree_progress = {'files_done': 0, 'files_total': len(files), 'bytes_done': 0}
+        self._pending_files = []
+        for remote_path, local_path, size in files:
+            pending_file = self._prepare_file(remote_path, local_path, size)
+            if pending_file is None:
+                self._tree_progress['files_done'] = self._tree_progress['files_done'] + 1
             else:
-                # TLS does not work so good on python 2.7
-                ftp = FTP_TLS()
-        else:
-            ftp = FTP()
+                self._pending_files.append(pending_file)
 
-        ftp.connect(self._server_url, self._port)
+        # loop until every file is downloaded and fully saved to disk, if the download is aborted or an exception is
+        # raised the data which has already been received is saved and the blockmaps are checkpointed so the
+        # downloads can be resumed
+        try:
+            next_timer = time.time()
+            while (self._jobs or self._pending_files or
+                   any(t.private_small_files for t in self._download_threads.values())):
+                # exit if we are aborting
+                if self._abort_download:
+                    return
+
+                # manage the download threads when something has happened, or when the timer for the kill checks and
+                # the concurrency controller is due
+                timer = time.time() >= next_timer
+                if timer:
+                    next_timer = time.time() + self.TIMER_INTERVAL
+                throttle = self._pending_events() > self.NUM_QUEUE_MSGS_THROTTLE
+                self._manage_download_threads(throttle)
+
+                # block until the next event arrives or the timer is due, then process every event which has arrived
+                events = self._process_events(max(0.0, next_timer - time.time()))
+
+                # close the files which have been completely downloaded and saved
+                for job in [job for job in self._jobs if job.blockmap.is_blockmap_complete()]:
+                    self._finish_job(job)
+
+                # call the refresh display callback with the oldest file which is still being downloaded
+                if (events > 0 or timer) and self._jobs:
+                    self.on_refresh_display(self, self._jobs[0].blockmap, self._jobs[0].remote_path)
+        finally:
+            # stop every download thread before the next download
+            self._drain_download_threads()
+            self._close_jobs()
+
+    def _drain_download_threads(self):
+        """ kill all of the download threads and pass the data they have already received to the file writers, so
+            that blocks which have been received but not saved yet do not need to be downloaded again when the download
+            is resumed
+        """
+        # kill every active download thread without aborting the rest of the download
+        for k in self._download_threads.keys():
+            self.abort_download(k)
 
-        ftp.login(self._username, self._password)
+        # process events until every thread has stopped and the channels are empty, or the drain times out
+        t = time.time()
+        while time.time() - t < self.DRAIN_TIMEOUT:
+            if self._process_events(self.BUFFER_WAIT) == 0:
+                if all(not thread.is_alive() for thread in self._download_threads.values()):
+                    break
 
-        if self._enable_tls:
-            ftp.prot_p()
-        return ftp
+        # download threads which did not stop in time only talk to the channels of this download, so they are replaced
+        # with idle threads for the next download
+        for k in self._download_threads.keys():
+            if self._download_threads[k].private_thread_state != self.IDLE:
+                self._download_threads[k] = self._idle_thread()
 
-    def _ftp_get_filesize(self, remote_path):
-        """ return the file size of an ftp file on the ftp server
+    def _duplicate_segments(self, job, idle_download_workers):
+        """ end-game, download the remaining blocks of the slowest active download threads of a file again on idle
+            download threads, whichever copy of a block arrives first is saved
 
             Args:
-                remote_path - path to the file on the ftp server
+                job - _FileJob of the file
+                idle_download_workers - list of ids of the idle download threads
 
             Returns:
-                number of bytes in the file
+                list of ids of the download threads which are still idle
+        """
+        # segments which are already being downloaded twice are not duplicated again
+        duplicated = [t.private_duplicate_of for t in self._download_threads.values()
+                      if t.private_thread_state == self.ACTIVE and t.private_duplicate_of is not None]
+        while idle_download_workers:
+            candidates = [w for w in self._stealable_workers(job.blockmap, 1)
+                          if (w, self._download_threads[w].private_segment_offset) not in duplicated]
+            if not candidates:
+                break
+            victim = max(candidates, key=lambda w, c=candidates: self._remaining_time(job.blockmap, w, c))
+            segment = job.blockmap.get_worker_segments(victim)[-1]
+            duplicated.append((victim, self._download_threads[victim].private_segment_offset))
+            self._start_download_thread(job, segment['byte_offset'], segment['blocks'], idle_download_workers.pop(0),
+                                        duplicated[-1])
+        return idle_download_workers
+
+    def _finish_job(self, job):
+        """ close a file which has been completely downloaded and saved, and delete its blockmap
+
+            Args:
+                job - _FileJob of the file
         """
-        ftp = self._ftp_connection()
-        ftp.sendcmd("TYPE i")           # Switch to Binary mode
-        size = ftp.size(remote_path)    # Get size of file
-        ftp.sendcmd("TYPE A")           # Switch to Binary mode
-        return size
-
-    def _manage_download_threads(self, blockmap, remote_path, throttle):
-        """ kill underperforming thread and allocate work to idle threads """
-        # check if we need to kill any download threads because they have stalled
-        # kill speed must be set to greater than zero, and the download thread must be at least 10 seconds old
-        # the download speed usually ramps up if the server is far away so we give it time to ramp up before
-        # checking if it has stalled or is stuck on a very slow packet path
-        if self._kill_speed > 0:
-            for k in self.worker_dl_speeds:
-                # check the speed if the thread is active
-                if (self._download_threads[k].private_thread_state == self.ACTIVE and
-                        time.time() - self._download_threads[k].private_start_time > 20):
-                    # do not kill if we are still starting up, we can tell since we have 0 speeds
-                    if 0 not in self.worker_dl_speeds[k]:
-                        # kill if the average speed
-                        if max(self.worker_dl_speeds[k]) / 1024 / 1024 < self._kill_speed:
-                            self.abort_download(k)
+        # download threads can still be running once the file is complete, for example a worker whose segment was
+        # split or a duplicate download in the end-game
+        for k in self._download_threads.keys():
+            if self._download_threads[k].private_job is job:
+                self.abort_download(k)
+
+        # every block has been written, so the file writer stops straight away
+        if job.file_writer is not None:
+            job.file_writer.close()
+        self._process_channel(job, job.writer_channel)
+        job.finished = True
+        self._jobs.remove(job)
+        self._tree_progress['files_done'] = self._tree_progress['files_done'] + 1
+        self._tree_progress['bytes_done'] = self._tree_progress['bytes_done'] + os.path.getsize(job.local_path)
+
+        # clean up the block map
+        job.blockmap.delete_blockmap()
+
+    def _is_small_file(self, pending_file):
+        """ return True if a file waiting to be downloaded may be fetched whole by the small file path, a file whose
+            size is not known yet is checked by the download thread before it is fetched
+
+            Args:
+                pending_file - (remote_path, local_path, size, allow_small) of the file
+        """
+        _, _, size, allow_small = pending_file
+        return self._small_file_size > 0 and allow_small and (size is None or size <= self._small_file_size)
+
+    def _kill_download_threads(self):
+        """ kill the download threads which the kill policy selects, and the duplicate downloads of the end-game whose
+            original download thread has finished or has been killed """
+        # ask the kill policy which download threads have stalled or are stuck on a very slow packet path, threads
+        # which are waiting for the buffer budget or have waited for the max rate in the last KILL_POLL seconds are not
+        # reading from the server so they are left alone
+        now = time.time()
+        paused = [k for k, thread in self._download_threads.items()
+                  if self._throttled.get(k, 0) + self.KILL_POLL > now or
+                  thread.private_job is not None and thread.private_job.buffer_pool.exhausted]
+        for k in self._kill_policy.select(paused):
+            self.abort_download(k)
+
+        # stop duplicate downloads whose original download thread has finished or has been killed
+        for k in self._download_threads.keys():
+            duplicate_of = self._download_threads[k].private_duplicate_of
+            if self._download_threads[k].private_thread_state == self.ACTIVE and duplicate_of is not None:
+                original = self._download_threads[duplicate_of[0]]
+                if original.private_thread_state != self.ACTIVE or original.private_segment_offset != duplicate_of[1]:
+                    self.abort_download(k)
+
+    def _manage_download_threads(self, throttle):
+        """ kill underperforming thread and allocate work to idle threads, the files which are open are served in the
+            order they were opened and the next file is opened while download threads are left idle """
+        self._kill_download_threads()
+
+        # let the concurrency controller tune the number of download threads, threads above the number of connections
+        # finish their segments but are not given new ones
+        if self._concurrency_controller is not None:
+            self._set_concurrent_connections(self._concurrency_controller.update(self.total_dl_speed))
+
+        # keep standby connections logged in, ready for the download threads
+        if self._standby_connections > 0:
+            (self._connection_pool if self._engine is None else self._engine).prewarm(self._standby_connections)
 
         # do not allocate new threads if we are throttled
         if throttle:
             return
 
-        # gather all of the idle download threads
-        idle_download_workers = []
-        for k in self._download_threads.keys():
-            if self._download_threads[k].private_thread_state == self.IDLE:
-                idle_download_workers.append(k)
-
-        # allocate segments to each idle worker
-        _, available_blocks, _, blocksize, _ = blockmap.get_statistics()
-        if available_blocks > 0:
-            segments = blockmap.allocate_segments(idle_download_workers)
-            for k in segments:
-                self._download_threads[k] = Thread(target=self._tw_ftp_download_segment,
-                                                   args=(remote_path, segments[k]['byte_offset'], segments[k]['blocks'],
-                                                         blocksize, k))
-                self._download_threads[k].private_thread_state = self.ACTIVE
-                self._download_threads[k].private_start_time = time.time()
-                self._download_threads[k].private_dl_speed_fifo = [0] * self.SPEED_FIFO_SIZE
-                self._download_threads[k].start()
-
-    def _process_high_priority_messages(self, blockmap):
-        # process all of the available high priority messages
-        while not self._com_queue_out.empty():
-            # get the next message
-            msg = self._com_queue_out.get()
-
-            # if this is not a high priority message, put it back in the queue and exit
-            if msg[0] != self.HIGH_PRIORITY_MSG:
-                self._com_queue_out.put(msg)
-                break
+        # gather all of the idle download threads, and allocate segments of the open files to them
+        idle_download_workers = [k for k in list(self._download_threads.keys())[:self._concurrent_connections]
+                                 if self._download_threads[k].private_thread_state == self.IDLE]
+        idle_download_workers = self._allocate_segments(idle_download_workers)
+
+        # give the next segment to the download threads which are about to finish their segments
+        if self._pipeline_seconds > 0:
+            for job in self._jobs:
+                self._pipeline_segments(job)
+
+        # once there are no available blocks left, split the segments of the slowest workers with the idle workers
+        # instead of leaving them idle until the slow workers finish
+        for job in self._jobs:
+            if idle_download_workers:
+                idle_download_workers = self._steal_segments(job, idle_download_workers)
+
+        # in the end-game race the idle workers against the slowest workers for the last few blocks, once there are
+        # no more files to open
+        if not self._pending_files:
+            for job in self._jobs:
+                non_downloaded_blocks, _, _, _, _ = job.blockmap.get_statistics()
+                if idle_download_workers and non_downloaded_blocks <= self._endgame_blocks:
+                    idle_download_workers = self._duplicate_segments(job, idle_download_workers)
+
+    def _new_download_thread(self, worker_id, target, args, channel_in, channel_out):
+        """ create an ACTIVE download thread which has not been started yet, in place of an idle download thread, with
+            the asyncio engine the download thread is a handle of a coroutine on the event loop of the engine
 
-            # process the message
-            if msg[1][1]['type'] == 'data_received_high_priority':
-                # update the blockmap to show the block has been downloaded and is pending save to disk
-                blockmap.change_block_range_status(msg[1][1]['byte_offset'], 1, blockmap.SAVING)
-            elif msg[1][1]['type'] in ('aborted_high_priority', 'thread_finished_high_priority'):
-                # abort this download thread, so mark all of the blocks as available
-                blockmap.change_status(msg[1][1]['worker_id'], blockmap.AVAILABLE)
-                # set the download thread state to IDLE
-                self._download_threads[msg[1][1]['worker_id']].private_thread_state = self.IDLE
-                # zero out the download speeds for this thread
-                self._download_threads[msg[1][1]['worker_id']].private_dl_speed_fifo = [0] * self.SPEED_FIFO_SIZE
-            elif msg[1][1]['type'] == 'dl_speed_update_high_priority':
-                # a new download speed has been calculated, update the worker dl speed fifo
-                self._download_threads[msg[1][1]['worker_id']].private_dl_speed_fifo.insert(0, msg[1][1]['dl_speed'])
-                self._download_threads[msg[1][1]['worker_id']].private_dl_speed_fifo.pop(-1)
-            else:
-                raise Exception('Unhandled msg type "%s"' % msg[1][1]['type'])
+            Args:
+                worker_id - id of the download thread
+                target - thread worker function, or coroutine function of the asyncio engine
+                args - arguments of the thread worker function
+                channel_in - Channel of control messages from the manager to the thread
+                channel_out - Channel of messages from the thread to the manager
 
-    def _process_low_priority_messages(self, blockmap, local_path):
-        # init
-        blocks = 0
-        data = b''
-        next_byte_offset = None
-        starting_byte_offset = None
+            Returns:
+                the new thread
+        """
+        thread = self._idle_thread(Thread(target=target, args=args) if self._engine is None else
+                                   self._engine.task(target, args))
+        thread.private_recent_dl_speed = self._download_threads[worker_id].private_recent_dl_speed
+        thread.private_channel_in = channel_in
+        thread.private_channel_out = channel_out
+        thread.private_thread_state = self.ACTIVE
+        self._download_threads[worker_id] = thread
+        self._kill_policy.start(worker_id)
+        return thread
+
+    def _on_small_file(self, thread, msg):
+        """ a download thread of small files has fetched a file, or found that the file is too large and handed it back
+            to be downloaded in segments
+
+            Args:
+                thread - the download thread
+                msg - FILE_DONE or FILE_DEFERRED Message of the file
+        """
+        thread.private_small_files = [f for f in thread.private_small_files if f[0:2] != msg.value[0:2]]
+        if msg.kind == Message.FILE_DEFERRED:
+            self._pending_files.insert(0, msg.value + (False, ))
+        else:
+            self._kill_policy.on_data(msg.worker_id)
+            self._tree_progress['files_done'] = self._tree_progress['files_done'] + 1
+            self._tree_progress['bytes_done'] = self._tree_progress['bytes_done'] + msg.value[2]
+
+    def _on_thread_finished(self, job, thread, msg):
+        """ a download thread has stopped, it is set back to IDLE and the work it did not finish is given back
+
+            Args:
+                job - _FileJob of the file the thread was downloading, None for a download thread of small files
+                thread - the download thread
+                msg - ABORTED, THREAD_FINISHED or ERROR Message of the thread
+        """
+        # tell the concurrency controller if the server returned an error
+        if msg.kind == Message.ERROR and self._concurrency_controller is not None:
+            self._concurrency_controller.on_error()
+        # abort this download thread, so mark all of the blocks as available.  The small files which a thread did not
+        # fetch go back to the front of the queue, after an error they are downloaded in segments instead
+        if job is None:
+            self._pending_files[0:0] = [f + (msg.kind == Message.ABORTED, ) for f in thread.private_small_files]
+            thread.private_small_files = []
+        elif not job.finished:
+            job.blockmap.change_status(msg.worker_id, job.blockmap.AVAILABLE)
+        # set the download thread state to IDLE
+        thread.private_thread_state = self.IDLE
+        self._kill_policy.stop(msg.worker_id)
+        self._throttled.pop(msg.worker_id, None)
+        # zero out the download speeds for this thread
+        thread.private_dl_speed_fifo = [0] * self.SPEED_FIFO_SIZE
+
+    def _open_job(self, remote_path, local_path):
+        """ open a file to be downloaded, the local file and its blockmap are created and the file writer is started
+
+            Args:
+                remote_path - path to the remote file
+                local_path - path of the local file
+
+            Returns:
+                _FileJob of the file
+        """
+        # construct a blockmap, but the blockmap is written to disk until init_blockmap if it does not exist yet.  A new
+        # blockmap is always sized with SIZE, the size in a cached directory listing can be out of date
+        blockmap = Blockmap(remote_path, local_path, self._ftp_get_filesize, self._min_blocks_per_segment,
+                            self._max_blocks_per_segment, self._initial_blocksize, self._checkpoint_interval,
+                            self._checkpoint_blocks, self._durability)
+
+        # create the local file if it does not exist
+        if not os.path.exists(local_path):
+            f = open(local_path, 'wb')
+            f.close()
+
+        # initialize the blockmap
+        blockmap.init_blockmap()
+
+        # the files with the same blocksize share a pool of buffers the download threads receive blocks into, and the
+        # pools share the buffer budget
         _, _, _, blocksize, _ = blockmap.get_statistics()
+        if blocksize not in self._buffer_pools:
+            self._buffer_pools[blocksize] = BlockBufferPool(blocksize, budget=self._buffer_budget)
+
+        # start the file writer, it reports runs of blocks which have been written with a data_saved event.  The
+        # worker processes of the process engine write the blocks themselves and report on the writer channel
+        writer_channel = Channel(self._doorbell)
+        if self._engine is not None and isinstance(self._engine, ProcessEngine):
+            return _FileJob(remote_path, local_path, blockmap, self._buffer_pools[blocksize], None, writer_channel)
+
+        def on_saved(byte_offset, blocks):
+            """ called from the file writer thread once a run of blocks has been written to disk """
+            writer_channel.put(Message(Message.DATA_SAVED, byte_offset=byte_offset, value=blocks))
+        file_writer = FileWriter(local_path, self._buffer_pools[blocksize], on_saved,
+                                 fsync=self._durability != Blockmap.DURABILITY_NONE)
+        return _FileJob(remote_path, local_path, blockmap, self._buffer_pools[blocksize], file_writer, writer_channel)
+
+    def _open_next_job(self, idle_download_workers):
+        """ open the next file waiting to be downloaded, unless max_open_files files are already open, or give the
+            next batch of small files to an idle download thread
 
-        # loop through the messages and see if we can assemble a chain of consecutive blocks
-        while not self._com_queue_out.empty():
-            # peek at the next message
-            msg = self._com_queue_out.get()
-            # if then ext message is not the next block in the data chain, put the msg back and process what we have
-            if (msg[0] == self.HIGH_PRIORITY_MSG) or ((next_byte_offset is not None) and
-                                                      (msg[1][1]['byte_offset'] != next_byte_offset)):
-                self._com_queue_out.put(msg)
-                break
+            Args:
+                idle_download_workers - list of ids of the idle download threads, the id of the thread given a batch
+                                        of small files is removed
 
-            # sanity check, this is the only low priority message we have
-            if msg[1][1]['type'] != 'data_received_low_priority':
-                raise Exception('Unhandled msg type "%s"' % msg[1][1]['type'])
+            Returns:
+                True if a file was opened or a batch of small files was started
+        """
+        if not self._pending_files:
+            return False
+
+        # the small files at the front of the queue are downloaded whole by one download thread
+        if self._is_small_file(self._pending_files[0]):
+            files = []
+            while (self._pending_files and len(files) < self.SMALL_FILE_BATCH and
+                   self._is_small_file(self._pending_files[0])):
+                files.append(self._pending_files.pop(0)[0:3])
+            self._start_small_files_thread(files, idle_download_workers.pop(0))
+            return True
+
+        # open the next file
+        if len(self._jobs) >= self._max_open_files:
+            return False
+        remote_path, local_path, _, _ = self._pending_files.pop(0)
+        self._jobs.append(self._open_job(remote_path, local_path))
+        return True
+
+    def _pending_events(self):
+        """ return the number of messages waiting in the channels of the file writers and the download threads """
+        return (sum(len(job.writer_channel) for job in self._jobs) +
+                sum(len(t.private_channel_out) for t in self._download_threads.values()))
+
+    def _pipeline_segments(self, job):
+        """ allocate the next segment of a file to each active download thread of the file which is expected to finish
+            its segment within self._pipeline_seconds, the thread starts the transfer of the next segment before the
+            current segment ends
+
+            Args:
+                job - _FileJob of the file
+        """
+        blockmap = job.blockmap
+        active = [k for k in list(self._download_threads.keys())[:self._concurrent_connections]
+                  if self._download_threads[k].private_thread_state == self.ACTIVE and
+                  self._download_threads[k].private_job is job]
+        for k in active:
+            thread = self._download_threads[k]
+            if thread.private_duplicate_of is not None or thread.private_next_segment_offset is not None:
+                continue
+            # only threads which have measured their speed can estimate when they will finish
+            if max(thread.private_dl_speed_fifo) <= 0:
+                continue
+            if self._remaining_time(blockmap, k, active) > self._pipeline_seconds:
+                continue
+            worker_speeds = dict((w, self._download_threads[w].private_recent_dl_speed)
+                                 for w in self._download_threads.keys())
+            segments = blockmap.allocate_segments([k], worker_speeds)
+            if k not in segments:
+                return
+            thread.private_next_segment_offset = segments[k]['byte_offset']
+            thread.private_channel_in.put(Message(Message.NEXT_SEGMENT, byte_offset=segments[k]['byte_offset'],
+                                                  value=segments[k]['blocks']))
 
-            # add this message data to the chain
-            if starting_byte_offset is None:
-                starting_byte_offset = msg[1][1]['byte_offset']
-            blocks = blocks + 1
-            data = data + msg[1][1]['data']
-            next_byte_offset = msg[1][1]['byte_offset'] + blocksize
+    def _prepare_file(self, remote_path, local_path, size):
+        """ prepare the local path of a file to be downloaded
 
-            # save max of 256MB at a time
-            if len(data) >= 256 * 1024 * 1024:
-                break
+            Args:
+                remote_path - path to the remote file
+                local_path - file location to save the remote file to
+                size - size of the remote file in bytes, or None if it is not known yet
+
+            Returns:
+                (remote_path, local_path, size, allow_small) of the file, or None if the file has already been
+                downloaded.  allow_small is False if a partial download of the file can be resumed from its blockmap
+        """
+        # sanity check for local_path if it is a directory
+        if os.path.isdir(local_path):
+            local_path = os.path.join(local_path, os.path.basename(remote_path))
+
+        # clean the file if needed
+        if self._clean:
+            self.clean_local_file(remote_path, local_path)
+
+        # exit if this file has already been downloaded
+        resume = Blockmap(remote_path, local_path, None, 1, 1, 1024).is_blockmap_already_exists()
+        if not resume and os.path.exists(local_path):
+            if os.path.getsize(local_path) > 0:
+                return None
+        return (remote_path, local_path, size, not resume)
+
+    def _process_channel(self, job, channel):
+        """ process every message waiting in a channel
+
+            Args:
+                job - _FileJob the messages in the channel belong to
+                channel - Channel to read the messages from
+
+            Returns:
+                number of messages processed
+        """
+        events = 0
+        msg = channel.get_nowait()
+        while msg is not None:
+            self._process_event(job, msg)
+            events = events + 1
+            msg = channel.get_nowait()
+        return events
 
-        # save the block
-        if starting_byte_offset is not None:
-            with open(local_path, 'r+b') as f:
-                f.seek(starting_byte_offset)
-                f.write(data)
-                f.close()
-            # update the blockmap
-            blockmap.change_block_range_status(starting_byte_offset, blocks, blockmap.DOWNLOADED)
+    def _process_event(self, job, msg):
+        """ process a single message from a download thread or a file writer
 
-    def _tw_ftp_download_segment(self, remote_path, byte_offset, blocks, blocksize, worker_id):
-        """ thread worker to download a segment of a file from teh ftp server
+            Args:
+                job - _FileJob of the file the message belongs to
+                msg - Message to process
+        """
+        blockmap = job.blockmap if job is not None else None
+        thread = self._download_threads[msg.worker_id] if msg.worker_id is not None else None
+        if msg.kind == Message.DATA_RECEIVED:
+            # the first copy of a block to arrive is passed to the file writer, and the block is shown as pending save
+            # to disk.  later copies from a split segment or the end-game, or copies which arrive after the file has
+            # been finished, are dropped
+            self._kill_policy.on_data(msg.worker_id)
+            if job.finished or blockmap.get_block_status(msg.byte_offset) in (blockmap.SAVING, blockmap.DOWNLOADED):
+                job.buffer_pool.release(msg.data)
+            else:
+                blockmap.change_block_range_status(msg.byte_offset, 1, blockmap.SAVING)
+                job.file_writer.write(msg.byte_offset, [(msg.data, msg.length)])
+        elif msg.kind == Message.DATA_SAVED:
+            # the file writer, or a download thread with zero copy, has written a run of blocks to disk
+            if thread is not None:
+                self._kill_policy.on_data(msg.worker_id)
+            if not job.finished:
+                blockmap.change_block_range_status(msg.byte_offset, msg.value, blockmap.DOWNLOADED)
+        elif msg.kind in (Message.FILE_DEFERRED, Message.FILE_DONE):
+            self._on_small_file(thread, msg)
+        elif msg.kind in (Message.ABORTED, Message.THREAD_FINISHED, Message.ERROR):
+            self._on_thread_finished(job, thread, msg)
+        elif msg.kind == Message.SEGMENT_STARTED:
+            # a download thread has moved on to the next segment it was given ahead of time
+            self._download_threads[msg.worker_id].private_segment_offset = msg.byte_offset
+            self._download_threads[msg.worker_id].private_next_segment_offset = None
+        elif msg.kind == Message.DL_SPEED_UPDATE:
+            # a new download speed has been calculated, update the worker dl speed fifo
+            self._download_threads[msg.worker_id].private_dl_speed_fifo.insert(0, msg.value)
+            self._download_threads[msg.worker_id].private_dl_speed_fifo.pop(-1)
+            self._kill_policy.on_speed(msg.worker_id, msg.value)
+            # remember the average speed after the thread becomes idle, it sizes the next segment of the worker
+            speeds = [s for s in self._download_threads[msg.worker_id].private_dl_speed_fifo if s > 0]
+            self._download_threads[msg.worker_id].private_recent_dl_speed = sum(speeds) / float(len(speeds))
+        elif msg.kind == Message.THROTTLED:
+            # the download thread waits for the max rate, a slow thread can not be told apart from a throttled one
+            self._throttled[msg.worker_id] = time.time() + msg.value
+        else:
+            raise Exception('Unhandled msg kind "%s"' % msg.kind)
+
+    def _process_events(self, timeout):
+        """ wait for the doorbell, then process every message waiting in the channels of the file writers and the
+            channels of the download threads
 
             Args:
-                remote_path - path to the file to download on the ftp server
+                timeout - maximum number of seconds to wait for the doorbell
+
+            Returns:
+                number of messages processed
+        """
+        if timeout > 0:
+            self._doorbell.wait(timeout)
+        events = 0
+        for job in list(self._jobs):
+            events = events + self._process_channel(job, job.writer_channel)
+        for thread in list(self._download_threads.values()):
+            events = events + self._process_channel(thread.private_job, thread.private_channel_out)
+        return events
+
+    def _start_download_thread(self, job, byte_offset, blocks, worker_id, duplicate_of=None):
+        """ start a download thread to download a segment
+
+            Args:
+                job - _FileJob of the file to download the segment of
                 byte_offset - byte offset into the file to start downloading at
-                blocks - number of blocks to download, see self._blocksize for size of each block
-                worker_id - id of this worker thread, can be and of the characters in the set [0123456789ABCDEF]
+                blocks - number of blocks to download
+                worker_id - id of the download thread
+                duplicate_of - (worker id, segment byte offset) of the download thread whose blocks are being
+                               downloaded again in the end-game, or None
         """
-        # open an ftp connection to the server
-        ftp = self._ftp_connection()
-        with closing(ftp):
-            # switch to FTP binary mode, then initiate a transfer starting at the byte_offset
-            ftp.voidcmd('TYPE I')
-            conn = ftp.transfercmd('retr %s' % remote_path, byte_offset)
-            conn.settimeout(30)
-
-            # loop until the correct amount of data has been transferred
-            bytes_received = 0
-            bytes_since_last_second = 0
-            data = b''
-            t = time.time()
-            while bytes_received < (blocks * blocksize):
-                # check for a message on in the incoming communication queue
-                while not self._com_queue_in.empty():
-                    try:
-                        msg = self._com_queue_in.get_nowait()
-                    except Empty as _:
-                        continue
-                    if msg['type'] == 'kill':
-                        if msg['worker_id'] == worker_id:
-                            new_msg = (time.time(), {'type': 'aborted_high_priority', 'worker_id': worker_id})
-                            self._com_queue_out.put((self.HIGH_PRIORITY_MSG, new_msg))
-                            return
-                        else:
-                            self._com_queue_in.put(msg)
-                    else:
-                        raise Exception('Unhandled incoming message type of "%s"' % msg['type'])
-
-                # receive the data
-                chunk = conn.recv(blocksize * 8)
-
-                # calculate the speed and save it to the FIFO.  new speeds are pushed in at index 0
-                bytes_since_last_second = bytes_since_last_second + len(chunk)
-                if (time.time() - t) > 1.0:
-                    speed = bytes_since_last_second / (time.time() - t)
-                    t = time.time()
-                    bytes_since_last_second = 0
-                    new_msg = (time.time(), {'type': 'dl_speed_update_high_priority', 'worker_id': worker_id,
-                                             'dl_speed': speed})
-                    self._com_queue_out.put((self.HIGH_PRIORITY_MSG, new_msg))
-
-                # save the data
-                if chunk:
-                    data = data + chunk
-
-                # send data if greater than blocksize
-                while (len(data) > blocksize) or not chunk:
-                    block = data[:blocksize]
-                    data = data[blocksize:]
-
-                    # enqueue a high priority data received for quickly update the UI that the block has been downloaded
-                    # and is pending saving
-                    new_msg = (time.time(), {'type': 'data_received_high_priority', 'worker_id': worker_id,
-                                             'byte_offset': byte_offset})
-                    self._com_queue_out.put((self.HIGH_PRIORITY_MSG, new_msg))
-                    # enqueue a low priority data received to actually save the data
-                    new_msg = (time.time(), {'type': 'data_received_low_priority', 'worker_id': worker_id,
-                                             'byte_offset': byte_offset, 'data': block})
-                    self._com_queue_out.put((byte_offset, new_msg))
-                    byte_offset = byte_offset + blocksize
-                    bytes_received = bytes_received + blocksize
-
-                    # stop of EOF
-                    if not chunk:
-                        break
-
-            # set the thread to be idle
-            new_msg = (time.time(), {'type': 'thread_finished_high_priority', 'worker_id': worker_id})
-            self._com_queue_out.put((self.HIGH_PRIORITY_MSG, new_msg))
+        channel_in = Channel()
+        channel_out = Channel(self._doorbell)
+        target = self._tw_ftp_download_segment if self._engine is None else self._engine.download_segment
+        thread = self._new_download_thread(worker_id, target,
+                                           (job.remote_path, job.local_path, byte_offset, blocks, job.blocksize,
+                                            worker_id, channel_in, channel_out, job.buffer_pool), channel_in,
+                                           channel_out)
+        thread.private_job = job
+        thread.private_segment_offset = byte_offset
+        thread.private_duplicate_of = duplicate_of
+        thread.start()
+
+    def _start_small_files_thread(self, files, worker_id):
+        """ start a download thread to fetch a batch of small files
+
+            Args:
+                files - list of (remote_path, local_path, size) of the files, size is None if it is not known yet
+                worker_id - id of the download thread
+        """
+        channel_in = Channel()
+        channel_out = Channel(self._doorbell)
+        target = self._tw_ftp_download_small_files if self._engine is None else self._engine.download_small_files
+        thread = self._new_download_thread(worker_id, target,
+                                           (files, worker_id, channel_in, channel_out), channel_in, channel_out)
+        thread.private_small_files = list(files)
+        thread.start()
+
+    def _steal_segments(self, job, idle_download_workers):
+        """ split the blocks left in the segment of the slowest active download thread of a file and give the back part
+            to an idle download thread, repeat for every idle download thread
+
+            The split is proportional to the speeds of the two threads so that they should finish at the same time.
+            The original thread is told where its segment now ends with a truncate message.
+
+            Args:
+                job - _FileJob of the file
+                idle_download_workers - list of ids of the idle download threads
+
+            Returns:
+                list of ids of the download threads which are still idle
+        """
+        blockmap = job.blockmap
+        while idle_download_workers:
+            candidates = self._stealable_workers(blockmap, self.MIN_STEAL_BLOCKS)
+            if not candidates:
+                break
+            victim = max(candidates, key=lambda w, c=candidates: self._remaining_time(blockmap, w, c))
+            k = idle_download_workers.pop(0)
+
+            # the download thread receives its blocks in order, so the back of its last run of blocks is split off
+            segment = blockmap.get_worker_segments(victim)[-1]
+            victim_speed = self._worker_speed(victim, candidates)
+            keep = int(math.ceil(segment['blocks'] * victim_speed / (victim_speed + self._worker_speed(k, candidates))))
+            keep = min(max(keep, 1), segment['blocks'] - 1)
+            split_byte_offset = segment['byte_offset'] + keep * job.blocksize
+
+            # give the back part to the idle worker, then tell the original worker where to stop
+            blockmap.change_block_range_status(split_byte_offset, segment['blocks'] - keep, k)
+            self._download_threads[victim].private_channel_in.put(Message(Message.TRUNCATE,
+                                                                          byte_offset=split_byte_offset))
+            self._start_download_thread(job, split_byte_offset, segment['blocks'] - keep, k)
+        return idle_download_workers
 
     # --------------------------------------------------
     # Properties
     # --------------------------------------------------
-    @property
-    def concurrent_connections(self):
-        """ return the number of concurrent download connections """
-        return self._concurrent_connections
-
     @property
     def kill_speed(self):
         """ return the speed which if the connection is under will be killed """
         return self._kill_speed
 
     @property
-    def total_dl_speed(self):
-        """ return the total download speed of all the workers """
-        dl_speed = 0
-        for worker_id in self.worker_dl_speeds:
-            dl_speed = dl_speed + (sum(self.worker_dl_speeds[worker_id]) /
-                                   len(self.worker_dl_speeds[worker_id]))
-        return dl_speed
+    def max_rate(self):
+        """ return the maximum total download speed in MB/sec, 0 for no maximum """
+        return self._rate_limiter.rate / 1024 / 1024
 
     @property
-    def worker_dl_speeds(self):
-        """ return an estimate of the current worker download speeds """
-        retval = OrderedDict()
-        for k in self._download_threads.keys():
-            retval[k] = self._download_threads[k].private_dl_speed_fifo
-        return retval
+    def tree_progress(self):
+        """ return the progress of the files being downloaded, a dictionary of files_done, the number of files which
+            have been downloaded or skipped, files_total, and bytes_done, the number of bytes downloaded """
+        bytes_done = self._tree_progress['bytes_done']
+        for job in self._jobs:
+            non_downloaded_blocks, _, total_blocks, blocksize, _ = job.blockmap.get_statistics()
+            bytes_done = bytes_done + (total_blocks - non_downloaded_blocks) * blocksize
+        return {'files_done': self._tree_progress['files_done'], 'files_total': self._tree_progress['files_total'],
+                'bytes_done': bytes_done}
 
     # --------------------------------------------------
     # Methods
@@ -391,7 +873,7 @@ class FtpFileDownloader:
             if worker_id is None or worker_id == k:
                 if self._download_threads[k].private_thread_state == self.ACTIVE:
                     self._download_threads[k].private_thread_state = self.ABORTING
-                    self._com_queue_in.put({'worker_id': k, 'type': 'kill'})
+                    self._download_threads[k].private_channel_in.put(Message(Message.KILL))
 
     @classmethod
     def clean_local_file(cls, remote_path, local_path):
@@ -409,8 +891,14 @@ class FtpFileDownloader:
         if blockmap.is_blockmap_already_exists():
             blockmap.delete_blockmap()
 
+    def close(self):
+        """ close the ftp connections which are kept open to be reused by the next download """
+        FtpDownloadThreads.close(self)
+        if self._engine is not None:
+            self._engine.close()
+
     def download(self, remote_path, local_path):
-        """ download a directory or a file from the ftp server
+        """ download a directory or a file from the ftp server, the files of a directory are downloaded at once
 
             Args:
                 remote_path - path to the remote file
@@ -420,9 +908,9 @@ class FtpFileDownloader:
         if self._abort_download:
             return
 
-        # open an ftp connection to the server, have a special check if the server does not support TLS
+        # get an ftp connection to the server from the pool, have a special check if the server does not support TLS
         try:
-            ftp = self._ftp_connection()
+            ftp = self._connection_pool.acquire()
         except (error_temp, error_perm) as e:
             # show a pretty message if this server does not support AUTH_TLS
             if str(e).startswith('500') and 'TLS' in str(e):
@@ -431,36 +919,21 @@ class FtpFileDownloader:
             else:
                 raise e
 
-        with closing(ftp):
-            # check if this is a directory
-            listing = None
-            try:
-                ftp.cwd(remote_path)
-                listing = ftp.nlst(remote_path.replace('[', r'\['))
-            except (error_temp, error_perm) as _:
-                pass
-
-        # download the file if this is not a directory
-        if listing is None:
-            # this is a file so just download the file
-            self.download_file(remote_path, local_path)
-            return
+        # find every file in the directory tree, and create the local directories
+        files = []
+        try:
+            self._lister.walk(ftp, ftp.pwd(), remote_path, local_path, files)
+            self._lister.save()
 
-        # this is a directory, create it if it does not exist
-        if not os.path.exists(local_path):
-            os.mkdir(local_path)
-
-        # loop through each item in the directory and download it
-        for f in listing:
-            # handle if absolute
-            if f.startswith('/') and f.startswith(remote_path):
-                f = f[len(remote_path):]
-                if f.startswith('/'):
-                    f = f[1:]
-            if f in ['.', '..']:
-                continue
+            # the listings switch the connection to ascii mode, put the connection back the way the pool expects
+            ftp.voidcmd('TYPE I')
+        except all_errors as e:
+            self._connection_pool.discard(ftp)
+            raise e
+        self._connection_pool.release(ftp)
 
-            self.download(os.path.join(remote_path, f), os.path.join(local_path, f))
+        # download the files
+        self._download_files(files)
 
     def download_file(self, remote_path, local_path):
         """ downloads a file from a remote ftp server
@@ -469,61 +942,12 @@ class FtpFileDownloader:
                 remote_path - path to the remote file
                 local_path - file location to save the remote file to
         """
-        # sanity check for local_path if it is a directory
-        if os.path.isdir(local_path):
-            local_path = os.path.join(local_path, os.path.basename(remote_path))
-
-        # clean the file if needed
-        if self._clean:
-            self.clean_local_file(remote_path, local_path)
+        self._download_files([(remote_path, local_path, None)])
 
-        # construct a blockmap, but the blockmap is written to disk until init_blockmap if it does not exist yet
-        blockmap = Blockmap(remote_path, local_path, self._ftp_get_filesize, self._min_blocks_per_segment,
-                            self._max_blocks_per_segment, self._initial_blocksize)
-
-        # exit if this file has already been downloaded
-        if not blockmap.is_blockmap_already_exists() and os.path.exists(local_path):
-            if os.path.getsize(local_path) > 0:
-                return
+    def set_max_rate(self, max_rate):
+        """ change the maximum total download speed, can be called from another thread during the download
 
-        # create the local file if it does not exist
-        if not os.path.exists(local_path):
-            f = open(local_path, 'wb')
-            f.close()
-
-        # initialize the blockmap
-        blockmap.init_blockmap()
-
-        # setup the communication queues
-        self._com_queue_in = Queue()            # from manager to download thread
-        self._com_queue_out = PriorityQueue()   # from download thread to manager
-
-        # loop until file is downloaded and fully saved to disk
-        while not blockmap.is_blockmap_complete():
-            # exit if we are aborting
-            if self._abort_download:
-                return
-
-            throttle = self._com_queue_out.qsize() > self.NUM_QUEUE_MSGS_THROTTLE
-            self._manage_download_threads(blockmap, remote_path, throttle)
-
-            # process all of the high priority messages
-            self._process_high_priority_messages(blockmap)
-
-            # process low priority messages (just process one of them)
-            self._process_low_priority_messages(blockmap, local_path)
-
-            # process all of the high priority messages
-            self._process_high_priority_messages(blockmap)
-
-            # process low priority messages (just process one of them)
-            self._process_low_priority_messages(blockmap, local_path)
-
-            # call the refresh display callback
-            self.on_refresh_display(self, blockmap, remote_path)
-
-            # sleep
-            time.sleep(0.001)
-
-        # clean up the block map
-        blockmap.delete_blockmap()
+            Args:
+                max_rate - maximum total download speed in MB/sec of all of the download connections, 0 for no maximum
+        """
+        self._rate_limiter.set_rate(max_rate * 1024 * 1024)
@@ -0,0 +1,273 @@
+""" lists the directories of an ftp server with MLSD, falling back to LIST, and caches the listings on disk """
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+from ftplib import error_perm
+import json
+import os
+import re
+import time
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+class FtpLister:
+    """ lists the directories of an ftp server, one listing per directory gives the type, size and modify time of
+        every entry, so that the files of a directory tree are found without a round trip per entry
+
+        MLSD is used if the server supports it.  Otherwise the directory is entered with CWD and listed with LIST, and
+        the unix and DOS style lines of the listing are parsed.  An entry whose type is not known from the listing,
+        for example a symbolic link, has a type of None, and the caller lists it to find out if it is a directory.
+
+        Each entry is a tuple of (name, type, size, modify) where type is 'dir', 'file' or None, size is the number
+        of bytes or None, and modify is the modify time as a YYYYMMDDHHMMSS string in UTC for MLSD, or in the time zone
+        of the server for LIST, or None.
+
+        If a cache path is given, the listings are kept in a JSON file and reused by the next run for cache_ttl
+        seconds, so a tree which is downloaded again does not have to be listed again.
+    """
+    # --------------------------------------------------
+    # Constants
+    # --------------------------------------------------
+    CACHE_TTL = 3600.0      # seconds a cached listing is reused for
+    CACHE_VERSION = 1       # version of the format of the listing cache file
+
+    MLSD_FACTS = ['type', 'size', 'modify']
+    NO_MLSD_REPLIES = ('500', '502', '504')     # replies to MLSD from a server which does not support it
+    NOT_A_DIRECTORY_REPLIES = ('501', '550')    # replies to MLSD or CWD for a path which is not a directory
+
+    # -rw-r--r--   1 owner    group    20971570 Oct 17 02:31 name
+    UNIX_LINE = re.compile(r'^([\-dlbcps])\S{9}\S*\s+\d+\s+\S+\s+\S+\s+(\d+)\s+(\w{3})\s+(\d{1,2})\s+'
+                           r'(\d{1,2}:\d\d|\d{4})\s(.*)$')
+    # 10-17-26  02:31AM       <DIR>          name
+    DOS_LINE = re.compile(r'^(\d\d)-(\d\d)-(\d\d(?:\d\d)?)\s+(\d\d):(\d\d)([AP]M)\s+(<DIR>|\d+)\s+(.*)$')
+    MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, cache_path=None, cache_ttl=CACHE_TTL, cache_key=''):
+        """ Initialize the class, the cache file is read if it exists
+
+            Args:
+                cache_path - path of the JSON file the listings are cached in, or None to not cache the listings
+                cache_ttl - seconds a cached listing is reused for
+                cache_key - prefix of the cache keys of the listings, identifies the server and the user so that one
+                            cache file can be shared by several servers
+        """
+        self._cache_path = cache_path
+        self._cache_ttl = cache_ttl
+        self._cache_key = cache_key
+        self._cache = {}            # cache key -> {'time': time listed, 'entries': list of entries or None}
+        self._cache_dirty = False
+        self._mlsd = True           # False once the server has refused MLSD
+        if cache_path is not None:
+            self._load_cache()
+
+    # --------------------------------------------------
+    # Private Functions
+    # --------------------------------------------------
+    def _list_list(self, ftp, home, remote_path):
+        """ list a directory with CWD and LIST
+
+            Args:
+                ftp - ftp connection in the home directory
+                home - directory the ftp connection logged in to, the connection is returned to it after the listing
+                remote_path - path to the remote directory
+
+            Returns:
+                list of entries, or None if remote_path is not a directory
+
+            Raises:
+                the ftplib error of any other failure of the server or the connection
+        """
+        try:
+            ftp.cwd(remote_path)
+        except error_perm as e:
+            if str(e)[0:3] in self.NOT_A_DIRECTORY_REPLIES:
+                return None
+            raise
+
+        # list the current directory, a relative remote_path would be resolved against itself otherwise.  Some
+        # servers refuse to list an empty directory with 550
+        lines = []
+        try:
+            ftp.retrlines('LIST', lines.append)
+        except error_perm as e:
+            if str(e)[0:3] != '550':
+                raise
+            lines = []
+        ftp.cwd(home)
+        return [e for e in [self.parse_list_line(line) for line in lines] if e is not None]
+
+    def _list_mlsd(self, ftp, remote_path):
+        """ list a directory with MLSD
+
+            Args:
+                ftp - ftp connection in the home directory
+                remote_path - path to the remote directory
+
+            Returns:
+                list of entries
+
+            Raises:
+                error_perm if the server does not support MLSD or remote_path is not a directory, or the ftplib error
+                of any other failure of the server or the connection
+        """
+        entries = []
+        for name, facts in ftp.mlsd(remote_path, self.MLSD_FACTS):
+            entry_type = facts.get('type', '').lower()
+            if entry_type in ('cdir', 'pdir') or name in ('.', '..'):
+                continue
+            size = facts.get('size')
+            entries.append((name, entry_type if entry_type in ('dir', 'file') else None,
+                            int(size) if size is not None and size.isdigit() else None,
+                            facts.get('modify', '')[0:14] or None))
+        return entries
+
+    def _load_cache(self):
+        """ read the listings which have not expired from the cache file, a missing or unreadable file is ignored """
+        try:
+            with open(self._cache_path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') != self.CACHE_VERSION:
+                return
+            now = time.time()
+            for k, v in data['listings'].items():
+                if now - v['time'] < self._cache_ttl:
+                    entries = v['entries'] if v['entries'] is None else [tuple(e) for e in v['entries']]
+                    self._cache[k] = {'time': v['time'], 'entries': entries}
+        except (IOError, OSError, ValueError, AttributeError, KeyError, TypeError) as _:
+            self._cache = {}
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def list_dir(self, ftp, home, remote_path):
+        """ list a directory on the ftp server, the cached listing is returned if there is one
+
+            Args:
+                ftp - ftp connection in the home directory, the listing may switch it to ascii mode
+                home - directory the ftp connection logged in to, the connection is returned to it after the listing
+                remote_path - path to the remote directory
+
+            Returns:
+                list of (name, type, size, modify) of the entries of the directory, or None if remote_path is not a
+                directory
+
+            Raises:
+                the ftplib error of a temporary failure of the server or of the connection, or of a reply which does
+                not tell if remote_path is a directory, nothing is cached for a listing which has failed
+        """
+        key = self._cache_key + remote_path
+        cached = self._cache.get(key)
+        if cached is not None and time.time() - cached['time'] < self._cache_ttl:
+            return cached['entries']
+
+        entries = None
+        listed = False
+        if self._mlsd and hasattr(ftp, 'mlsd'):
+            try:
+                entries = self._list_mlsd(ftp, remote_path)
+                listed = True
+            except error_perm as e:
+                # the server does not know MLSD, or this is not a directory
+                if str(e)[0:3] in self.NO_MLSD_REPLIES:
+                    self._mlsd = False
+                elif str(e)[0:3] in self.NOT_A_DIRECTORY_REPLIES:
+                    listed = True
+                else:
+                    raise
+        if not listed:
+            entries = self._list_list(ftp, home, remote_path)
+
+        if self._cache_path is not None:
+            self._cache[key] = {'time': time.time(), 'entries': entries}
+            self._cache_dirty = True
+        return entries
+
+    @classmethod
+    def parse_list_line(cls, line):
+        """ parse a unix or DOS style line of a LIST reply
+
+            Args:
+                line - line of the LIST reply
+
+            Returns:
+                (name, type, size, modify) of the entry, or None if the line is not an entry
+        """
+        m = cls.UNIX_LINE.match(line)
+        if m is not None:
+            kind, size, month, day, time_or_year, name = m.groups()
+            if kind == 'l':
+                name = name.split(' -> ')[0]
+            if name in ('.', '..'):
+                return None
+            modify = None
+            if month.lower() in cls.MONTHS:
+                month = cls.MONTHS.index(month.lower()) + 1
+                if ':' in time_or_year:
+                    # entries from the last six months show the time instead of the year
+                    now = time.gmtime()
+                    year = now.tm_year if (month, int(day)) <= (now.tm_mon, now.tm_mday + 1) else now.tm_year - 1
+                    modify = '%04d%02d%02d%s%s00' % (year, month, int(day), time_or_year[:-3].zfill(2),
+                                                     time_or_year[-2:])
+                else:
+                    modify = '%s%02d%02d000000' % (time_or_year, month, int(day))
+            entry_type = {'d': 'dir', '-': 'file'}.get(kind)
+            return (name, entry_type, int(size) if entry_type == 'file' else None, modify)
+
+        m = cls.DOS_LINE.match(line)
+        if m is not None:
+            month, day, year, hour, minute, am_pm, size, name = m.groups()
+            year = int(year) if len(year) == 4 else 1900 + int(year) + (100 if int(year) < 70 else 0)
+            hour = int(hour) % 12 + (12 if am_pm == 'PM' else 0)
+            modify = '%04d%s%s%02d%s00' % (year, month, day, hour, minute)
+            if size == '<DIR>':
+                return (name, 'dir', None, modify)
+            return (name, 'file', int(size), modify)
+        return None
+
+    def save(self):
+        """ write the listings to the cache file if there is one and a listing has changed, the file is replaced
+            atomically so that a run which is interrupted never leaves a partial cache file """
+        if self._cache_path is None or not self._cache_dirty:
+            return
+        temp_path = self._cache_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'version': self.CACHE_VERSION, 'listings': self._cache}, f)
+        getattr(os, 'replace', os.rename)(temp_path, self._cache_path)
+        self._cache_dirty = False
+
+    def walk(self, ftp, home, remote_path, local_path, files):
+        """ find the files in a directory tree on the ftp server and create the local directories of the tree, each
+            directory is listed once and the listing gives the type and size of its entries
+
+            Args:
+                ftp - ftp connection to list the directories with
+                home - directory the ftp connection logged in to, the connection is returned to it after each listing
+                remote_path - path to the remote file or directory
+                local_path - location to save the remote file or directory to
+                files - list the (remote_path, local_path, size) of each file is appended to, size is None if it
+                        is not known
+        """
+        # check if this is a directory
+        listing = self.list_dir(ftp, home, remote_path)
+
+        # this is a file so just download the file
+        if listing is None:
+            files.append((remote_path, local_path, None))
+            return
+
+        # this is a directory, create it if it does not exist
+        if not os.path.exists(local_path):
+            os.mkdir(local_path)
+
+        # loop through each item in the directory, an item whose type is not known is listed to find out if it is a
+        # directory
+        for name, entry_type, entry_size, _ in listing:
+            if entry_type == 'file':
+                files.append((os.path.join(remote_path, name), os.path.join(local_path, name), entry_size))
+            else:
+                self.walk(ftp, home, os.path.join(remote_path, name), os.path.join(local_path, name), files)
@@ -0,0 +1,267 @@
+""" classes to decide which download connections are killed and reconnected """
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import time
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+class KillPolicy:
+    """ base class of the kill policies, this policy never kills a download connection
+
+        The manager tells the policy when a download connection starts and stops, when data arrives on the connection
+        and which download speeds the connection measures.  Every time the manager checks the download connections it
+        asks the policy which connections to kill, a killed connection is reestablished in the hopes that a faster
+        packet route will be used by the new connection.  Subclasses decide which connections to kill in _select.
+    """
+    # --------------------------------------------------
+    # Constants
+    # --------------------------------------------------
+    EWMA_ALPHA = 0.3        # weight of the newest sample in the moving averages of the speeds and the data gaps
+    SPEED_SAMPLES = 16      # number of the most recent download speeds kept for each download connection
+
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self):
+        """ Initialize the class """
+        self._workers = {}      # worker_id -> statistics of each download connection which has been started
+
+    # --------------------------------------------------
+    # Private Functions
+    # --------------------------------------------------
+    def _ewma(self, average, sample):
+        """ return the moving average updated with a new sample
+
+            Args:
+                average - current moving average, None if there is no sample yet
+                sample - new sample
+        """
+        return sample if average is None else self.EWMA_ALPHA * sample + (1.0 - self.EWMA_ALPHA) * average
+
+    def _select(self, _worker_ids, _now):
+        """ return the ids of the download connections to kill
+
+            Args:
+                _worker_ids - ids of the download connections which may be killed, connections which are waiting for
+                              the buffer budget or the max rate are left out
+                _now - current time in seconds
+        """
+        return []
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def on_data(self, worker_id, now=None):
+        """ notify the policy that data has arrived on a download connection
+
+            Args:
+                worker_id - id of the download connection
+                now - current time in seconds, defaults to time.time()
+        """
+        now = time.time() if now is None else now
+        worker = self._workers.get(worker_id)
+        if worker is None:
+            return
+        # the gap before the first data includes connecting to the server, so it is not part of the average gap
+        if worker['data_events'] > 0:
+            worker['gap'] = self._ewma(worker['gap'], now - worker['last_data'])
+        worker['data_events'] = worker['data_events'] + 1
+        worker['last_data'] = now
+
+    def on_speed(self, worker_id, speed, now=None):
+        """ notify the policy of a download speed measured by a download connection
+
+            Args:
+                worker_id - id of the download connection
+                speed - download speed in bytes/sec
+                now - current time in seconds, defaults to time.time()
+        """
+        worker = self._workers.get(worker_id)
+        if worker is None:
+            return
+        worker['speeds'] = [speed] + worker['speeds'][:self.SPEED_SAMPLES - 1]
+        worker['ewma'] = self._ewma(worker['ewma'], speed)
+        if speed > 0:
+            self.on_data(worker_id, now)
+
+    def select(self, paused=(), now=None):
+        """ return the ids of the download connections to kill
+
+            Args:
+                paused - ids of the download connections which are waiting for the buffer budget or the max rate, they
+                         are not reading from the server so they are not killed, and the wait does not count as a stall
+                now - current time in seconds, defaults to time.time()
+        """
+        now = time.time() if now is None else now
+        for worker_id in paused:
+            if worker_id in self._workers:
+                self._workers[worker_id]['last_data'] = now
+        return self._select([k for k in self._workers if k not in paused], now)
+
+    def start(self, worker_id, now=None):
+        """ notify the policy that a download connection has been started
+
+            Args:
+                worker_id - id of the download connection
+                now - current time in seconds, defaults to time.time()
+        """
+        now = time.time() if now is None else now
+        self._workers[worker_id] = {'start': now, 'last_data': now, 'data_events': 0, 'gap': None, 'speeds': [],
+                                    'ewma': None, 'ramped': False}
+
+    def stop(self, worker_id):
+        """ notify the policy that a download connection has stopped
+
+            Args:
+                worker_id - id of the download connection
+        """
+        self._workers.pop(worker_id, None)
+
+
+class AbsoluteKillPolicy(KillPolicy):
+    """ kill a download connection whose download speeds are all below a fixed speed
+
+        The download speed usually ramps up if the server is far away, so a connection is given warm_up seconds to ramp
+        up, and is only killed once it has measured enough speeds to tell that it is stuck on a very slow packet path.
+    """
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, kill_speed, warm_up=20.0, samples=4):
+        """ Initialize the class
+
+            Args:
+                kill_speed - a download connection whose last samples download speeds are all below this speed in
+                             MB/sec is killed
+                warm_up - number of seconds a download connection is never killed for after it has been started
+                samples - number of download speeds which must all be below the kill_speed
+        """
+        KillPolicy.__init__(self)
+        self._kill_speed = kill_speed
+        self._warm_up = warm_up
+        self._samples = samples
+
+    # --------------------------------------------------
+    # Private Functions
+    # --------------------------------------------------
+    def _select(self, worker_ids, now):
+        """ return the ids of the download connections to kill, see KillPolicy._select """
+        retval = []
+        for worker_id in worker_ids:
+            worker = self._workers[worker_id]
+            speeds = worker['speeds'][:self._samples]
+            if now - worker['start'] > self._warm_up and len(speeds) == self._samples and 0 not in speeds:
+                if max(speeds) / 1024 / 1024 < self._kill_speed:
+                    retval.append(worker_id)
+        return retval
+
+
+class RelativeKillPolicy(KillPolicy):
+    """ kill a download connection which is much slower than the other download connections, or which has stalled
+
+        The speed of each download connection is estimated with an exponentially weighted moving average of the speeds
+        it measures.  A connection whose estimate is below fraction of the median estimate of the connections is
+        killed, so no absolute speed has to be tuned for each server.  Only the slowest such connection is killed at a
+        time, and the median is only used once there are at least min_workers connections to compare with.
+
+        A connection has stalled when no data has arrived for stall_factor times the average gap between the arrivals
+        of its data, but at least stall_seconds.  A fast connection reports data many times per second, so a stall is
+        detected in less than a second instead of waiting for the timeout of the socket.
+
+        The warm-up is adapted to how long the connections take to ramp up.  A connection has ramped up once its
+        download speed stops growing, and new connections are not compared with the median until ramp_margin times
+        the average ramp-up time has passed.  Until the first connection has ramped up the warm-up is max_warm_up.
+    """
+    # --------------------------------------------------
+    # Constants
+    # --------------------------------------------------
+    RAMP_GROWTH = 0.1       # a download connection has ramped up once its speed grows by less than this fraction
+    MIN_GAPS = 3            # number of data gaps to average before a download connection can stall
+
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, fraction=0.3, stall_seconds=0.5, min_workers=3, min_warm_up=1.0, max_warm_up=20.0,
+                 stall_factor=4.0, ramp_margin=2.0):
+        """ Initialize the class
+
+            Args:
+                fraction - a download connection slower than this fraction of the median download connection is killed
+                stall_seconds - minimum number of seconds without data before a download connection has stalled
+                min_workers - minimum number of download connections with a speed estimate before the median is used
+                min_warm_up - minimum number of seconds a download connection is not compared with the median for
+                max_warm_up - maximum number of seconds a download connection is not compared with the median for, or
+                              waits for its first data before it has stalled
+                stall_factor - a download connection has stalled when no data has arrived for this many times the
+                               average gap between the arrivals of its data
+                ramp_margin - the warm-up is this many times the average time the download connections take to ramp up
+        """
+        KillPolicy.__init__(self)
+        self._fraction = fraction
+        self._stall_seconds = stall_seconds
+        self._min_workers = max(1, min_workers)
+        self._min_warm_up = min_warm_up
+        self._max_warm_up = max(min_warm_up, max_warm_up)
+        self._stall_factor = stall_factor
+        self._ramp_margin = ramp_margin
+        self._ramp_time = None      # moving average of the seconds the download connections took to ramp up
+
+    # --------------------------------------------------
+    # Private Functions
+    # --------------------------------------------------
+    def _select(self, worker_ids, now):
+        """ return the ids of the download connections to kill, see KillPolicy._select """
+        # kill the download connections which have stalled
+        retval = []
+        for worker_id in worker_ids:
+            worker = self._workers[worker_id]
+            if worker['data_events'] > self.MIN_GAPS:
+                stall_seconds = max(self._stall_seconds, self._stall_factor * worker['gap'])
+                if now - worker['last_data'] > stall_seconds:
+                    retval.append(worker_id)
+            elif now - worker['last_data'] > self._max_warm_up:
+                retval.append(worker_id)
+
+        # kill the slowest download connection which has warmed up if it is much slower than the median
+        estimates = sorted((self._workers[k]['ewma'], k) for k in worker_ids
+                           if self._workers[k]['ewma'] is not None and k not in retval)
+        if len(estimates) >= self._min_workers:
+            median = estimates[len(estimates) // 2][0]
+            if len(estimates) % 2 == 0:
+                median = (median + estimates[len(estimates) // 2 - 1][0]) / 2.0
+            for estimate, worker_id in estimates:
+                if estimate >= self._fraction * median:
+                    break
+                if now - self._workers[worker_id]['start'] > self.warm_up:
+                    retval.append(worker_id)
+                    break
+        return retval
+
+    # --------------------------------------------------
+    # Properties
+    # --------------------------------------------------
+    @property
+    def warm_up(self):
+        """ return the number of seconds a new download connection is not compared with the median for """
+        if self._ramp_time is None:
+            return self._max_warm_up
+        return min(self._max_warm_up, max(self._min_warm_up, self._ramp_margin * self._ramp_time))
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def on_speed(self, worker_id, speed, now=None):
+        """ notify the policy of a download speed measured by a download connection, see KillPolicy.on_speed """
+        now = time.time() if now is None else now
+        worker = self._workers.get(worker_id)
+        if worker is None:
+            return
+
+        # the download connection has ramped up once its speed stops growing
+        if not worker['ramped'] and worker['speeds'] and 0 < speed <= worker['speeds'][0] * (1.0 + self.RAMP_GROWTH):
+            worker['ramped'] = True
+            self._ramp_time = self._ewma(self._ramp_time, now - worker['start'])
+        KillPolicy.on_speed(self, worker_id, speed, now)
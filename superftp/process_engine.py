@@ -0,0 +1,565 @@
+""" download engine which spreads the download connections over worker processes so that TLS decryption scales
+    across cores """
+# DISABLE - Access to a protected member %s of a client class, the worker processes run the download threads of an
+# FtpFileDownloader of their own
+# pylint: disable=W0212
+
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import itertools
+import multiprocessing
+from multiprocessing.connection import wait
+import sys
+from threading import Event, Lock, Thread
+# disable pylint for relative-import below, no way to make it work with sphinx and nosetests and comply with pylint
+
+if sys.version_info >= (3, 0):
+    from .blockmap import Blockmap
+    from .block_buffer_pool import BlockBufferPool, BufferBudget
+    from .channels import Channel, Doorbell, Message
+    from .file_writer import FileWriter
+    from .rate_limiter import TokenBucket
+else:
+    from blockmap import Blockmap                               # pylint: disable=E0401
+    from block_buffer_pool import BlockBufferPool, BufferBudget   # pylint: disable=E0401
+    from channels import Channel, Doorbell, Message               # pylint: disable=E0401
+    from file_writer import FileWriter                          # pylint: disable=E0401
+    from rate_limiter import TokenBucket                        # pylint: disable=E0401
+
+
+# --------------------------------------------------
+#    Constants
+# --------------------------------------------------
+TERMINAL_KINDS = (Message.ABORTED, Message.THREAD_FINISHED, Message.ERROR)
+
+
+# --------------------------------------------------
+#    Worker Process
+# --------------------------------------------------
+def _finish_tasks(tasks, writers, events):
+    """ pass on the terminal messages of the tasks whose blocks have all been saved, so the manager never hands blocks
+        which are still being written to another connection.  After a failed write the blocks are never saved, so the
+        task reports the error instead.  The writer of a file is closed once its last task has finished
+
+        Args:
+            tasks - dictionary of the tasks of the process, see _worker_main
+            writers - dictionary of the file writers of the process, see _worker_main
+            events - sending end of the event pipe to the manager
+    """
+    for task_id in list(tasks.keys()):
+        _, _, local_path, _, pending, msg, _ = tasks[task_id]
+        writer = writers[local_path][0] if local_path is not None else None
+        if msg is None or (pending > 0 and writer.error is None):
+            continue
+        del tasks[task_id]
+        if writer is not None:
+            if writer.error is not None:
+                msg = Message(Message.ERROR, msg.worker_id, value=str(writer.error))
+            writers[local_path][2] = writers[local_path][2] - 1
+            if writers[local_path][2] == 0:
+                _, saved, _, _ = writers.pop(local_path)
+                try:
+                    writer.close()
+                except (IOError, OSError) as e:
+                    msg = Message(Message.ERROR, msg.worker_id, value=str(e))
+                run = saved.get_nowait()
+                while run is not None:
+                    events.send((Message.DATA_SAVED, local_path, run[0], run[1]))
+                    run = saved.get_nowait()
+        events.send((msg.kind, task_id, msg.byte_offset, msg.value))
+
+
+def _forward_saved_runs(tasks, writers, events):
+    """ pass the runs of blocks which the file writers have written on to the manager, and count them off the tasks
+        which received the blocks
+
+        Args:
+            tasks - dictionary of the tasks of the process, see _worker_main
+            writers - dictionary of the file writers of the process, see _worker_main
+            events - sending end of the event pipe to the manager
+    """
+    for local_path, (_, saved, _, owners) in writers.items():
+        run = saved.get_nowait()
+        while run is not None:
+            events.send((Message.DATA_SAVED, local_path, run[0], run[1]))
+            # every write is a single block, so each run is the block of the task which queued it first
+            task_id = owners[run[0]].pop(0)
+            if not owners[run[0]]:
+                del owners[run[0]]
+            if task_id in tasks:
+                tasks[task_id][4] = tasks[task_id][4] - 1
+            run = saved.get_nowait()
+
+
+def _forward_task_messages(task_id, task, writers, events):
+    """ process the messages of a download thread, the received blocks are queued to the file writer of the file and
+        the terminal message is held in the task until the blocks have been saved
+
+        Args:
+            task_id - id of the task
+            task - list of the task, see _worker_main
+            writers - dictionary of the file writers of the process, see _worker_main
+            events - sending end of the event pipe to the manager
+    """
+    channel_in, channel_out, local_path, buffer_pool, _, _, _ = task
+    msg = channel_out.get_nowait() if task[5] is None else None
+    while msg is not None:
+        if msg.kind == Message.DATA_RECEIVED and task[6] is not None:
+            # the download thread has been stopped after a failed write, the blocks it still sends are dropped
+            buffer_pool.release(msg.data)
+        elif msg.kind == Message.DATA_RECEIVED:
+            try:
+                writers[local_path][0].write(msg.byte_offset, [(msg.data, msg.length)])
+                writers[local_path][3].setdefault(msg.byte_offset, []).append(task_id)
+                task[4] = task[4] + 1
+            except (IOError, OSError) as e:
+                # the file can not be written, so the download thread is stopped and reports the error
+                buffer_pool.release(msg.data)
+                channel_in.put(Message(Message.KILL))
+                task[6] = Message(Message.ERROR, msg.worker_id, value=str(e))
+        elif msg.kind == Message.DATA_SAVED:
+            # a download thread with zero copy has written the block itself
+            events.send((Message.DATA_SAVED, local_path, msg.byte_offset, msg.value))
+        elif msg.kind in TERMINAL_KINDS:
+            # the terminal message is held until the blocks of the task have been saved
+            task[5] = task[6] or msg
+            return
+        else:
+            events.send((msg.kind, task_id, msg.byte_offset, msg.value))
+        msg = channel_out.get_nowait()
+
+
+def _start_task(downloader, task, tasks, writers, buffer_pools, buffer_budget, doorbell, fsync):
+    """ start the download thread of a task, the blocks of a segment are written by the file writer of the process
+        for the file, which is started by the first task of the file
+
+        Args:
+            downloader - FtpFileDownloader of the process
+            task - (task id, target, args) of the start command
+            tasks - dictionary of the tasks of the process, see _worker_main
+            writers - dictionary of the file writers of the process, see _worker_main
+            buffer_pools - dictionary of the buffer pools of the process, see _worker_main
+            buffer_budget - BufferBudget shared by the buffer pools
+            doorbell - Doorbell of the main loop of the process
+            fsync - fsync the local files before the runs of blocks are reported as written
+    """
+    task_id, target, args = task
+    channel_in = Channel()
+    channel_out = Channel(doorbell)
+    if target == ProcessEngine.download_segment:
+        remote_path, local_path, byte_offset, blocks, blocksize, worker_id = args
+        if blocksize not in buffer_pools:
+            buffer_pools[blocksize] = BlockBufferPool(blocksize, budget=buffer_budget)
+        if local_path not in writers:
+            saved = Channel(doorbell)
+
+            def on_saved(byte_offset, blocks):
+                """ called from the file writer thread once a run of blocks has been written to disk """
+                saved.put((byte_offset, blocks))
+            writers[local_path] = [FileWriter(local_path, buffer_pools[blocksize], on_saved, fsync), saved, 0, {}]
+        writers[local_path][2] = writers[local_path][2] + 1
+        tasks[task_id] = [channel_in, channel_out, local_path, buffer_pools[blocksize], 0, None, None]
+        thread = Thread(target=downloader._tw_ftp_download_segment,
+                        args=(remote_path, local_path, byte_offset, blocks, blocksize, worker_id, channel_in,
+                              channel_out, buffer_pools[blocksize]))
+    else:
+        files, worker_id = args
+        tasks[task_id] = [channel_in, channel_out, None, None, 0, None, None]
+        thread = Thread(target=downloader._tw_ftp_download_small_files,
+                        args=(files, worker_id, channel_in, channel_out))
+    thread.daemon = True
+    thread.start()
+
+
+def _tw_receive_commands(commands, inbox):
+    """ thread worker of a worker process which passes the commands from the manager to the main loop of the process
+
+        Args:
+            commands - receiving end of the command pipe from the manager
+            inbox - Channel the commands are put into
+    """
+    while True:
+        try:
+            command = commands.recv()
+        except (EOFError, OSError) as _:
+            command = ('stop', )
+        inbox.put(command)
+        if command[0] == 'stop':
+            return
+
+
+def _worker_main(commands, events, settings):
+    """ main function of a worker process
+
+        The worker process runs the download threads of an FtpFileDownloader of its own, on connections it owns.  The
+        blocks its download threads receive are written to the local file by a FileWriter of the process, and only the
+        runs of blocks which have been written, the speed samples and the state changes of the download threads are
+        sent back to the manager.
+
+        Args:
+            commands - receiving end of the command pipe from the manager
+            events - sending end of the event pipe to the manager
+            settings - dictionary of the constructor arguments of the FtpFileDownloader of the process, and of
+                       downloader_class, max_buffer_bytes, fsync and the rate_limiter shared by the processes
+    """
+    downloader_class = settings.pop('downloader_class')
+    max_buffer_bytes = settings.pop('max_buffer_bytes')
+    fsync = settings.pop('fsync')
+    rate_limiter = settings.pop('rate_limiter')
+    downloader = downloader_class(**settings)
+    downloader._rate_limiter = rate_limiter
+    doorbell = Doorbell()
+    inbox = Channel(doorbell)
+    receiver = Thread(target=_tw_receive_commands, args=(commands, inbox))
+    receiver.daemon = True
+    receiver.start()
+
+    buffer_pools = {}       # blocksize -> BlockBufferPool, the pools share the buffer budget of the process
+    buffer_budget = BufferBudget(max_buffer_bytes)
+    tasks = {}              # task id -> [channel_in, channel_out, local_path or None, buffer_pool or None, number of
+    #                         blocks queued to the writer which have not been saved yet, held terminal Message or None,
+    #                         ERROR Message of a failed write or None]
+    writers = {}            # local_path -> [FileWriter, Channel of saved runs, number of tasks writing to the file,
+    #                         byte_offset -> list of the ids of the tasks whose copies of the block are queued]
+    standby_connections = 0
+    stopping = False
+    while not stopping:
+        doorbell.wait(0.1)
+
+        # commands from the manager
+        command = inbox.get_nowait()
+        while command is not None:
+            if command[0] == 'start':
+                _start_task(downloader, command[1:], tasks, writers, buffer_pools, buffer_budget, doorbell, fsync)
+            elif command[0] == 'control':
+                _, task_id, kind, byte_offset, value = command
+                if task_id in tasks:
+                    tasks[task_id][0].put(Message(kind, byte_offset=byte_offset, value=value))
+            elif command[0] == 'prewarm':
+                standby_connections = command[1]
+            elif command[0] == 'stop':
+                stopping = True
+            command = inbox.get_nowait()
+
+        # messages from the download threads, the received blocks are written here and only reported once saved
+        for task_id, task in tasks.items():
+            _forward_task_messages(task_id, task, writers, events)
+        _forward_saved_runs(tasks, writers, events)
+        _finish_tasks(tasks, writers, events)
+
+        # keep standby connections logged in
+        if standby_connections > 0:
+            downloader._connection_pool.prewarm(standby_connections)
+
+    # stop the download threads which are still running and close the connections of the process
+    for task in tasks.values():
+        task[0].put(Message(Message.KILL))
+    for writer, _, _, _ in writers.values():
+        try:
+            writer.close()
+        except (IOError, OSError) as _:
+            pass
+    downloader.close()
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+class _ProcessTask:
+    """ handle of a download thread which runs in a worker process of the engine, it has the start, is_alive and join
+        methods of a thread so the manager keeps track of it like a download thread """
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, engine, target, args):
+        """ Initialize the class
+
+            Args:
+                engine - ProcessEngine which runs the task
+                target - ProcessEngine.download_segment or ProcessEngine.download_small_files
+                args - arguments of the thread worker function of the target
+        """
+        self.engine = engine
+        self.target = target
+        self.args = args
+        self.channel_in = args[6] if target == ProcessEngine.download_segment else args[2]
+        self.channel_out = args[7] if target == ProcessEngine.download_segment else args[3]
+        self.worker_id = args[5] if target == ProcessEngine.download_segment else args[1]
+        self.local_path = args[1] if target == ProcessEngine.download_segment else None
+        self.process_index = None
+        self.finished = Event()
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def is_alive(self):
+        """ return True if the task has been started and has not finished """
+        return self.process_index is not None and not self.finished.is_set()
+
+    def join(self, timeout=None):
+        """ wait until the task has finished
+
+            Args:
+                timeout - maximum number of seconds to wait, None to wait forever
+        """
+        if self.process_index is not None:
+            self.finished.wait(timeout)
+
+    def start(self):
+        """ start the task in the worker process with the fewest tasks """
+        self.engine.start_task(self)
+
+
+class ProcessEngine:
+    """ runs the download connections in worker processes instead of threads of the manager process
+
+        With TLS every byte is decrypted by the process which owns the connection, so the download threads of one
+        process saturate one core long before the network.  The engine starts one worker process per core, and
+        spreads the download threads over them.  Each worker process owns its connections and writes the blocks it
+        receives straight into the local file with positional writes, so only the runs of blocks which have been
+        written, the speed samples and the state changes of the download threads flow back to the manager over a
+        pipe.  The manager, the blockmap and the scheduling policy are the same as with the thread engine, the runs of
+        blocks which have been written arrive on the writer channel of the file as if the manager had written them.
+
+        The runs of blocks of a segment are passed to the writer channel of the private_job of its task, which the
+        manager sets before the task is started.  The manager does not need a FileWriter of its own for the files.
+
+        The buffers a worker process receives blocks into can not be lent to another process, so max_buffer_mb is
+        divided evenly between the worker processes and each process holds its share to a budget of its own.
+    """
+    # --------------------------------------------------
+    # Constants
+    # --------------------------------------------------
+    RELAY_INTERVAL = 0.05   # seconds between the checks for control messages from the manager to the tasks
+    STOP_TIMEOUT = 5.0      # seconds to wait for a worker process to stop before it is terminated
+
+    # targets of the tasks, used in place of the thread worker functions
+    download_segment = 'segment'
+    download_small_files = 'small_files'
+
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, server_url, port, username, password, enable_tls, small_file_size, downloader_class,
+                 max_buffer_mb=0, fsync=False, zero_copy=False, processes=None, max_rate=0):
+        """ Initialize the class and start the worker processes
+
+            Args:
+                server_url - url to the ftp server
+                port - port number to use for the ftp connection to the server
+                username - username to login to ftp server with
+                password - password to login to ftp server with
+                enable_tls - enable TLS encryption when connecting and downloading from the FTP server
+                small_file_size - a small file larger than this many bytes is handed back to the manager
+                downloader_class - FtpFileDownloader, or a subclass, whose download threads the worker processes run.
+                                   It is passed in so that this module does not import the manager
+                max_buffer_mb - budget in MB for the data which has been received but not written to disk yet,
+                                divided evenly between the worker processes, 0 for no budget
+                fsync - fsync the local files before the runs of blocks are reported as written
+                zero_copy - the download threads of the worker processes move the data straight into the local files,
+                            see FtpFileDownloader
+                processes - number of worker processes, None for one per core
+                max_rate - maximum total download speed in bytes/sec of the worker processes, 0 for no maximum, the
+                           worker processes share a token bucket in shared memory, see rate_limiter
+        """
+        self._processes_count = max(1, processes or multiprocessing.cpu_count())
+        self._settings = {'downloader_class': downloader_class,
+                          'server_url': server_url, 'username': username, 'password': password, 'port': port,
+                          'concurrent_connections': 1, 'enable_tls': enable_tls, 'small_file_size': small_file_size,
+                          'zero_copy': zero_copy,
+                          'durability': Blockmap.DURABILITY_CHECKPOINT if fsync else Blockmap.DURABILITY_NONE,
+                          'max_buffer_bytes': (max_buffer_mb * 1024 * 1024 // self._processes_count
+                                               if max_buffer_mb else None),
+                          'fsync': fsync}
+        self._context = multiprocessing.get_context('spawn')
+        self._rate_limiter = TokenBucket(max_rate, state=self._context.Array('d', 3, lock=False),
+                                         lock=self._context.Lock())
+        self._settings['rate_limiter'] = self._rate_limiter
+        self._processes = [None] * self._processes_count     # [process, command connection, event connection]
+        self._tasks = {}                    # task id -> _ProcessTask
+        self._writer_channels = {}          # local path -> writer Channel of a file which has tasks running
+        self._task_ids = itertools.count()
+        self._standby_connections = 0
+        self._lock = Lock()
+        self._closed = False
+        for i in range(0, self._processes_count):
+            self._start_process(i)
+        self._relay_thread = Thread(target=self._tw_relay)
+        self._relay_thread.daemon = True
+        self._relay_thread.start()
+
+    # --------------------------------------------------
+    # Private Functions
+    # --------------------------------------------------
+    def _finish_task(self, task_id, msg):
+        """ pass the terminal message of a task to the manager and forget the task
+
+            Args:
+                task_id - id of the task
+                msg - ABORTED, THREAD_FINISHED or ERROR Message
+        """
+        with self._lock:
+            task = self._tasks.pop(task_id, None)
+            # the worker process sends the last runs of blocks of a file before the terminal message of its last task
+            if (task is not None and task.local_path is not None and
+                    not any(t.local_path == task.local_path for t in self._tasks.values())):
+                self._writer_channels.pop(task.local_path, None)
+        if task is not None:
+            task.finished.set()
+            task.channel_out.put(msg)
+
+    def _process_died(self, index):
+        """ report an error for every task of a worker process which has died, the process is restarted by the next
+            task which is given to it
+
+            Args:
+                index - index of the worker process
+        """
+        with self._lock:
+            self._processes[index] = None
+            task_ids = [k for k in self._tasks if self._tasks[k].process_index == index]
+        for task_id in task_ids:
+            self._finish_task(task_id, Message(Message.ERROR, self._tasks[task_id].worker_id,
+                                               value='worker process %d died' % index))
+
+    def _send(self, index, command):
+        """ send a command to a worker process, a worker process which has died is reported by the relay thread
+
+            Args:
+                index - index of the worker process
+                command - command tuple
+        """
+        with self._lock:
+            if self._processes[index] is None:
+                return
+            try:
+                self._processes[index][1].send(command)
+            except (EOFError, OSError) as _:
+                pass
+
+    def _start_process(self, index):
+        """ start a worker process
+
+            Args:
+                index - index of the worker process
+        """
+        command_recv, command_send = self._context.Pipe(False)
+        event_recv, event_send = self._context.Pipe(False)
+        process = self._context.Process(target=_worker_main, args=(command_recv, event_send, dict(self._settings)))
+        process.daemon = True
+        process.start()
+        command_recv.close()
+        event_send.close()
+        self._processes[index] = [process, command_send, event_recv]
+        if self._standby_connections > 0:
+            command_send.send(('prewarm', self._standby_connections))
+
+    def _tw_relay(self):
+        """ thread worker which passes the events of the worker processes to the channels of the tasks and the files,
+            and the control messages of the tasks to their worker processes """
+        while not self._closed:
+            # events from the worker processes
+            with self._lock:
+                connections = dict((p[2], i) for i, p in enumerate(self._processes) if p is not None)
+            for connection in wait(list(connections.keys()), self.RELAY_INTERVAL):
+                try:
+                    kind, key, byte_offset, value = connection.recv()
+                except (EOFError, OSError) as _:
+                    if not self._closed:
+                        self._process_died(connections[connection])
+                    continue
+                if kind == Message.DATA_SAVED:
+                    writer_channel = self._writer_channels.get(key)
+                    if writer_channel is not None:
+                        writer_channel.put(Message(Message.DATA_SAVED, byte_offset=byte_offset, value=value))
+                    continue
+                task = self._tasks.get(key)
+                if task is None:
+                    continue
+                msg = Message(kind, task.worker_id, byte_offset, value=value)
+                if kind in TERMINAL_KINDS:
+                    self._finish_task(key, msg)
+                else:
+                    task.channel_out.put(msg)
+
+            # control messages from the manager to the tasks
+            with self._lock:
+                tasks = list(self._tasks.items())
+            for task_id, task in tasks:
+                msg = task.channel_in.get_nowait()
+                while msg is not None:
+                    self._send(task.process_index, ('control', task_id, msg.kind, msg.byte_offset, msg.value))
+                    msg = task.channel_in.get_nowait()
+
+    # --------------------------------------------------
+    # Properties
+    # --------------------------------------------------
+    @property
+    def rate_limiter(self):
+        """ return the TokenBucket in shared memory which caps the total download speed of the worker processes """
+        return self._rate_limiter
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def close(self):
+        """ stop the worker processes """
+        if self._closed:
+            return
+        self._closed = True
+        for i in range(0, self._processes_count):
+            self._send(i, ('stop', ))
+        for p in self._processes:
+            if p is not None:
+                p[0].join(self.STOP_TIMEOUT)
+                if p[0].is_alive():
+                    p[0].terminate()
+                p[1].close()
+                p[2].close()
+        self._relay_thread.join(self.STOP_TIMEOUT)
+
+    def prewarm(self, count):
+        """ keep count standby connections logged in, spread over the worker processes
+
+            Args:
+                count - number of standby connections
+        """
+        per_process = -(-count // self._processes_count)
+        if per_process != self._standby_connections:
+            self._standby_connections = per_process
+            for i in range(0, self._processes_count):
+                self._send(i, ('prewarm', per_process))
+
+    def start_task(self, task):
+        """ start a task in the worker process with the fewest tasks, a worker process which has died is restarted
+
+            Args:
+                task - _ProcessTask to start
+        """
+        with self._lock:
+            loads = [0] * self._processes_count
+            for t in self._tasks.values():
+                loads[t.process_index] = loads[t.process_index] + 1
+            index = loads.index(min(loads))
+            if self._processes[index] is None:
+                self._start_process(index)
+            task_id = next(self._task_ids)
+            task.process_index = index
+            self._tasks[task_id] = task
+            if task.local_path is not None:
+                self._writer_channels[task.local_path] = task.private_job.writer_channel
+        args = tuple(task.args[0:6] if task.target == self.download_segment else task.args[0:2])
+        self._send(index, ('start', task_id, task.target, args))
+
+    def task(self, target, args):
+        """ return a handle of a download thread which is run in a worker process once it is started
+
+            Args:
+                target - download_segment or download_small_files
+                args - arguments of the thread worker function of the target
+
+            Returns:
+                _ProcessTask with the start, is_alive and join methods of a thread
+        """
+        return _ProcessTask(self, target, args)
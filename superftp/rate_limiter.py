@@ -0,0 +1,120 @@
+""" class to cap the total download speed of the download connections """
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+from threading import Lock
+import time
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+class TokenBucket:
+    """ token bucket shared by the download connections to cap their total download speed
+
+        The bucket fills with rate tokens per second, up to a burst of burst_seconds worth of tokens.  A download
+        connection waits until the bucket is not empty before it reads from its data connection, then takes one token
+        for each byte it has received.  A read may take more tokens than the bucket holds, the bucket then owes the
+        tokens and every connection waits until they have been paid back, so the total download speed is held at the
+        rate no matter how many connections share the bucket.  While a connection waits it does not read from the
+        server, so the server is slowed down by TCP flow control.
+
+        The state of the bucket may be kept in shared memory, so that the download connections of several processes
+        share the bucket.
+    """
+    # --------------------------------------------------
+    # Constants
+    # --------------------------------------------------
+    BURST_SECONDS = 0.1     # seconds of tokens the bucket holds when it is full
+
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, rate=0, burst_seconds=BURST_SECONDS, state=None, lock=None):
+        """ Initialize the class
+
+            Args:
+                rate - maximum total download speed in bytes/sec, 0 for no maximum
+                burst_seconds - seconds of tokens the bucket holds when it is full
+                state - sequence of 3 floats to keep the rate, the tokens and the time of the last refill in, for
+                        example a multiprocessing Array to share the bucket between processes, None to keep them in a
+                        list
+                lock - lock which guards the state, for example a multiprocessing Lock, None for a threading Lock
+        """
+        self._burst_seconds = burst_seconds
+        self._state = state if state is not None else [0.0, 0.0, 0.0]
+        self._lock = lock if lock is not None else Lock()
+        self.set_rate(rate)
+
+    # --------------------------------------------------
+    # Private Functions
+    # --------------------------------------------------
+    def _refill(self, now):
+        """ add the tokens which have arrived since the last refill, the lock must be held
+
+            Args:
+                now - current time in seconds
+        """
+        rate = self._state[0]
+        self._state[1] = min(rate * self._burst_seconds, self._state[1] + (now - self._state[2]) * rate)
+        self._state[2] = now
+
+    # --------------------------------------------------
+    # Properties
+    # --------------------------------------------------
+    @property
+    def limiting(self):
+        """ return True if the rate is holding the download connections back, the bucket has not filled up again since
+            it was last taken from """
+        with self._lock:
+            if self._state[0] <= 0:
+                return False
+            self._refill(time.time())
+            return self._state[1] < self._state[0] * self._burst_seconds
+
+    @property
+    def rate(self):
+        """ return the maximum total download speed in bytes/sec, 0 for no maximum """
+        return self._state[0]
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def consume(self, count):
+        """ take tokens for bytes which have been received, the bucket owes the tokens it does not hold
+
+            Args:
+                count - number of bytes received
+        """
+        if self._state[0] <= 0 or count <= 0:
+            return
+        with self._lock:
+            self._refill(time.time())
+            self._state[1] = self._state[1] - count
+
+    def delay(self):
+        """ return the number of seconds to wait before reading from a data connection, 0 if the bucket is not empty
+        """
+        if self._state[0] <= 0:
+            return 0
+        with self._lock:
+            self._refill(time.time())
+            if self._state[1] > 0:
+                return 0
+            return (1.0 - self._state[1]) / self._state[0]
+
+    def set_rate(self, rate):
+        """ change the maximum total download speed, the download connections follow the new rate straight away
+
+            Args:
+                rate - maximum total download speed in bytes/sec, 0 for no maximum
+        """
+        with self._lock:
+            now = time.time()
+            if self._state[0] > 0:
+                self._refill(now)
+            else:
+                self._state[1] = rate * self._burst_seconds
+            self._state[0] = max(0.0, float(rate))
+            self._state[1] = min(self._state[1], self._state[0] * self._burst_seconds)
+            self._state[2] = now
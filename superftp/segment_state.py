@@ -0,0 +1,320 @@
+""" protocol state of the download threads, shared by the download engines """
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import sys
+import time
+# disable pylint for relative-import below, no way to make it work with sphinx and nosetests and comply with pylint
+
+if sys.version_info >= (3, 0):
+    from .channels import Message
+else:
+    from channels import Message        # pylint: disable=E0401
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+class TransferState:
+    """ protocol state shared by the download threads which download segments and those which fetch small files
+
+        The state waits for the max rate, measures the download speed and tells the manager when the download thread
+        is idle or has failed.
+    """
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, worker_id, rate_limiter, channel_out):
+        """ Initialize the class
+
+            Args:
+                worker_id - id of the download thread
+                rate_limiter - TokenBucket which caps the total download speed
+                channel_out - Channel of messages from the download thread to the manager
+        """
+        self._worker_id = worker_id
+        self._rate_limiter = rate_limiter
+        self._channel_out = channel_out
+        self._bytes_since_last_second = 0
+        self._t = time.time()
+        self.killed = False
+        self.last_data = self._t                                # time the last data was received
+
+    # --------------------------------------------------
+    # Private Functions
+    # --------------------------------------------------
+    def _measure(self, received):
+        """ take data which has been received off the max rate, the manager is sent the download speed about once a
+            second
+
+            Args:
+                received - number of bytes received
+        """
+        self.last_data = time.time()
+        self._rate_limiter.consume(received)
+        self._bytes_since_last_second = self._bytes_since_last_second + received
+        if (self.last_data - self._t) > 1.0:
+            speed = self._bytes_since_last_second / (self.last_data - self._t)
+            self._t = self.last_data
+            self._bytes_since_last_second = 0
+            self._channel_out.put(Message(Message.DL_SPEED_UPDATE, self._worker_id, value=speed))
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def fail(self, e):
+        """ tell the manager that the download thread has ended with an error
+
+            Args:
+                e - the exception which ended the download thread
+        """
+        self._channel_out.put(Message(Message.ERROR, self._worker_id, value=str(e) or repr(e)))
+
+    def finish(self):
+        """ tell the manager that the download thread is idle """
+        self._channel_out.put(Message(Message.ABORTED if self.killed else Message.THREAD_FINISHED, self._worker_id))
+
+    def on_wait(self, reset_speed=False):
+        """ account for a wait during which the data connection was not read, the wait does not count as a stall
+
+            Args:
+                reset_speed - True if the wait does not count towards the download speed either
+        """
+        self.last_data = time.time()
+        if reset_speed:
+            self._t = self.last_data
+            self._bytes_since_last_second = 0
+
+    def stalled(self, timeout):
+        """ return True if no data has been received for more than timeout seconds
+
+            Args:
+                timeout - number of seconds
+        """
+        return time.time() - self.last_data > timeout
+
+    def throttle_delay(self, max_wait):
+        """ return the number of seconds to wait while the download is over the max rate, the manager is told about the
+            wait so that a throttled download thread is not taken for a slow one
+
+            Args:
+                max_wait - maximum number of seconds to wait before the control messages are checked again
+        """
+        delay = min(self._rate_limiter.delay(), max_wait)
+        if delay > 0:
+            self._channel_out.put(Message(Message.THROTTLED, self._worker_id, value=delay))
+        return delay
+
+
+class SegmentState(TransferState):
+    """ protocol state of a download thread which downloads the segments of a file
+
+        The download threads of the manager and the download coroutines of the asyncio engine move the data of a
+        segment in different ways, but follow the same protocol with the manager.  The state applies the control
+        messages from the manager to the segment and to the next segment the thread was given ahead of time, waits for
+        the max rate, measures the download speed and tells when a block is complete, so that the engines only move the
+        data.
+    """
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, worker_id, byte_offset, blocks, blocksize, rate_limiter, channel_out):
+        """ Initialize the class
+
+            Args:
+                worker_id - id of the download thread
+                byte_offset - byte offset into the file of the segment
+                blocks - number of blocks in the segment
+                blocksize - size of each block in bytes
+                rate_limiter - TokenBucket which caps the total download speed
+                channel_out - Channel of messages from the download thread to the manager
+        """
+        TransferState.__init__(self, worker_id, rate_limiter, channel_out)
+        self._blocksize = blocksize
+        self.byte_offset = byte_offset                          # byte offset of the block being received
+        self.end_byte_offset = byte_offset + blocks * blocksize
+        self.filled = 0                                         # number of bytes of the block received so far
+        self.next_segment = None    # [ftp, data connection, byte_offset, end_byte_offset] once it is started
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def finish_block(self):
+        """ move on to the next block once the block has been sent to the manager
+
+            Returns:
+                (byte_offset, length) of the block
+        """
+        retval = (self.byte_offset, self.filled)
+        self.byte_offset = self.byte_offset + self._blocksize
+        self.filled = 0
+        return retval
+
+    def move_to_next_segment(self):
+        """ move on to the next segment once the transfer of the segment has ended, the manager is told unless the
+            download thread has been killed
+
+            Returns:
+                (ftp connection, data connection) of the next segment
+        """
+        ftp, conn, self.byte_offset, self.end_byte_offset = self.next_segment
+        self.next_segment = None
+        self.filled = 0
+        self.last_data = time.time()
+        if not self.killed:
+            self._channel_out.put(Message(Message.SEGMENT_STARTED, self._worker_id, self.byte_offset))
+        return ftp, conn
+
+    def on_control_message(self, msg):
+        """ apply a control message from the manager, a truncate applies to whichever segment holds the new end since
+            the segments never overlap
+
+            Args:
+                msg - Message from the manager
+
+            Returns:
+                (byte_offset, end_byte_offset) of the next segment to start for a next segment message, otherwise None
+        """
+        if msg.kind == Message.KILL:
+            self.killed = True
+        elif msg.kind == Message.TRUNCATE:
+            self.end_byte_offset = min(self.end_byte_offset, msg.byte_offset)
+            if self.next_segment is not None:
+                self.next_segment[3] = min(self.next_segment[3], msg.byte_offset)
+        elif msg.kind == Message.NEXT_SEGMENT:
+            return (msg.byte_offset, msg.byte_offset + msg.value * self._blocksize)
+        else:
+            raise Exception('Unhandled incoming message kind of "%s"' % msg.kind)
+        return None
+
+    def on_received(self, received):
+        """ account for data received into the block, the manager is sent the download speed about once a second
+
+            Args:
+                received - number of bytes received, 0 at the end of the file
+
+            Returns:
+                True if the block is complete, at the end of the file the last block is short
+        """
+        self._measure(received)
+        self.filled = self.filled + received
+        return self.filled == self._blocksize or (received == 0 and self.filled > 0)
+
+    def poll_control_messages(self, channel_in):
+        """ apply the control messages waiting from the manager, a truncate which arrives after a next segment message
+            also applies to the next segment
+
+            Args:
+                channel_in - Channel of control messages from the manager
+
+            Returns:
+                (byte_offset, end_byte_offset) of the next segment to start if the manager sent one, otherwise None
+        """
+        start = end = None
+        msg = channel_in.get_nowait()
+        while msg is not None:
+            next_range = self.on_control_message(msg)
+            if next_range is not None:
+                start, end = next_range
+            elif end is not None and msg.kind == Message.TRUNCATE:
+                end = min(end, msg.byte_offset)
+            msg = channel_in.get_nowait()
+        return None if start is None else (start, end)
+
+    def send_block(self, buf):
+        """ send a complete block to the manager and move on to the next block
+
+            Args:
+                buf - buffer of the block, the buffer now belongs to the manager which passes it to the file writer,
+                      and the writer returns it to the pool once it has been written.  None if the block is already in
+                      the local file
+        """
+        byte_offset, length = self.finish_block()
+        if buf is None:
+            self._channel_out.put(Message(Message.DATA_SAVED, self._worker_id, byte_offset, value=1))
+        else:
+            self._channel_out.put(Message(Message.DATA_RECEIVED, self._worker_id, byte_offset, buf, length))
+
+
+class SmallFilesState(TransferState):
+    """ protocol state of a download thread which fetches a batch of small files one after the other
+
+        Like SegmentState for the segments of a file, the state applies the control messages from the manager, hands
+        the files which are not small back to the manager, waits for the max rate and measures the download speed, so
+        that the engines only move the data.
+    """
+    # --------------------------------------------------
+    # Init
+    # --------------------------------------------------
+    def __init__(self, worker_id, files, small_file_size, rate_limiter, channel_out):
+        """ Initialize the class
+
+            Args:
+                worker_id - id of the download thread
+                files - list of (remote_path, local_path, size) of the files, size is None if it is not known yet
+                small_file_size - a file larger than this many bytes is handed back to the manager
+                rate_limiter - TokenBucket which caps the total download speed
+                channel_out - Channel of messages from the download thread to the manager
+        """
+        TransferState.__init__(self, worker_id, rate_limiter, channel_out)
+        self._files = files
+        self._small_file_size = small_file_size
+
+    # --------------------------------------------------
+    # Methods
+    # --------------------------------------------------
+    def deferred(self, remote_path, local_path, size):
+        """ hand a file back to the manager if it turns out to be too large, or if the server does not report its
+            size, the manager then downloads it in segments
+
+            Args:
+                remote_path - path to the remote file
+                local_path - path of the local file
+                size - size of the remote file in bytes, or None if it is not known
+
+            Returns:
+                True if the file has been handed back
+        """
+        if size is not None and size <= self._small_file_size:
+            return False
+        self._channel_out.put(Message(Message.FILE_DEFERRED, self._worker_id, value=(remote_path, local_path, size)))
+        return True
+
+    def file_done(self, remote_path, local_path, size):
+        """ tell the manager that a file has been fetched and has replaced the local file
+
+            Args:
+                remote_path - path to the remote file
+                local_path - path of the local file
+                size - size of the file in bytes
+        """
+        self._channel_out.put(Message(Message.FILE_DONE, self._worker_id, value=(remote_path, local_path, size)))
+
+    def on_received(self, received):
+        """ account for data of a file which has been received, the manager is sent the download speed about once a
+            second
+
+            Args:
+                received - number of bytes received, 0 at the end of the file
+        """
+        self._measure(received)
+
+    def pending_files(self, channel_in):
+        """ generate the files to fetch, the control messages from the manager are applied before each file and the
+            files which are left once the download thread has been killed are skipped
+
+            Args:
+                channel_in - Channel of control messages from the manager
+
+            Returns:
+                generator of (remote_path, local_path, size) of the files
+        """
+        for f in self._files:
+            msg = channel_in.get_nowait()
+            while msg is not None:
+                if msg.kind == Message.KILL:
+                    self.killed = True
+                msg = channel_in.get_nowait()
+            if self.killed:
+                return
+            yield f
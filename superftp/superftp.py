@@ -12,8 +12,10 @@ from functools import partial
 # disable pylint for relative-import below, no way to make it work with sphinx and nosetests and comply with pylint
 if sys.version_info >= (3, 0):
     from .ftp_file_download_manager import FtpFileDownloader     # pylint: disable=W0403
+    from .kill_policy import RelativeKillPolicy                 # pylint: disable=W0403
 else:
     from ftp_file_download_manager import FtpFileDownloader     # pylint: disable=W0403
+    from kill_policy import RelativeKillPolicy                  # pylint: disable=W0403
 
 
 # --------------------------------------------------
@@ -105,28 +107,39 @@ def _pretty_summary_line(ftp_download_manager, blockmap, remote_filepath):
 
     # display
     s = 'ETA:%-13s %5.1f%%  %0.3fMB/sec  ' % (eta, percent_complete, dl_speed / 1024 / 1024)
+
+    # show the number of files which have been downloaded when a directory is downloaded
+    tree_progress = ftp_download_manager.tree_progress
+    if tree_progress['files_total'] > 1:
+        s = s + '%d/%d files  ' % (tree_progress['files_done'], tree_progress['files_total'])
     s = s + remote_filepath[max(0, len(remote_filepath) - (79 - len(s))):]
 
     # return the pretty representation
     return s
 
 
-def _pretty_dl_speed_fifo(ftp_download_manager, kill_speed):
+def _pretty_dl_speed_fifo(ftp_download_manager, kill_speed, cols=None):
     """ construct a pretty ansi representation of the download fifo speeds
 
         Args:
             ftp_download_manager - ftp_download_manager instance to show summary for
             kill_speed - shwo in red if under this speed in MB/sec
+            cols - if not None, only show as many workers as fit in this many columns
 
         Returns:
             string containing a pretty ansi representation of the download fifo speeds
     """
+    # only show the workers which fit in the window
+    worker_ids = list(ftp_download_manager.worker_dl_speeds.keys())
+    if cols is not None:
+        worker_ids = worker_ids[:max(1, cols // len('[0.000]'))]
+
     # loop over each depth
     s = ''
     last_ansi_color = None
     for y in range(0, ftp_download_manager.SPEED_FIFO_SIZE):
         # loop across the workers
-        for k in ftp_download_manager.worker_dl_speeds.keys():
+        for k in worker_ids:
             # get the speed, we want to show the oldest speed at the top so we traverse in reverse order
             speed = float(ftp_download_manager.worker_dl_speeds[k][::-1][y]) / 1024 / 1024
 
@@ -196,7 +209,7 @@ def _display_full(ftp_download_manager, blockmap, remote_filepath, force_window_
     # show the pretty download speed fifos
     y = 3
     s = s + ANSI_MOVE % (y, 0)
-    s = s + _pretty_dl_speed_fifo(ftp_download_manager, ftp_download_manager.kill_speed)
+    s = s + _pretty_dl_speed_fifo(ftp_download_manager, ftp_download_manager.kill_speed, columns)
     s = s + ANSI_MOVE % (y + ftp_download_manager.SPEED_FIFO_SIZE, 0) + ANSI_CLEAR_REST_OF_LINE
 
     # show the blockmap
@@ -245,15 +258,35 @@ def _run(args):
         Args:
             args - dictionary of arguments passed in from the command line
     """
+    # the relative kill policy replaces the kill speed
+    kill_policy = None
+    if args['kill_policy'] == 'relative':
+        kill_policy = RelativeKillPolicy(args['kill_percent'] / 100.0, args['stall_seconds'])
+
     # create a new ftp downloader
     ftp_downloader = FtpFileDownloader(server_url=args['server'], username=args['username'], password=args['password'],
                                        port=args['port'], concurrent_connections=args['connections'],
                                        min_blocks_per_segment=args['min_blocks_per_segment'],
                                        max_blocks_per_segment=args['max_blocks_per_segment'],
                                        initial_blocksize=args['blocksize'],
-                                       kill_speed=args['kill_speed'],
+                                       kill_speed=args['kill_speed'] if kill_policy is None else 0,
                                        clean=args['clean'],
-                                       enable_tls=args['enable_tls'])
+                                       enable_tls=args['enable_tls'],
+                                       durability=args['durability'],
+                                       endgame_blocks=args['endgame_blocks'],
+                                       auto_connections=args['auto_connections'],
+                                       max_connections=args['max_connections'],
+                                       max_buffer_mb=args['max_buffer_mb'],
+                                       standby_connections=args['standby_connections'],
+                                       pipeline_seconds=args['pipeline_seconds'],
+                                       max_open_files=args['max_open_files'],
+                                       small_file_size=args['small_file_size'],
+                                       listing_cache=args['listing_cache'],
+                                       listing_cache_ttl=args['listing_cache_ttl'],
+                                       engine=args['engine'],
+                                       zero_copy=args['zero_copy'],
+                                       kill_policy=kill_policy,
+                                       max_rate=args['max_rate'])
 
     # download
     ftp_downloader.on_refresh_display = partial(_on_refresh_display, args['display_mode'])
@@ -267,6 +300,8 @@ def _run(args):
         sys.stderr.write('\n' + str(e) + '\n')
         if args['debug']:
             sys.stderr.write(traceback.format_exc())
+    finally:
+        ftp_downloader.close()
 
     sys.stdout.write(ANSI_WHITE + '\n')
     sys.stdout.flush()
@@ -285,11 +320,42 @@ def main():
                         default='.')
 
     parser.add_argument("--port", help="port number to use", type=int, default=21)
-    parser.add_argument("--connections", help="number of concurrent connections to use", type=int, default=4)
+    parser.add_argument("--connections", help=("number of concurrent connections to use, or to start with if " +
+                                               "--auto_connections is set, there is no upper limit"),
+                        type=int, default=4)
+    parser.add_argument("--auto_connections", help=("keep adding connections while the download speed improves, and " +
+                                                    "remove them when it plateaus or the server returns errors"),
+                        action="store_true")
+    parser.add_argument("--max_connections", help="maximum number of connections used by --auto_connections",
+                        type=int, default=32)
+    parser.add_argument("--standby_connections", help=("number of logged in connections kept ready in the " +
+                                                       "background for new download connections"),
+                        type=int, default=0)
+    parser.add_argument("--pipeline_seconds", help=("start the next segment of a connection this many seconds " +
+                                                    "before its current segment ends, 0 to disable"),
+                        type=float, default=0)
     parser.add_argument("--min_blocks_per_segment",
                         help="minimum number of contigous 1MB blocks allocated per connection", type=int, default=8)
     parser.add_argument("--max_blocks_per_segment",
                         help="maximum number of contiguous 1MB blocks per connection", type=int, default=128)
+    parser.add_argument("--max_open_files", help=("number of files of a directory which share the connections " +
+                                                  "and are downloaded at once"),
+                        type=int, default=8)
+    parser.add_argument("--small_file_size", help=("files of this many bytes or less are fetched whole without a " +
+                                                   "blockmap, 0 to disable"),
+                        type=int, default=1024 * 1024)
+    parser.add_argument("--listing_cache", help=("path of a file the directory listings are cached in so that a " +
+                                                 "directory downloaded again is not listed again"),
+                        default=None)
+    parser.add_argument("--listing_cache_ttl", help="seconds a cached directory listing is reused for",
+                        type=float, default=3600)
+    parser.add_argument("--engine", help=("threads to run each connection in its own thread, asyncio to run every " +
+                                          "connection on one event loop, processes to spread the connections over " +
+                                          "one process per core for faster TLS"),
+                        choices=['threads', 'asyncio', 'processes'], default='threads')
+    parser.add_argument("--zero_copy", help=("on Linux move plaintext downloads straight from the connections into " +
+                                             "the files in the kernel with splice"),
+                        action="store_true")
     parser.add_argument("--display_mode", help="quiet, compact, full",
                         default='full')
     parser.add_argument("--clean", help="clean any existing downloaded files", action="store_true")
@@ -297,7 +363,31 @@ def main():
     parser.add_argument("--kill_speed", help=("minimum speed in MB/sec a download thread must average or else it is" +
                                               " killed"),
                         type=float, default=1.0)
+    parser.add_argument("--kill_policy", help=("absolute to kill download threads slower than kill_speed, relative " +
+                                               "to kill download threads much slower than the median thread or " +
+                                               "which have stalled"),
+                        choices=['absolute', 'relative'], default='absolute')
+    parser.add_argument("--kill_percent", help=("with the relative kill policy, percent of the median download speed " +
+                                                "below which a download thread is killed"),
+                        type=float, default=30)
+    parser.add_argument("--stall_seconds", help=("with the relative kill policy, minimum seconds without data before " +
+                                                 "a download thread has stalled"),
+                        type=float, default=0.5)
+    parser.add_argument("--max_rate", help=("maximum total download speed in MB/sec of all of the connections, 0 " +
+                                            "for no limit"),
+                        type=float, default=0)
     parser.add_argument("--enable_tls", help="enable FTP TLS encryption", action="store_true")
+    parser.add_argument("--durability", help=("when to fsync the blockmap used to resume downloads, none, " +
+                                              "checkpoint, or journal"),
+                        choices=['none', 'checkpoint', 'journal'], default='checkpoint')
+    parser.add_argument("--endgame_blocks", help=("when this many blocks or fewer are left, idle connections also " +
+                                                  "download the blocks of the slowest connections, 0 to disable.  " +
+                                                  "Opt-in since the blocks are downloaded twice, which only pays off " +
+                                                  "when a few connections are much slower than the rest"),
+                        type=int, default=0)
+    parser.add_argument("--max_buffer_mb", help=("maximum MB of received data waiting to be written to disk, " +
+                                                 "connections pause while it is reached, 0 for no limit"),
+                        type=int, default=256)
     parser.add_argument("--debug", help="enable debug mode", action="store_true")
 
     args = parser.parse_args()
@@ -0,0 +1,115 @@
+""" tests for the asyncio download engine """
+# DISABLE - Access to a protected member %s of a client class
+# pylint: disable=W0212
+
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import asyncio
+import ftplib
+import unittest
+
+from superftp.async_engine import AsyncEngine, AsyncFtpConnection
+from superftp.block_buffer_pool import BlockBufferPool
+from superftp.channels import Channel, Message
+from superftp.ftp_connection_pool import FtpConnectionPool
+from test_utils import setup_ftp_server, teardown_ftp_server
+
+
+# --------------------------------------------------
+#    Test Classes
+# --------------------------------------------------
+class TestAsyncEngine(unittest.TestCase):
+    """ tests for the asyncio download engine """
+    def setUp(self):
+        self._ftp_thread = None
+        self._com_queue = None
+        self._results_dir = 'results_async_engine'
+        self._test_dir = None
+        (self._com_queue, self._results_dir,
+         self._test_dir, self._ftp_thread) = setup_ftp_server(self._ftp_thread, self._com_queue,
+                                                              self._results_dir)
+        self._loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self._loop.close()
+        teardown_ftp_server(self._ftp_thread, self._com_queue)
+        self._ftp_thread = None
+
+    def test_connection(self):
+        """ tests that a connection can be used for another transfer after a transfer was stopped early """
+        async def run():
+            """ open a connection and start two transfers on it """
+            ftp = await AsyncFtpConnection.open('localhost', 2121, 'user', '12345')
+            self.assertEqual(await ftp.size('testfile.txt'), 20971570)
+            with self.assertRaises(ftplib.error_perm):
+                await ftp.size('nonexist.txt')
+
+            # stop a transfer early, then read the last bytes of the file
+            sock = await ftp.transfer('RETR testfile.txt', 1048576)
+            self.assertTrue(len(await self._loop.sock_recv(sock, 1024)) > 0)
+            sock.close()
+            await ftp.drain(8)
+            sock = await ftp.transfer('RETR testfile.txt', 20971560)
+            data = b''
+            received = await self._loop.sock_recv(sock, 1024)
+            while received:
+                data = data + received
+                received = await self._loop.sock_recv(sock, 1024)
+            sock.close()
+            await ftp.void_response()
+            self.assertEqual(len(data), 10)
+            ftp.close()
+
+            # bad credentials raise the same error as ftplib
+            with self.assertRaises(ftplib.error_perm):
+                await AsyncFtpConnection.open('localhost', 2121, 'user', 'wrong')
+        self._loop.run_until_complete(run())
+
+    def test_validate(self):
+        """ tests that a connection which has waited in the pool of the engine is checked, and replaced if it has been
+            dropped """
+        engine = AsyncEngine('localhost', 2121, 'user', '12345', 0)
+
+        def run(coroutine):
+            """ run a coroutine on the event loop of the engine """
+            return asyncio.run_coroutine_threadsafe(coroutine, engine._loop).result(30)
+        ftp = run(engine._acquire())
+        run(engine._release(ftp))
+        ftp.returned_time = ftp.returned_time - 2 * FtpConnectionPool.VALIDATE_IDLE
+        self.assertTrue(run(engine._acquire()) is ftp)
+
+        # the connection is dropped while it waits in the pool
+        run(engine._release(ftp))
+        ftp.returned_time = ftp.returned_time - 2 * FtpConnectionPool.VALIDATE_IDLE
+        ftp.close()
+        ftp2 = run(engine._acquire())
+        self.assertTrue(ftp2 is not ftp)
+        self.assertEqual(run(ftp2.void_command('NOOP'))[:3], '200')
+        engine.close()
+
+    def test_download_segment(self):
+        """ tests that a segment is received into pool buffers and the connection is reused by the next segment """
+        engine = AsyncEngine('localhost', 2121, 'user', '12345', 1048576)
+        pool = BlockBufferPool(65536)
+        received = []
+        for byte_offset in (0, 20971520 - 65536):
+            channel_in = Channel()
+            channel_out = Channel()
+            task = engine.task(engine.download_segment, ('testfile.txt', None, byte_offset, 2, 65536, '0', channel_in,
+                                                         channel_out, pool))
+            task.start()
+            task.join(30)
+            self.assertFalse(task.is_alive())
+            msg = channel_out.get_nowait()
+            while msg is not None:
+                if msg.kind == Message.DATA_RECEIVED:
+                    received.append((msg.byte_offset, msg.length))
+                    pool.release(msg.data)
+                last = msg
+                msg = channel_out.get_nowait()
+            self.assertEqual(last.kind, Message.THREAD_FINISHED)
+            self.assertEqual(len(engine._idle_connections), 1)
+        self.assertEqual(received, [(0, 65536), (65536, 65536), (20971520 - 65536, 65536), (20971520, 50)])
+        engine.close()
+        self.assertTrue(engine._loop.is_closed())
@@ -0,0 +1,86 @@
+""" tests for the block buffer pool class """
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import threading
+import time
+import unittest
+
+from superftp.block_buffer_pool import BlockBufferPool, BufferBudget
+
+
+# --------------------------------------------------
+#    Test Classes
+# --------------------------------------------------
+class TestBlockBufferPool(unittest.TestCase):
+    """ tests for block buffer pool class """
+    def test_acquire_release(self):
+        """ tests that released buffers are reused instead of allocating new buffers """
+        pool = BlockBufferPool(1024)
+        a = pool.acquire()
+        b = pool.acquire()
+        self.assertEqual(len(a), 1024)
+        self.assertTrue(a is not b)
+        self.assertEqual(pool.allocated, 2)
+
+        # a released buffer is handed out again
+        pool.release(a)
+        self.assertEqual(pool.free, 1)
+        self.assertTrue(pool.acquire() is a)
+        self.assertEqual(pool.free, 0)
+        self.assertEqual(pool.allocated, 2)
+
+    def test_recv_into(self):
+        """ tests that a buffer can be filled in place through a memoryview """
+        pool = BlockBufferPool(8)
+        buf = pool.acquire()
+        view = memoryview(buf)
+        view[0:3] = b'abc'
+        view[3:8] = b'defgh'
+        self.assertEqual(bytes(buf), b'abcdefgh')
+        self.assertEqual(pool.blocksize, 8)
+
+    def test_budget(self):
+        """ tests that acquire blocks while the budget is exhausted until a buffer is released """
+        pool = BlockBufferPool(1024, max_bytes=2048)
+        self.assertEqual(pool.max_buffers, 2)
+        a = pool.acquire()
+        pool.acquire()
+        self.assertEqual(pool.in_use, 2)
+        t = time.time()
+        self.assertTrue(pool.acquire(timeout=0.05) is None)
+        self.assertTrue(time.time() - t >= 0.04)
+
+        # a buffer released from another thread wakes up the waiting thread
+        releaser = threading.Timer(0.05, pool.release, args=(a,))
+        releaser.start()
+        self.assertTrue(pool.acquire(timeout=5) is a)
+        releaser.join()
+        self.assertEqual(pool.in_use, 2)
+        self.assertEqual(pool.allocated, 2)
+
+        # at least one buffer is always allowed
+        self.assertEqual(BlockBufferPool(1024, max_bytes=10).max_buffers, 1)
+
+    def test_shared_budget(self):
+        """ tests that pools of different blocksizes share one budget, and that the buffers waiting in one pool are
+            dropped to make room for the buffers of another pool """
+        budget = BufferBudget(4096)
+        small = BlockBufferPool(1024, budget=budget)
+        large = BlockBufferPool(2048, budget=budget)
+        a = small.acquire()
+        b = small.acquire()
+        large.acquire()
+        self.assertEqual(budget.allocated_bytes, 4096)
+        self.assertTrue(large.exhausted)
+        self.assertTrue(large.acquire(timeout=0.05) is None)
+
+        # one free buffer of the small pool does not make enough room
+        small.release(a)
+        self.assertTrue(large.acquire(timeout=0.05) is None)
+        small.release(b)
+        self.assertFalse(large.exhausted)
+        self.assertEqual(len(large.acquire(timeout=0.05)), 2048)
+        self.assertEqual(small.allocated, 0)
+        self.assertEqual(budget.allocated_bytes, 4096)
+        self.assertTrue(small.exhausted)
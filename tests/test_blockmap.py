@@ -5,9 +5,12 @@
 # --------------------------------------------------
 #    Imports
 # --------------------------------------------------
+import os
+import random
+import re
 import unittest
 
-from superftp.blockmap import Blockmap, BlockmapException
+from superftp.blockmap import Blockmap, BlockmapException, RunIndex
 from test_utils import create_blockmap, create_results_dir
 
 
@@ -43,6 +46,186 @@ class TestBlockmap(unittest.TestCase):
         blockmap.allocate_segments(['0', '1', '2'])
         self._verify_blockmap(blockmap, '00011122')
 
+    def test_allocate_by_speed(self):
+        """ tests that segments are sized in proportion to the speeds of the workers """
+        blockmap = Blockmap('testfile.txt', os.path.join(self._results_dir, 'speed.txt'), lambda _: 1024 * 1024 * 8,
+                            1, 8, 1048576)
+        if blockmap.is_blockmap_already_exists():
+            blockmap.delete_blockmap()
+        blockmap.init_blockmap()
+
+        # worker 0 is three times as fast as worker 1
+        blockmap.allocate_segments(['0', '1'], {'0': 3000, '1': 1000})
+        self._verify_blockmap(blockmap, '00000011')
+
+        # workers without a known speed are treated as average workers
+        blockmap.change_status('0', Blockmap.AVAILABLE)
+        blockmap.change_status('1', Blockmap.AVAILABLE)
+        blockmap.allocate_segments(['0', '1', '2'], {'0': 1000, '1': 0, '2': 1000})
+        self._verify_blockmap(blockmap, '00011122')
+
+        # a busy worker keeps a share of the run for when it is done
+        blockmap.change_status('0', Blockmap.AVAILABLE)
+        blockmap.change_status('1', Blockmap.AVAILABLE)
+        blockmap.change_status('2', Blockmap.AVAILABLE)
+        blockmap.allocate_segments(['0'], {'0': 1000, '1': 3000})
+        self._verify_blockmap(blockmap, '00......')
+        blockmap.delete_blockmap()
+
+    def test_allocate_largest_run(self):
+        """ tests that the largest, leftmost run of available blocks is allocated """
+        blockmap = create_blockmap(self._results_dir, 1024 * 1024 * 16)
+        blockmap.init_blockmap()
+        blockmap.change_block_range_status(1024 * 1024 * 2, 1, Blockmap.DOWNLOADED)
+        blockmap.change_block_range_status(1024 * 1024 * 5, 1, Blockmap.DOWNLOADED)
+        blockmap.change_block_range_status(1024 * 1024 * 9, 1, Blockmap.DOWNLOADED)
+        blockmap.change_block_range_status(1024 * 1024 * 13, 1, Blockmap.DOWNLOADED)
+        self._verify_blockmap(blockmap, '..*..*...*...*..')
+
+        blockmap.allocate_segments(['0'])
+        self._verify_blockmap(blockmap, '..*..*000*...*..')
+        blockmap.allocate_segments(['1'])
+        self._verify_blockmap(blockmap, '..*..*000*111*..')
+        blockmap.change_status('0', Blockmap.AVAILABLE)
+        blockmap.allocate_segments(['2', '3'])
+        self._verify_blockmap(blockmap, '..*..*223*111*..')
+
+    def test_free_run_index(self):
+        """ tests that the free run index matches a scan of the blockmap after random state changes """
+        random.seed(0)
+        blockmap = create_blockmap(self._results_dir, 1024 * 1024 * 200)
+        blockmap.init_blockmap()
+        for _ in range(0, 500):
+            start = random.randint(0, 199)
+            blocks = random.randint(0, 200 - start)
+            status = random.choice([Blockmap.AVAILABLE, Blockmap.DOWNLOADED, Blockmap.SAVING, '0', '1'])
+            blockmap.change_block_range_status(1024 * 1024 * start, blocks, status)
+            if random.random() < 0.1:
+                blockmap.change_status(random.choice(['0', '1']), Blockmap.AVAILABLE)
+            expected = [(m.start(), m.end() - m.start()) for m in re.finditer(r'\.+', str(blockmap))]
+            self.assertEqual(blockmap._free_runs.runs(), expected)
+            if expected:
+                self.assertEqual(blockmap._free_runs.largest(),
+                                 sorted(expected, key=lambda x: (-x[1], x[0]))[0])
+            else:
+                self.assertEqual(blockmap._free_runs.largest(), None)
+
+            # the number of blocks in each state is counted
+            counts = dict((c, str(blockmap).count(c)) for c in Blockmap.STATES if c in str(blockmap))
+            self.assertEqual(blockmap.get_state_counts(), counts)
+            self.assertEqual(blockmap.get_statistics()[0:3], (200 - counts.get(Blockmap.DOWNLOADED, 0),
+                                                              counts.get(Blockmap.AVAILABLE, 0), 200))
+
+            # the blocks allocated to each worker are indexed too
+            for worker_id in ['0', '1']:
+                expected = [(m.start(), m.end() - m.start()) for m in re.finditer(worker_id + '+', str(blockmap))]
+                worker_runs = blockmap._worker_runs.get(int(worker_id, 16))
+                self.assertEqual(worker_runs.runs() if worker_runs else [], expected)
+
+    def test_change_status_worker(self):
+        """ tests that releasing the blocks of a worker only changes the blocks allocated to that worker """
+        blockmap = create_blockmap(self._results_dir, 1024 * 1024 * 12)
+        blockmap.init_blockmap()
+        blockmap.change_block_range_status(1024 * 1024 * 0, 3, '0')
+        blockmap.change_block_range_status(1024 * 1024 * 3, 3, '1')
+        blockmap.change_block_range_status(1024 * 1024 * 6, 3, '0')
+        blockmap.change_block_range_status(1024 * 1024 * 1, 1, Blockmap.SAVING)
+        self._verify_blockmap(blockmap, '0_0111000...')
+
+        # reassign the blocks of worker 0 to worker 2, then release them
+        blockmap.change_status('0', '2')
+        self._verify_blockmap(blockmap, '2_2111222...')
+        self.assertFalse(0 in blockmap._worker_runs)
+        self.assertEqual(blockmap._worker_runs[2].runs(), [(0, 1), (2, 1), (6, 3)])
+        blockmap.change_status('2', Blockmap.AVAILABLE)
+        self._verify_blockmap(blockmap, '._.111......')
+        self.assertEqual(blockmap._free_runs.runs(), [(0, 1), (2, 1), (6, 6)])
+
+    def test_get_state_counts(self):
+        """ tests that the number of blocks in each state is counted """
+        blockmap = create_blockmap(self._results_dir, 1024 * 1024 * 8)
+        blockmap.init_blockmap()
+        self.assertEqual(blockmap.get_state_counts(), {Blockmap.AVAILABLE: 8})
+        blockmap.allocate_segments(['0', '1'])
+        blockmap.change_block_range_status(1024 * 1024 * 0, 1, Blockmap.SAVING)
+        blockmap.change_block_range_status(1024 * 1024 * 3, 1, Blockmap.DOWNLOADED)
+        self._verify_blockmap(blockmap, '_00*11..')
+        self.assertEqual(blockmap.get_state_counts(), {Blockmap.AVAILABLE: 2, Blockmap.DOWNLOADED: 1,
+                                                       Blockmap.SAVING: 1, '0': 2, '1': 2})
+
+        # the counters are rebuilt when the blockmap is loaded again
+        blockmap.checkpoint()
+        blockmap = create_blockmap(self._results_dir, 1024 * 1024 * 8, delete_if_exists=False)
+        self.assertEqual(blockmap.get_state_counts(), {Blockmap.AVAILABLE: 2, Blockmap.DOWNLOADED: 1,
+                                                       Blockmap.SAVING: 1, '0': 2, '1': 2})
+        blockmap.init_blockmap()
+        self.assertEqual(blockmap.get_state_counts(), {Blockmap.AVAILABLE: 7, Blockmap.DOWNLOADED: 1})
+
+    def test_get_block_status(self):
+        """ tests that the status and owner of single blocks, and the segments of a worker, are looked up """
+        blockmap = create_blockmap(self._results_dir, 1024 * 1024 * 8)
+        blockmap.init_blockmap()
+        blockmap.change_block_range_status(1024 * 1024 * 0, 4, '1')
+        blockmap.change_block_range_status(1024 * 1024 * 4, 4, '11')
+        blockmap.change_block_range_status(1024 * 1024 * 1, 1, Blockmap.SAVING)
+        self._verify_blockmap(blockmap, '1_111111')
+        self.assertEqual(blockmap.get_block_status(1024 * 1024 * 0), '1')
+        self.assertEqual(blockmap.get_block_status(1024 * 1024 * 1), Blockmap.SAVING)
+        self.assertEqual(blockmap.get_block_status(1024 * 1024 * 5), '11')
+        self.assertEqual(blockmap.get_worker_segments('1'), [{'byte_offset': 0, 'blocks': 1},
+                                                             {'byte_offset': 1024 * 1024 * 2, 'blocks': 2}])
+        self.assertEqual(blockmap.get_worker_segments('11'), [{'byte_offset': 1024 * 1024 * 4, 'blocks': 4}])
+        self.assertEqual(blockmap.get_worker_segments('2'), [])
+
+        # moving the back of a segment to another worker changes the owner of the blocks
+        blockmap.change_block_range_status(1024 * 1024 * 6, 2, '2')
+        self.assertEqual(blockmap.get_block_status(1024 * 1024 * 6), '2')
+        self.assertEqual(blockmap.get_worker_segments('11'), [{'byte_offset': 1024 * 1024 * 4, 'blocks': 2}])
+
+    def test_many_workers(self):
+        """ tests that blocks can be allocated to more than 16 workers, and that worker ids are not case sensitive """
+        blockmap = create_blockmap(self._results_dir, 1024 * 1024 * 512)
+        blockmap.init_blockmap()
+        worker_ids = [format(k, 'x') for k in range(0, 256)]
+        segments = blockmap.allocate_segments(worker_ids)
+        self.assertEqual(len(segments), 256)
+        counts = blockmap.get_state_counts()
+        for k in worker_ids:
+            self.assertEqual(counts[k], 2)
+
+        # workers which share the last hexadecimal digit are tracked separately
+        self.assertEqual(str(blockmap)[0:8], '00112233')
+        self.assertEqual(str(blockmap)[32:36], '0011')
+        blockmap.change_status('10', Blockmap.AVAILABLE)
+        self.assertEqual(str(blockmap)[0:8], '00112233')
+        self.assertEqual(str(blockmap)[32:36], '..11')
+
+        # worker ids a-f round trip regardless of case
+        blockmap.change_block_range_status(segments['a']['byte_offset'], 1, Blockmap.SAVING)
+        blockmap.change_status('A', Blockmap.AVAILABLE)
+        self.assertFalse('a' in blockmap.get_state_counts())
+        self.assertEqual(str(blockmap)[20:22], '_.')
+
+        # release every worker
+        for k in worker_ids:
+            blockmap.change_status(k, Blockmap.AVAILABLE)
+        self.assertEqual(blockmap.get_state_counts(), {Blockmap.AVAILABLE: 511, Blockmap.SAVING: 1})
+
+    def test_free_run_index_merge_split(self):
+        """ tests that the free run index merges and splits runs """
+        index = RunIndex()
+        index.add(0, 4)
+        index.add(8, 4)
+        self.assertEqual(index.runs(), [(0, 4), (8, 4)])
+        index.add(4, 4)
+        self.assertEqual(index.runs(), [(0, 12)])
+        index.remove(3, 2)
+        self.assertEqual(index.runs(), [(0, 3), (5, 7)])
+        self.assertEqual(index.largest(), (5, 7))
+        index.remove(0, 12)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.largest(), None)
+
     def test_blockmap_bad_local_dir(self):
         """ tests that blockmap raises exception if a directory is passed in as local dir """
         try:
@@ -82,12 +265,130 @@ class TestBlockmap(unittest.TestCase):
         blockmap.change_block_range_status(1024 * 1024 * 0, 4, Blockmap.DOWNLOADED)
         blockmap.change_block_range_status(1024 * 1024 * 2, 4, '1')
         self._verify_blockmap(blockmap, '**1111..')
+        blockmap.checkpoint()
 
         # load the blockmap in again to check it is cleaned
         blockmap = create_blockmap(self._results_dir, 1024 * 1024 * 8, delete_if_exists=False)
         blockmap.init_blockmap()
         self._verify_blockmap(blockmap, '**......')
 
+    def test_blockmap_checkpoint(self):
+        """ tests that the memory mapped blockmap is only flushed to disk on a checkpoint """
+        blockmap = create_blockmap(self._results_dir, 1024 * 1024 * 8)
+        blockmap.init_blockmap()
+        blockmap._checkpoint_interval = 3600
+        blockmap._checkpoint_blocks = 4
+
+        # changes below the block threshold are not checkpointed
+        blockmap.change_block_range_status(1024 * 1024 * 0, 2, Blockmap.DOWNLOADED)
+        self.assertEqual(blockmap._dirty_blocks, 2)
+
+        # reaching the block threshold checkpoints the blockmap to disk
+        blockmap.change_block_range_status(1024 * 1024 * 2, 2, Blockmap.DOWNLOADED)
+        self.assertEqual(blockmap._dirty_blocks, 0)
+
+        # a forced checkpoint flushes the blockmap to disk, and a new blockmap instance sees the changes
+        blockmap.change_block_range_status(1024 * 1024 * 4, 1, '0')
+        blockmap.checkpoint()
+        self.assertEqual(blockmap._dirty_blocks, 0)
+        blockmap2 = create_blockmap(self._results_dir, 1024 * 1024 * 8, delete_if_exists=False)
+        self._verify_blockmap(blockmap2, '****0...')
+
+    def test_blockmap_journal_recovery(self):
+        """ tests that the downloaded blocks are recovered from the journal after a crash """
+        blockmap = create_blockmap(self._results_dir, 1024 * 1024 * 8)
+        blockmap.init_blockmap()
+        blockmap._checkpoint_interval = 3600
+        blockmap._checkpoint_blocks = 100
+        blockmap.change_block_range_status(1024 * 1024 * 0, 2, Blockmap.DOWNLOADED)
+        blockmap.change_block_range_status(1024 * 1024 * 2, 2, '0')
+        blockmap.change_block_range_status(1024 * 1024 * 5, 1, Blockmap.SAVING)
+        blockmap.change_block_range_status(1024 * 1024 * 7, 1, Blockmap.DOWNLOADED)
+        self._verify_blockmap(blockmap, '**00._.*')
+
+        # the snapshot has not been written, but the downloaded blocks are in the journal
+        with open(blockmap._blockmap_path, 'rb') as f:
+            self.assertEqual(f.read()[Blockmap.FILE_HEADER.size:], b'........')
+        with open(blockmap._journal_path, 'rb') as f:
+            self.assertEqual(len(f.read()), Blockmap.JOURNAL_RECORD.size * 2)
+
+        # simulate a crash in the middle of appending a record to the journal, then recover
+        with open(blockmap._journal_path, 'ab') as f:
+            f.write(b'\x01\x02\x03')
+        blockmap2 = create_blockmap(self._results_dir, 1024 * 1024 * 8, delete_if_exists=False)
+        blockmap2.init_blockmap()
+        self._verify_blockmap(blockmap2, '**.....*')
+
+        # recovery checkpoints a new snapshot and truncates the journal
+        with open(blockmap2._blockmap_path, 'rb') as f:
+            self.assertEqual(f.read()[Blockmap.FILE_HEADER.size:], b'**.....*')
+        self.assertEqual(os.path.getsize(blockmap2._journal_path), 0)
+        self.assertFalse(os.path.exists(blockmap2._blockmap_path + '.tmp'))
+        blockmap._close_blockmap()
+
+        # deleting the blockmap deletes the journal
+        blockmap2.delete_blockmap()
+        self.assertFalse(os.path.exists(blockmap2._journal_path))
+
+    def test_blockmap_journal_durability(self):
+        """ tests that the downloaded file is fsync'd before its blocks are journaled, unless durability is none """
+        for durability, expected in ((Blockmap.DURABILITY_NONE, []),
+                                     (Blockmap.DURABILITY_CHECKPOINT, [(b'', 'test.txt')]),
+                                     (Blockmap.DURABILITY_JOURNAL, [(b'', 'test.txt')])):
+            blockmap = create_blockmap(self._results_dir, 1024 * 1024 * 8)
+            blockmap._durability = durability
+            blockmap.init_blockmap()
+            blockmap._checkpoint_interval = 3600
+            blockmap._checkpoint_blocks = 100
+            fsyncs = []
+
+            def fsync_path(path, directory=False, blockmap=blockmap, fsyncs=fsyncs):
+                """ record the journal at the time the file is fsync'd """
+                if not directory:
+                    with open(blockmap._journal_path, 'rb') as f:
+                        fsyncs.append((f.read(), os.path.basename(path)))
+            blockmap._fsync_path = fsync_path
+            blockmap.change_block_range_status(1024 * 1024 * 0, 2, Blockmap.DOWNLOADED)
+            self.assertEqual(fsyncs, expected)
+            blockmap._close_blockmap()
+
+    def test_blockmap_bad_durability(self):
+        """ tests that blockmap raises exception if the durability level is not valid """
+        with self.assertRaises(BlockmapException):
+            Blockmap('testfile.txt', os.path.join(self._results_dir, 'test.txt'), None, durability='sometimes')
+
+    def test_blockmap_format(self):
+        """ tests that the blockmap is saved in the binary format with one state code per block """
+        blockmap = create_blockmap(self._results_dir, 1024 * 1024 * 8)
+        blockmap.init_blockmap()
+        blockmap.change_block_range_status(1024 * 1024 * 1, 2, Blockmap.DOWNLOADED)
+        blockmap.checkpoint()
+
+        with open(blockmap._blockmap_path, 'rb') as f:
+            data = f.read()
+        self.assertEqual(len(data), Blockmap.FILE_HEADER.size + 8)
+        self.assertEqual(Blockmap.FILE_HEADER.unpack_from(data, 0), (Blockmap.FILE_MAGIC, Blockmap.FILE_VERSION,
+                                                                     1024 * 1024, 8))
+        self.assertEqual(data[Blockmap.FILE_HEADER.size:], b'.**.....')
+
+    def test_blockmap_out_of_range(self):
+        """ tests that blockmap raises exception if a block range is outside of the blockmap """
+        blockmap = create_blockmap(self._results_dir, 1024 * 1024 * 8)
+        blockmap.init_blockmap()
+        with self.assertRaises(BlockmapException):
+            blockmap.change_block_range_status(1024 * 1024 * 6, 4, Blockmap.DOWNLOADED)
+
+    def test_blockmap_text_migration(self):
+        """ tests that a blockmap saved in the text format is migrated to the binary format """
+        blockmap = create_blockmap(self._results_dir, 1024 * 1024 * 8)
+        with open(blockmap._blockmap_path, 'w') as f:
+            f.write('1048576\n**1_11..')
+
+        blockmap.init_blockmap()
+        self._verify_blockmap(blockmap, '**......')
+        with open(blockmap._blockmap_path, 'rb') as f:
+            self.assertEqual(f.read(len(Blockmap.FILE_MAGIC)), Blockmap.FILE_MAGIC)
+
     def test_blockmap_init_delete(self):
         """ test blockmaps are initialized correctly """
         # test for a multiple of blocksize, and a non-multiple of block size
@@ -0,0 +1,46 @@
+""" tests for the message channels """
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import threading
+import time
+import unittest
+
+from superftp.channels import Channel, Doorbell, Message
+
+
+# --------------------------------------------------
+#    Test Classes
+# --------------------------------------------------
+class TestChannels(unittest.TestCase):
+    """ tests for channel and doorbell classes """
+    def test_channel(self):
+        """ tests that messages come out of a channel in the order they were put in """
+        channel = Channel()
+        self.assertTrue(channel.get_nowait() is None)
+        channel.put(Message(Message.DATA_SAVED, byte_offset=0, value=2))
+        channel.put(Message(Message.TRUNCATE, byte_offset=8))
+        self.assertEqual(len(channel), 2)
+        msg = channel.get_nowait()
+        self.assertEqual((msg.kind, msg.byte_offset, msg.value), (Message.DATA_SAVED, 0, 2))
+        self.assertEqual(channel.get_nowait().kind, Message.TRUNCATE)
+        self.assertTrue(channel.get_nowait() is None)
+        self.assertEqual(len(channel), 0)
+
+    def test_doorbell(self):
+        """ tests that putting a message into any channel with a doorbell wakes up the consumer """
+        doorbell = Doorbell()
+        channels = [Channel(doorbell), Channel(doorbell)]
+        t = time.time()
+        self.assertFalse(doorbell.wait(0.05))
+        self.assertTrue(time.time() - t >= 0.04)
+
+        # a message put from another thread rings the doorbell
+        producer = threading.Timer(0.05, channels[1].put, args=(Message(Message.THREAD_FINISHED, '1'),))
+        producer.start()
+        self.assertTrue(doorbell.wait(5))
+        producer.join()
+        self.assertEqual(channels[1].get_nowait().worker_id, '1')
+
+        # the doorbell is reset by wait
+        self.assertFalse(doorbell.wait(0.01))
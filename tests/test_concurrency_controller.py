@@ -0,0 +1,77 @@
+""" tests for the concurrency controller class """
+# DISABLE - Access to a protected member %s of a client class
+# pylint: disable=W0212
+
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import unittest
+
+from superftp.concurrency_controller import ConcurrencyController
+
+
+# --------------------------------------------------
+#    Test Classes
+# --------------------------------------------------
+class TestConcurrencyController(unittest.TestCase):
+    """ tests for concurrency controller class """
+    @staticmethod
+    def _run_interval(controller, t, dl_speed):
+        """ feed the controller one interval of a constant download speed, returns the time at the end of the interval
+        """
+        controller.update(dl_speed, t)
+        return t + 1.0
+
+    def test_grow_while_improving(self):
+        """ tests that connections are added while the download speed improves, up to the ceiling """
+        controller = ConcurrencyController(2, 5, interval=1.0)
+        t = 0.0
+        for _ in range(0, 10):
+            t = self._run_interval(controller, t, controller.connections * 1000)
+        self.assertEqual(controller.connections, 5)
+
+    def test_back_off_at_plateau(self):
+        """ tests that the connection which did not improve the speed is removed, and that the plateau is probed """
+        controller = ConcurrencyController(2, 32, interval=1.0, probe_intervals=3)
+        t = 0.0
+
+        # the speed scales with the connections until 4 connections
+        history = []
+        for _ in range(0, 8):
+            t = self._run_interval(controller, t, min(controller.connections, 4) * 1000)
+            history.append(controller.connections)
+        self.assertEqual(history[:6], [2, 3, 4, 5, 4, 4])
+
+        # the controller probes with one more connection after staying at the plateau
+        self.assertTrue(5 in history[6:])
+        self.assertTrue(controller.connections <= 5)
+
+    def test_back_off_on_error(self):
+        """ tests that the number of connections is halved when the server returns errors """
+        controller = ConcurrencyController(8, 32, min_connections=3, interval=1.0)
+        t = self._run_interval(controller, 0.0, 8000)
+        self.assertEqual(controller.connections, 8)
+        controller.on_error()
+        t = self._run_interval(controller, t, 8000)
+        self.assertEqual(controller.connections, 4)
+        controller.on_error()
+        t = self._run_interval(controller, t, 8000)
+        self.assertEqual(controller.connections, 3)
+
+    def test_bounds(self):
+        """ tests that the initial number of connections is kept inside of the floor and ceiling """
+        self.assertEqual(ConcurrencyController(64, 8).connections, 8)
+        self.assertEqual(ConcurrencyController(0, 8).connections, 1)
+        self.assertEqual(ConcurrencyController(4, 8).max_connections, 8)
+
+    def test_time_weighted(self):
+        """ tests that the speed of an interval is weighted by time, not by the number of measurements """
+        controller = ConcurrencyController(2, 8, interval=1.0)
+        controller.update(1000, 0.0)
+
+        # a burst of measurements at the start of the interval, then a long stretch at a higher speed
+        for k in range(1, 100):
+            controller.update(100, k * 0.001)
+        controller.update(1000, 1.0)
+        self.assertAlmostEqual(controller._baseline_speed, 100 * 0.099 + 1000 * 0.901)
+        self.assertEqual(controller.connections, 3)
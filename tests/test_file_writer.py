@@ -0,0 +1,72 @@
+""" tests for the file writer class """
+# DISABLE - Access to a protected member %s of a client class
+# pylint: disable=W0212
+
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import os
+import unittest
+
+from superftp.block_buffer_pool import BlockBufferPool
+from superftp.file_writer import FileWriter
+from test_utils import create_results_dir
+
+
+# --------------------------------------------------
+#    Test Classes
+# --------------------------------------------------
+class TestFileWriter(unittest.TestCase):
+    """ tests for file writer class """
+    def setUp(self):
+        self._results_dir = create_results_dir('results_file_writer')
+        self._local_path = os.path.join(self._results_dir, 'writer.txt')
+        with open(self._local_path, 'wb') as f:
+            f.write(b'.' * 16)
+
+    def _buffers(self, pool, data):
+        """ return a list of (buffer, length) of pool buffers filled with data, one buffer per block """
+        buffers = []
+        for i in range(0, len(data), pool.blocksize):
+            buf = pool.acquire()
+            chunk = data[i:i + pool.blocksize]
+            buf[:len(chunk)] = chunk
+            buffers.append((buf, len(chunk)))
+        return buffers
+
+    def test_write(self):
+        """ tests that runs of blocks are written at their offsets, reported as saved, and the buffers are released """
+        pool = BlockBufferPool(4)
+        saved = []
+        writer = FileWriter(self._local_path, pool, lambda byte_offset, blocks: saved.append((byte_offset, blocks)))
+        writer.write(8, self._buffers(pool, b'ijklmn'))
+        writer.write(0, self._buffers(pool, b'abcd'))
+        writer.write(4, self._buffers(pool, b'efgh'))
+        writer.close()
+
+        with open(self._local_path, 'rb') as f:
+            self.assertEqual(f.read(), b'abcdefghijklmn..')
+        self.assertEqual(sorted(saved), [(0, 1), (4, 1), (8, 2)])
+        self.assertEqual(pool.free, pool.allocated)
+
+    def test_max_iov(self):
+        """ tests that a run with more buffers than MAX_IOV is written with several system calls """
+        pool = BlockBufferPool(4)
+        writer = FileWriter(self._local_path, pool, lambda _byte_offset, _blocks: None)
+        views = [memoryview(b'abcd'), memoryview(b'efgh'), memoryview(b'ij')]
+        writer.MAX_IOV = 1
+        writer._pwritev(2, views)
+        writer.close()
+        with open(self._local_path, 'rb') as f:
+            self.assertEqual(f.read(), b'..abcdefghij....')
+
+    def test_write_error(self):
+        """ tests that a failed write is raised to the caller """
+        pool = BlockBufferPool(4)
+        saved = []
+        writer = FileWriter(self._local_path, pool, lambda byte_offset, blocks: saved.append((byte_offset, blocks)))
+        os.close(writer._fd)
+        writer._fd = os.open(self._local_path, os.O_RDONLY)
+        writer.write(0, self._buffers(pool, b'abcd'))
+        self.assertRaises((IOError, OSError), writer.close)
+        self.assertEqual(saved, [])
@@ -0,0 +1,118 @@
+""" tests for the ftp connection pool class """
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+from ftplib import FTP
+import socket
+import time
+import unittest
+
+from superftp.ftp_connection_pool import FtpConnectionPool
+from test_utils import setup_ftp_server, teardown_ftp_server
+
+
+# --------------------------------------------------
+#    Test Classes
+# --------------------------------------------------
+class TestFtpConnectionPool(unittest.TestCase):
+    """ tests for ftp connection pool class """
+    def setUp(self):
+        self._ftp_thread = None
+        self._com_queue = None
+        self._results_dir = 'results_ftp_connection_pool'
+        self._test_dir = None
+        (self._com_queue, self._results_dir,
+         self._test_dir, self._ftp_thread) = setup_ftp_server(self._ftp_thread, self._com_queue,
+                                                              self._results_dir)
+        self._connects = 0
+
+    def tearDown(self):
+        teardown_ftp_server(self._ftp_thread, self._com_queue)
+        self._ftp_thread = None
+
+    def _connect(self):
+        """ open a new logged in connection to the test ftp server """
+        self._connects = self._connects + 1
+        ftp = FTP()
+        ftp.connect('localhost', 2121)
+        ftp.login('user', '12345')
+        return ftp
+
+    def test_reuse(self):
+        """ tests that a returned connection is reused without logging in again """
+        pool = FtpConnectionPool(self._connect)
+        ftp = pool.acquire()
+        self.assertEqual(ftp.size('testfile.txt'), 20971570)
+        pool.release(ftp)
+        self.assertEqual(pool.idle, 1)
+        self.assertTrue(pool.acquire() is ftp)
+        self.assertEqual(self._connects, 1)
+
+        # connections which waited too long are closed instead of reused
+        pool.release(ftp)
+        pool._idle_timeout = -1
+        ftp2 = pool.acquire()
+        self.assertTrue(ftp2 is not ftp)
+        self.assertTrue(ftp.sock is None)
+        self.assertEqual(self._connects, 2)
+
+        # connections returned after the pool has been closed are closed
+        pool.close()
+        pool.release(ftp2)
+        self.assertTrue(ftp2.sock is None)
+        self.assertEqual(pool.idle, 0)
+
+    def test_validate(self):
+        """ tests that a connection which has waited in the pool is checked, and replaced if it has been dropped """
+        pool = FtpConnectionPool(self._connect, validate_idle=-1)
+        ftp = pool.acquire()
+        pool.release(ftp)
+        self.assertTrue(pool.acquire() is ftp)
+        self.assertEqual(self._connects, 1)
+
+        # the connection is dropped while it waits in the pool
+        pool.release(ftp)
+        ftp.sock.shutdown(socket.SHUT_RDWR)
+        ftp2 = pool.acquire()
+        self.assertTrue(ftp2 is not ftp)
+        self.assertEqual(ftp2.voidcmd('NOOP')[:3], '200')
+        self.assertEqual(self._connects, 2)
+        pool.close()
+
+    def test_abort(self):
+        """ tests that a connection whose transfer was stopped early can be used for another transfer """
+        pool = FtpConnectionPool(self._connect)
+        ftp = pool.acquire()
+        conn = ftp.transfercmd('retr testfile.txt', 1048576)
+        self.assertTrue(len(conn.recv(1024)) > 0)
+        conn.close()
+        pool.release(ftp, abort=True)
+        self.assertEqual(pool.idle, 1)
+
+        # the next transfer on the connection gets its own replies
+        ftp = pool.acquire()
+        conn = ftp.transfercmd('retr testfile.txt', 20971560)
+        data = b''
+        received = conn.recv(1024)
+        while received:
+            data = data + received
+            received = conn.recv(1024)
+        conn.close()
+        self.assertEqual(ftp.voidresp()[:3], '226')
+        self.assertEqual(data, b'.........\n')
+        self.assertEqual(self._connects, 1)
+
+    def test_prewarm(self):
+        """ tests that standby connections are opened in the background """
+        pool = FtpConnectionPool(self._connect)
+        pool.prewarm(2)
+        t = time.time()
+        while pool.idle < 2 and time.time() - t < 5:
+            time.sleep(0.01)
+        self.assertEqual(pool.idle, 2)
+        pool.prewarm(2)
+        time.sleep(0.1)
+        self.assertEqual(self._connects, 2)
+        pool.acquire()
+        self.assertEqual(self._connects, 2)
+        pool.close()
@@ -1,14 +1,23 @@
 """ simple ftp tests """
+# DISABLE - Access to a protected member %s of a client class
+# pylint: disable=W0212
 # --------------------------------------------------
 #    Imports
 # --------------------------------------------------
 import filecmp
 import os
 import shutil
+import socket
 import ftplib
+import threading
+import time
 import unittest
 
-from superftp.ftp_file_download_manager import FtpFileDownloader
+from superftp.blockmap import Blockmap
+from superftp.block_buffer_pool import BlockBufferPool
+from superftp.channels import Channel, Doorbell, Message
+from superftp.ftp_file_download_manager import FtpFileDownloader, _FileJob
+from superftp.kill_policy import RelativeKillPolicy
 from test_utils import setup_ftp_server, teardown_ftp_server
 
 
@@ -49,6 +58,286 @@ class TestFTPFileDownloadManager(unittest.TestCase):
         self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'testfile.txt'),
                                     os.path.join(self._results_dir, 'testfile.txt'), shallow=False))
 
+        # the connections of finished segments are kept for the next segments and the next download
+        self.assertTrue(0 < ftp._connection_pool.idle <= 5)
+        ftp.close()
+        self.assertEqual(ftp._connection_pool.idle, 0)
+
+    def test_many_connections(self):
+        """ test the download of a file using more than 16 concurrent connections """
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=64, min_blocks_per_segment=1, max_blocks_per_segment=2,
+                                initial_blocksize=65536, kill_speed=0, clean=True)
+        ftp.download_file('testfile.txt', self._results_dir)
+        self.assertEqual(len(ftp.worker_dl_speeds), 64)
+        self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'testfile.txt'),
+                                    os.path.join(self._results_dir, 'testfile.txt'), shallow=False))
+
+    def test_steal_segments(self):
+        """ test that the back of the segment of the slowest worker is given to an idle worker """
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=3, min_blocks_per_segment=1, max_blocks_per_segment=16,
+                                initial_blocksize=1048576, kill_speed=0, clean=True)
+        local_path = os.path.join(self._results_dir, 'steal.txt')
+        FtpFileDownloader.clean_local_file('steal.txt', local_path)
+        blockmap = Blockmap('steal.txt', local_path, lambda _: 1048576 * 12, 1, 8, 1048576)
+        blockmap.init_blockmap()
+        blockmap.change_block_range_status(0, 4, '0')
+        blockmap.change_block_range_status(1048576 * 4, 8, '1')
+
+        # worker 0 is three times as fast as worker 1, so worker 1 has the most time left
+        started = []
+        ftp._start_download_thread = lambda *args: started.append(args)
+        for k, speed in (('0', 3000), ('1', 1000)):
+            ftp._download_threads[k].private_thread_state = FtpFileDownloader.ACTIVE
+            ftp._download_threads[k].private_dl_speed_fifo = [speed] * FtpFileDownloader.SPEED_FIFO_SIZE
+        ftp._download_threads['1'].private_segment_offset = 1048576 * 4
+        job = _FileJob('steal.txt', local_path, blockmap, None, None, Channel())
+
+        # the idle worker is assumed to be as fast as the average worker, twice as fast as worker 1, so it gets two
+        # thirds of the blocks
+        self.assertEqual(ftp._steal_segments(job, ['2']), [])
+        self.assertEqual(str(blockmap), '000011122222')
+        self.assertEqual(started, [(job, 1048576 * 7, 5, '2')])
+        msg = ftp._download_threads['1'].private_channel_in.get_nowait()
+        self.assertEqual((msg.kind, msg.byte_offset), (Message.TRUNCATE, 1048576 * 7))
+        blockmap.delete_blockmap()
+
+    def test_endgame_download(self):
+        """ test the download of a file with large segments which are split between workers, and with duplicate
+            downloads of the last blocks """
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=4, min_blocks_per_segment=1, max_blocks_per_segment=128,
+                                initial_blocksize=65536, kill_speed=0, clean=True, endgame_blocks=32)
+
+        # record the duplicate downloads which are started
+        duplicates = []
+        start_download_thread = ftp._start_download_thread
+
+        def on_start_download_thread(job, byte_offset, blocks, worker_id, duplicate_of=None):
+            """ record the duplicate downloads """
+            if duplicate_of is not None:
+                duplicates.append(duplicate_of)
+            start_download_thread(job, byte_offset, blocks, worker_id, duplicate_of)
+        ftp._start_download_thread = on_start_download_thread
+
+        # the first download thread never receives any data, so the back of its segment is stolen and the rest of its
+        # segment is downloaded again by another thread, then the stalled thread is cancelled
+        stalled = []
+        download_segment = ftp._tw_ftp_download_segment
+
+        def on_download_segment(*args):
+            """ stall the first download thread until it is killed, and record the control messages it receives """
+            if stalled:
+                return download_segment(*args)
+            worker_id, channel_in, channel_out = args[5:8]
+            stalled.append(worker_id)
+            t = time.time()
+            while Message.KILL not in stalled and time.time() - t < 30:
+                time.sleep(0.01)
+                msg = channel_in.get_nowait()
+                while msg is not None:
+                    stalled.append(msg.kind)
+                    msg = channel_in.get_nowait()
+            channel_out.put(Message(Message.ABORTED, worker_id))
+            return None
+        ftp._tw_ftp_download_segment = on_download_segment
+        ftp.download_file('testfile.txt', self._results_dir)
+        self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'testfile.txt'),
+                                    os.path.join(self._results_dir, 'testfile.txt'), shallow=False))
+        self.assertIn(Message.TRUNCATE, stalled[1:])
+        self.assertIn(stalled[0], [d[0] for d in duplicates])
+        self.assertEqual(stalled[-1], Message.KILL)
+
+    def test_auto_connections(self):
+        """ test the download of a file while the number of connections is tuned, and that server errors are
+            reported to the concurrency controller """
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=2, min_blocks_per_segment=1, max_blocks_per_segment=2,
+                                initial_blocksize=1048576, kill_speed=0, clean=True, auto_connections=True,
+                                max_connections=8)
+        ftp.download_file('testfile.txt', self._results_dir)
+        self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'testfile.txt'),
+                                    os.path.join(self._results_dir, 'testfile.txt'), shallow=False))
+        self.assertTrue(1 <= ftp.concurrent_connections <= 8)
+
+        # download threads are added when the number of connections grows
+        ftp._set_concurrent_connections(6)
+        self.assertEqual(list(ftp.worker_dl_speeds.keys()), ['0', '1', '2', '3', '4', '5'])
+
+        # a download thread which gets an error from the server is idled and its blocks are released
+        local_path = os.path.join(self._results_dir, 'error.txt')
+        FtpFileDownloader.clean_local_file('error.txt', local_path)
+        blockmap = Blockmap('error.txt', local_path, lambda _: 1048576 * 4, 1, 8, 1048576)
+        blockmap.init_blockmap()
+        blockmap.change_block_range_status(0, 4, '5')
+        ftp._download_threads['5'].private_thread_state = FtpFileDownloader.ACTIVE
+        ftp._doorbell = Doorbell()
+        ftp._download_threads['5'].private_job = _FileJob('error.txt', local_path, blockmap, None, None, Channel())
+        ftp._download_threads['5'].private_channel_out.put(Message(Message.ERROR, '5', value='421 Too many'))
+        self.assertEqual(ftp._process_events(0), 1)
+        self.assertEqual(str(blockmap), '....')
+        self.assertEqual(ftp._download_threads['5'].private_thread_state, FtpFileDownloader.IDLE)
+        self.assertEqual(ftp._concurrency_controller._errors, 1)
+        blockmap.delete_blockmap()
+
+    def test_buffer_budget(self):
+        """ test the download of a file with a buffer budget smaller than the number of connections """
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=4, min_blocks_per_segment=1, max_blocks_per_segment=2,
+                                initial_blocksize=1048576, kill_speed=0, clean=True, max_buffer_mb=2)
+        ftp.download_file('testfile.txt', self._results_dir)
+        self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'testfile.txt'),
+                                    os.path.join(self._results_dir, 'testfile.txt'), shallow=False))
+        self.assertEqual(ftp._buffer_pools[1048576].max_buffers, 2)
+        self.assertTrue(ftp._buffer_pools[1048576].allocated <= 2)
+        self.assertTrue(ftp._buffer_budget.allocated_bytes <= 2 * 1048576)
+
+    def test_pipeline_segments(self):
+        """ test that a worker which is about to finish its segment is given its next segment ahead of time, and that
+            the worker moves on to the next segment without a gap """
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=2, min_blocks_per_segment=1, max_blocks_per_segment=16,
+                                initial_blocksize=1048576, kill_speed=0, clean=True, pipeline_seconds=2)
+        local_path = os.path.join(self._results_dir, 'pipeline.txt')
+        FtpFileDownloader.clean_local_file('pipeline.txt', local_path)
+        blockmap = Blockmap('pipeline.txt', local_path, lambda _: 1048576 * 8, 1, 2, 1048576)
+        blockmap.init_blockmap()
+        blockmap.change_block_range_status(0, 2, '0')
+        blockmap.change_block_range_status(1048576 * 2, 4, '1')
+
+        # worker 0 has one second left, worker 1 has four seconds left and has not been given a next segment
+        job = _FileJob('pipeline.txt', local_path, blockmap, None, None, Channel())
+        for k in ('0', '1'):
+            ftp._download_threads[k].private_thread_state = FtpFileDownloader.ACTIVE
+            ftp._download_threads[k].private_dl_speed_fifo = [1048576] * FtpFileDownloader.SPEED_FIFO_SIZE
+            ftp._download_threads[k].private_job = job
+        ftp._pipeline_segments(job)
+        self.assertEqual(str(blockmap), '00111100')
+        self.assertEqual(ftp._download_threads['0'].private_next_segment_offset, 1048576 * 6)
+        msg = ftp._download_threads['0'].private_channel_in.get_nowait()
+        self.assertEqual((msg.kind, msg.byte_offset, msg.value), (Message.NEXT_SEGMENT, 1048576 * 6, 2))
+        self.assertTrue(ftp._download_threads['1'].private_channel_in.get_nowait() is None)
+        blockmap.delete_blockmap()
+
+        # a worker given its next segment downloads it after its current segment, on a second connection
+        buffer_pool = BlockBufferPool(1048576)
+        channel_in = Channel()
+        channel_out = Channel()
+        channel_in.put(Message(Message.NEXT_SEGMENT, byte_offset=1048576 * 19, value=2))
+        ftp._tw_ftp_download_segment('testfile.txt', None, 1048576 * 2, 2, 1048576, '0', channel_in, channel_out,
+                                     buffer_pool)
+        msgs = []
+        msg = channel_out.get_nowait()
+        while msg is not None:
+            if msg.kind != Message.DL_SPEED_UPDATE:
+                msgs.append((msg.kind, msg.byte_offset, msg.length))
+            if msg.data is not None:
+                buffer_pool.release(msg.data)
+            msg = channel_out.get_nowait()
+        self.assertEqual(msgs, [(Message.DATA_RECEIVED, 1048576 * 2, 1048576),
+                                (Message.DATA_RECEIVED, 1048576 * 3, 1048576),
+                                (Message.SEGMENT_STARTED, 1048576 * 19, None),
+                                (Message.DATA_RECEIVED, 1048576 * 19, 1048576),
+                                (Message.DATA_RECEIVED, 1048576 * 20, 20971570 - 1048576 * 20),
+                                (Message.THREAD_FINISHED, None, None)])
+        self.assertEqual(ftp._connection_pool.idle, 2)
+        ftp.close()
+
+    def test_pipeline_download(self):
+        """ test the download of a file with standby connections and pipelined segments """
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=4, min_blocks_per_segment=1, max_blocks_per_segment=2,
+                                initial_blocksize=1048576, kill_speed=0, clean=True, standby_connections=2,
+                                pipeline_seconds=60)
+        ftp.download_file('testfile.txt', self._results_dir)
+        self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'testfile.txt'),
+                                    os.path.join(self._results_dir, 'testfile.txt'), shallow=False))
+        ftp.close()
+
+    def test_asyncio_download(self):
+        """ test the download of a file with many connections on the asyncio engine, without a thread per connection """
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=100, min_blocks_per_segment=1, max_blocks_per_segment=2,
+                                initial_blocksize=65536, kill_speed=0, clean=True, standby_connections=2,
+                                pipeline_seconds=60, engine=FtpFileDownloader.ENGINE_ASYNCIO)
+        self._threads = 0
+
+        def on_refresh_display(_ftp_download_manager, _blockmap, _remote_filepath):
+            """ on refresh display handler, remember the most threads which were running at once """
+            self._threads = max(self._threads, threading.active_count())
+        ftp.on_refresh_display = on_refresh_display
+        ftp.download_file('testfile.txt', self._results_dir)
+        self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'testfile.txt'),
+                                    os.path.join(self._results_dir, 'testfile.txt'), shallow=False))
+        self.assertTrue(0 < self._threads < 20)
+        self.assertEqual(len(ftp.worker_dl_speeds), 100)
+
+        # a directory tree with small files
+        ftp.download('/', os.path.join(self._results_dir, 'asyncio_tree'))
+        self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'a/testfile2.txt'),
+                                    os.path.join(self._results_dir, 'asyncio_tree', 'a/testfile2.txt'), shallow=False))
+        ftp.close()
+
+        # the asyncio engine does not support TLS, and the engine must be known
+        self.assertRaises(ValueError, FtpFileDownloader, 'localhost', 'user', '12345', enable_tls=True,
+                          engine=FtpFileDownloader.ENGINE_ASYNCIO)
+        self.assertRaises(ValueError, FtpFileDownloader, 'localhost', 'user', '12345', engine='fibers')
+
+    def test_processes_download(self):
+        """ test the download of a file and a directory tree with the download connections in worker processes """
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=8, min_blocks_per_segment=1, max_blocks_per_segment=2,
+                                initial_blocksize=1048576, kill_speed=0, clean=True, standby_connections=2,
+                                pipeline_seconds=60, engine=FtpFileDownloader.ENGINE_PROCESSES)
+        ftp.download_file('testfile.txt', self._results_dir)
+        self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'testfile.txt'),
+                                    os.path.join(self._results_dir, 'testfile.txt'), shallow=False))
+        # the standby connections are kept by the worker processes, the manager only sends SIZE to size the blockmap
+        self.assertEqual(ftp._connection_pool.idle, 1)
+        ftp.download('/', os.path.join(self._results_dir, 'processes_tree'))
+        self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'a/testfile2.txt'),
+                                    os.path.join(self._results_dir, 'processes_tree', 'a/testfile2.txt'),
+                                    shallow=False))
+        self.assertEqual(ftp._engine._writer_channels, {})
+        processes = [p[0] for p in ftp._engine._processes]
+        ftp.close()
+        self.assertFalse(any(p.is_alive() for p in processes))
+
+    @unittest.skipIf(not hasattr(os, 'splice'), 'os.splice is not available')
+    def test_zero_copy_download(self):
+        """ test the download of a file moved straight into the local file with os.splice """
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=4, min_blocks_per_segment=1, max_blocks_per_segment=2,
+                                initial_blocksize=1048576, kill_speed=0, clean=True, zero_copy=True)
+        ftp.download_file('testfile.txt', self._results_dir)
+        self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'testfile.txt'),
+                                    os.path.join(self._results_dir, 'testfile.txt'), shallow=False))
+        self.assertEqual(ftp._buffer_pools[1048576].allocated, 0)
+        self.assertTrue(ftp._zero_copy)
+        ftp.close()
+
+        # data which can not be spliced into the file is written from the pipe, and zero copy is turned off
+        a, b = socket.socketpair()
+        a.settimeout(5)
+        pipe = os.pipe()
+        local_path = os.path.join(self._results_dir, 'splice.bin')
+        with open(local_path, 'wb') as f:
+            f.write(b'....')
+        for flags, expected in ((os.O_WRONLY, b'.hello'), (os.O_WRONLY | os.O_APPEND, b'.hellohello')):
+            fd = os.open(local_path, flags)
+            b.sendall(b'hello')
+            self.assertEqual(ftp._splice(a, pipe, fd, 1, 100), 5)
+            os.close(fd)
+            with open(local_path, 'rb') as f:
+                self.assertEqual(f.read(), expected)
+        self.assertFalse(ftp._zero_copy)
+        b.close()
+        self.assertEqual(ftp._splice(a, pipe, fd, 1, 100), 0)
+        a.close()
+        os.close(pipe[0])
+        os.close(pipe[1])
+
     def test_directory_download(self):
         """ test the download of a directory using download_file """
         # clean up the results directory
@@ -72,6 +361,100 @@ class TestFTPFileDownloadManager(unittest.TestCase):
         self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'a/testfile2.txt'),
                                     os.path.join(dir_path, 'a/testfile2.txt'), shallow=False))
 
+    def test_tree_download(self):
+        """ test the download of a directory of many files which are downloaded at once """
+        os.mkdir(os.path.join(self._test_dir, 'tree'))
+        sizes = [0, 10, 65536 * 3 + 1, 65536 * 8, 100000, 65536 * 20, 7, 65536 * 5 - 1]
+        for i, size in enumerate(sizes):
+            with open(os.path.join(self._test_dir, 'tree', 'file%d.bin' % i), 'wb') as f:
+                f.write(os.urandom(size))
+        self._open_files = 0
+
+        def on_refresh_display(ftp_download_manager, _blockmap, _remote_filepath):
+            """ on refresh display handler, remember the most files which were open at once """
+            self._open_files = max(self._open_files, len(ftp_download_manager._jobs))
+
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=6, min_blocks_per_segment=1, max_blocks_per_segment=2,
+                                initial_blocksize=65536, kill_speed=0, clean=True, max_open_files=4,
+                                small_file_size=0)
+        ftp.on_refresh_display = on_refresh_display
+        ftp.download('tree', os.path.join(self._results_dir, 'tree'))
+        for i in range(0, len(sizes)):
+            self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'tree', 'file%d.bin' % i),
+                                        os.path.join(self._results_dir, 'tree', 'file%d.bin' % i), shallow=False))
+        self.assertTrue(1 < self._open_files <= 4)
+        self.assertEqual(ftp.tree_progress, {'files_done': len(sizes), 'files_total': len(sizes),
+                                             'bytes_done': sum(sizes)})
+        self.assertEqual(ftp._jobs, [])
+        ftp.close()
+
+    def test_stale_listing_size(self):
+        """ test that the blockmap of a file is sized with SIZE, not with a size from an out of date listing """
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=4, min_blocks_per_segment=1, max_blocks_per_segment=2,
+                                initial_blocksize=1024, kill_speed=0, clean=True, small_file_size=0)
+        size = os.path.getsize(os.path.join(self._test_dir, 'testfile.txt'))
+        ftp._download_files([('testfile.txt', os.path.join(self._results_dir, 'testfile.txt'), size // 2)])
+        self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'testfile.txt'),
+                                    os.path.join(self._results_dir, 'testfile.txt'), shallow=False))
+        ftp.close()
+
+    def test_small_files_download(self):
+        """ test the download of a directory of small files which are fetched whole, mixed with larger files """
+        os.mkdir(os.path.join(self._test_dir, 'small'))
+        sizes = [0, 10, 1000, 65536, 300000, 2, 65536 * 4, 5000, 65536 * 3, 123]
+        for i, size in enumerate(sizes):
+            with open(os.path.join(self._test_dir, 'small', 'file%d.bin' % i), 'wb') as f:
+                f.write(os.urandom(size))
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=3, min_blocks_per_segment=1, max_blocks_per_segment=2,
+                                initial_blocksize=65536, kill_speed=0, clean=True, small_file_size=65536)
+        connects = []
+        connect = ftp._ftp_connection
+        ftp._ftp_connection = lambda: connects.append(1) or connect()
+        ftp._connection_pool._connect = ftp._ftp_connection
+        ftp.download('small', os.path.join(self._results_dir, 'small'))
+        for i in range(0, len(sizes)):
+            self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'small', 'file%d.bin' % i),
+                                        os.path.join(self._results_dir, 'small', 'file%d.bin' % i), shallow=False))
+        self.assertEqual(ftp.tree_progress, {'files_done': len(sizes), 'files_total': len(sizes),
+                                             'bytes_done': sum(sizes)})
+        self.assertFalse([f for f in os.listdir(os.path.join(self._results_dir, 'small')) if not f.endswith('.bin')])
+
+        # the connections are reused for the small files, and a second run skips every file
+        self.assertTrue(len(connects) <= 6)
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=3, small_file_size=65536)
+        ftp.download('small', os.path.join(self._results_dir, 'small'))
+        self.assertEqual(ftp.tree_progress['files_done'], len(sizes))
+        ftp.close()
+
+    def test_small_files_errors(self):
+        """ test that a file whose size the server does not report is handed back, and that any error ends the thread
+            with an error so that the files go back to the segment path """
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=1, small_file_size=65536)
+        connect = ftp._ftp_connection
+
+        def connect_without_size():
+            """ a connection to a server which does not reply to SIZE with a size """
+            connection = connect()
+            connection.size = lambda _remote_path: None
+            return connection
+        ftp._connection_pool._connect = connect_without_size
+        local_path = os.path.join(self._results_dir, 'testfile.txt')
+        channel_out = Channel()
+        ftp._tw_ftp_download_small_files([('testfile.txt', local_path, None)], '0', Channel(), channel_out)
+        messages = [channel_out.get_nowait(), channel_out.get_nowait()]
+        self.assertEqual([m.kind for m in messages], [Message.FILE_DEFERRED, Message.THREAD_FINISHED])
+        self.assertEqual(messages[0].value, ('testfile.txt', local_path, None))
+
+        # an error which is not an ftp error
+        ftp._tw_ftp_download_small_files([('testfile.txt', local_path, 'bad size')], '0', Channel(), channel_out)
+        self.assertEqual(channel_out.get_nowait().kind, Message.ERROR)
+        ftp.close()
+
     def test_download(self):
         """ test the download of a small simple file using download"""
         if os.path.exists(os.path.join(self._results_dir, 'testfile.txt')):
@@ -130,6 +513,93 @@ class TestFTPFileDownloadManager(unittest.TestCase):
         self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'testfile.txt'),
                                     os.path.join(self._results_dir, 'testfile.txt'), shallow=False))
 
+    def test_max_rate(self):
+        """ test that the total download speed of the connections is held at the max rate, and that the max rate can be
+            changed during the download """
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=4, min_blocks_per_segment=1, max_blocks_per_segment=4,
+                                initial_blocksize=1048576, kill_speed=0, clean=True, max_rate=10)
+        self.assertEqual(ftp.max_rate, 10)
+        t = time.time()
+        ftp.download('testfile.txt', self._results_dir)
+        # only a lower bound, a loaded machine can make the download take any amount of time longer
+        elapsed = time.time() - t
+        self.assertTrue(elapsed > 1.8, elapsed)
+        self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'testfile.txt'),
+                                    os.path.join(self._results_dir, 'testfile.txt'), shallow=False))
+
+        # the max rate is lifted once the first block has been downloaded
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=4, min_blocks_per_segment=1, max_blocks_per_segment=4,
+                                initial_blocksize=1048576, kill_speed=0, clean=True, max_rate=0.5)
+        ftp.on_refresh_display = lambda ftp_download_manager, _blockmap, _remote_filepath: \
+            ftp_download_manager.set_max_rate(0)
+        ftp.download('testfile.txt', self._results_dir)
+        self.assertEqual(ftp.max_rate, 0)
+        self.assertEqual(ftp._rate_limiter.delay(), 0)
+        self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'testfile.txt'),
+                                    os.path.join(self._results_dir, 'testfile.txt'), shallow=False))
+
+    def test_relative_kill_policy(self):
+        """ test that the relative kill policy selects a download thread which has stalled, and that the thread is
+            reconnected and the download still completes """
+        policy = RelativeKillPolicy(min_warm_up=0.1, max_warm_up=0.5)
+        selected = []
+        select = policy.select
+
+        def on_select(paused=(), now=None):
+            """ record the download threads which the policy selects to be killed """
+            retval = select(paused, now)
+            selected.extend(retval)
+            return retval
+        policy.select = on_select
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=4, min_blocks_per_segment=1, max_blocks_per_segment=8,
+                                initial_blocksize=65536, kill_speed=0, clean=True, kill_policy=policy)
+
+        # the first download thread never receives any data until it is killed
+        stalled = []
+        download_segment = ftp._tw_ftp_download_segment
+
+        def on_download_segment(*args):
+            """ stall the first download thread """
+            if stalled:
+                return download_segment(*args)
+            worker_id, channel_in, channel_out = args[5:8]
+            stalled.append(worker_id)
+            t = time.time()
+            msg = channel_in.get_nowait()
+            while (msg is None or msg.kind != Message.KILL) and time.time() - t < 30:
+                time.sleep(0.01)
+                msg = channel_in.get_nowait()
+            stalled.append(msg.kind if msg is not None else None)
+            channel_out.put(Message(Message.ABORTED, worker_id))
+            return None
+        ftp._tw_ftp_download_segment = on_download_segment
+        ftp.download('testfile.txt', self._results_dir)
+        self.assertIn(stalled[0], selected)
+        self.assertEqual(stalled[1], Message.KILL)
+        self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'testfile.txt'),
+                                    os.path.join(self._results_dir, 'testfile.txt'), shallow=False))
+
+    def test_throttled_threads_paused(self):
+        """ test that only the download threads which have waited for the max rate are left out of the kill policy """
+        policy = RelativeKillPolicy()
+        paused = []
+        policy.select = lambda p=(), now=None: paused.extend(p) or []
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=2, max_rate=1, kill_policy=policy)
+        ftp._process_event(None, Message(Message.THROTTLED, '1', value=0.5))
+        ftp._manage_download_threads(False)
+        self.assertEqual(paused, ['1'])
+
+        # the thread is no longer paused once its wait has ended
+        del paused[:]
+        ftp._throttled['1'] = time.time() - ftp.KILL_POLL
+        ftp._manage_download_threads(False)
+        self.assertEqual(paused, [])
+        ftp.close()
+
     def test_resume_aborted_download(self):
         """ test the handling of resuming a previously aborted download """
         self._blocks_downloaded = 0
@@ -159,6 +629,34 @@ class TestFTPFileDownloadManager(unittest.TestCase):
         self.assertTrue(filecmp.cmp(os.path.join(self._test_dir, 'testfile.txt'),
                                     os.path.join(self._results_dir, 'testfile.txt'), shallow=False))
 
+    def test_abort_saves_received_data(self):
+        """ test that data which has been received when a download is aborted is saved and journaled """
+        def on_refresh_display(ftp_download_manager, blockmap, _remote_filepath):
+            """ on refresh display handler, abort as soon as a block has been received """
+            counts = blockmap.get_state_counts()
+            if Blockmap.SAVING in counts or Blockmap.DOWNLOADED in counts:
+                ftp_download_manager.abort_download()
+
+        ftp = FtpFileDownloader(server_url='localhost', username='user', password='12345', port=2121,
+                                concurrent_connections=4, min_blocks_per_segment=1, max_blocks_per_segment=2,
+                                initial_blocksize=1048576, kill_speed=0, clean=True)
+        ftp.on_refresh_display = on_refresh_display
+        ftp.download('testfile.txt', self._results_dir)
+
+        # every block received before the abort has been saved, and the saved blocks match the original file
+        local_path = os.path.join(self._results_dir, 'testfile.txt')
+        blockmap = Blockmap('testfile.txt', local_path, None)
+        counts = blockmap.get_state_counts()
+        self.assertTrue(counts.get(Blockmap.DOWNLOADED, 0) > 0)
+        self.assertFalse(Blockmap.SAVING in counts)
+        with open(os.path.join(self._test_dir, 'testfile.txt'), 'rb') as f:
+            original = f.read()
+        with open(local_path, 'rb') as f:
+            downloaded = f.read()
+        for i, c in enumerate(str(blockmap)):
+            if c == Blockmap.DOWNLOADED:
+                self.assertEqual(downloaded[i * 1048576:(i + 1) * 1048576], original[i * 1048576:(i + 1) * 1048576])
+
     def test_resume_aborted_download2(self):
         """ test the handling of resuming a previously aborted download with a blocksize change"""
         self._blocks_downloaded = 0
@@ -0,0 +1,135 @@
+""" tests for the ftp lister class """
+# DISABLE - Access to a protected member %s of a client class
+# pylint: disable=W0212
+
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+from ftplib import FTP, error_perm, error_temp
+import os
+import unittest
+
+from superftp.ftp_lister import FtpLister
+from test_utils import setup_ftp_server, teardown_ftp_server
+
+
+# --------------------------------------------------
+#    Test Classes
+# --------------------------------------------------
+class TestFtpLister(unittest.TestCase):
+    """ tests for ftp lister class """
+    def setUp(self):
+        self._ftp_thread = None
+        self._com_queue = None
+        self._results_dir = 'results_ftp_lister'
+        self._test_dir = None
+        (self._com_queue, self._results_dir,
+         self._test_dir, self._ftp_thread) = setup_ftp_server(self._ftp_thread, self._com_queue,
+                                                              self._results_dir)
+        self._ftp = FTP()
+        self._ftp.connect('localhost', 2121)
+        self._ftp.login('user', '12345')
+
+    def tearDown(self):
+        self._ftp.close()
+        teardown_ftp_server(self._ftp_thread, self._com_queue)
+        self._ftp_thread = None
+
+    def _check_listing(self, lister):
+        """ check the listings of the test data directories """
+        home = self._ftp.pwd()
+        listing = sorted(lister.list_dir(self._ftp, home, '/'))
+        self.assertEqual([e[0:3] for e in listing], [('a', 'dir', listing[0][2]), ('testfile.txt', 'file', 20971570)])
+        self.assertEqual(len(listing[1][3]), 14)
+        self.assertEqual([e[0:3] for e in lister.list_dir(self._ftp, home, 'a')], [('testfile2.txt', 'file', 2097156)])
+        self.assertTrue(lister.list_dir(self._ftp, home, 'testfile.txt') is None)
+        self.assertTrue(lister.list_dir(self._ftp, home, 'nonexist') is None)
+        self.assertEqual(self._ftp.pwd(), home)
+
+    def test_mlsd(self):
+        """ tests that directories are listed with MLSD """
+        self._check_listing(FtpLister())
+
+    def test_list(self):
+        """ tests that directories are listed with LIST if the server refuses MLSD """
+        lister = FtpLister()
+        mlsd = []
+
+        def refuse_mlsd(*_args):
+            """ mlsd of a server which does not know the command """
+            mlsd.append(1)
+            self._ftp.voidcmd('FOO')
+            yield None
+        self._ftp.mlsd = refuse_mlsd
+        self._check_listing(lister)
+        self.assertFalse(lister._mlsd)
+        self.assertEqual(mlsd, [1])
+
+    def test_errors(self):
+        """ tests that only a reply which says that the path is not a directory is taken to be a file, and that a
+            listing which has failed is raised and not cached """
+        lister = FtpLister(os.path.join(self._results_dir, 'listings.json'))
+        home = self._ftp.pwd()
+        replies = []
+
+        def fail(*_args):
+            """ mlsd or cwd of a server which fails with the next reply """
+            raise replies.pop(0)
+        self._ftp.mlsd = fail
+        replies.append(error_temp('421 Too many connections'))
+        self.assertRaises(error_temp, lister.list_dir, self._ftp, home, '/')
+        replies.append(error_perm('530 Not logged in'))
+        self.assertRaises(error_perm, lister.list_dir, self._ftp, home, '/')
+        self.assertEqual(lister._cache, {})
+        replies.append(error_perm('550 No such directory'))
+        self.assertTrue(lister.list_dir(self._ftp, home, '/') is None)
+
+        # the same with LIST
+        lister = FtpLister(os.path.join(self._results_dir, 'listings.json'))
+        lister._mlsd = False
+        self._ftp.cwd = fail
+        replies.append(error_temp('450 Busy'))
+        self.assertRaises(error_temp, lister.list_dir, self._ftp, home, '/')
+        replies.append(EOFError())
+        self.assertRaises(EOFError, lister.list_dir, self._ftp, home, '/')
+        self.assertEqual(lister._cache, {})
+        replies.append(error_perm('501 Not a directory'))
+        self.assertTrue(lister.list_dir(self._ftp, home, '/') is None)
+
+    def test_parse_list_line(self):
+        """ tests the parsing of unix and DOS style lines of a LIST reply """
+        self.assertEqual(FtpLister.parse_list_line('-rw-r--r--   1 root  root  20971570 Jan  2  2019 file name.txt'),
+                         ('file name.txt', 'file', 20971570, '20190102000000'))
+        self.assertEqual(FtpLister.parse_list_line('drwxr-xr-x   2 root  root      4096 Jan 02  2019 sub'),
+                         ('sub', 'dir', None, '20190102000000'))
+        self.assertEqual(FtpLister.parse_list_line('lrwxrwxrwx   1 root  root         7 Jan 02  2019 link -> sub')[0:3],
+                         ('link', None, None))
+        self.assertEqual(FtpLister.parse_list_line('10-17-26  02:31PM       <DIR>          sub dir'),
+                         ('sub dir', 'dir', None, '20261017143100'))
+        self.assertEqual(FtpLister.parse_list_line('01-02-99  12:05AM                 1234 old.txt'),
+                         ('old.txt', 'file', 1234, '19990102000500'))
+        self.assertTrue(FtpLister.parse_list_line('total 24') is None)
+        self.assertTrue(FtpLister.parse_list_line('drwxr-xr-x   2 root  root      4096 Jan 02  2019 ..') is None)
+
+    def test_cache(self):
+        """ tests that the listings are reused from the cache file by the next run until they expire """
+        cache_path = os.path.join(self._results_dir, 'listings.json')
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        lister = FtpLister(cache_path, cache_key='user@localhost ')
+        self._check_listing(lister)
+        lister.save()
+        self.assertTrue(os.path.exists(cache_path))
+
+        # the next run lists nothing on the server
+        lister = FtpLister(cache_path, cache_key='user@localhost ')
+        lister._list_mlsd = lister._list_list = None
+        self._check_listing(lister)
+
+        # expired listings are listed again
+        self.assertEqual(len(FtpLister(cache_path, cache_ttl=0, cache_key='user@localhost ')._cache), 0)
+
+        # a corrupt cache file is ignored
+        with open(cache_path, 'w') as f:
+            f.write('{"version": 1, "listings": [')
+        self.assertEqual(FtpLister(cache_path)._cache, {})
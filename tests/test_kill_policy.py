@@ -0,0 +1,103 @@
+""" tests for the kill policy classes """
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import unittest
+
+from superftp.kill_policy import AbsoluteKillPolicy, KillPolicy, RelativeKillPolicy
+
+
+# --------------------------------------------------
+#    Test Classes
+# --------------------------------------------------
+class TestKillPolicy(unittest.TestCase):
+    """ tests for the kill policy classes """
+    @staticmethod
+    def _run(policy, speeds, seconds, t=0.0):
+        """ feed the policy one speed per second from each worker, returns the time at the end
+
+            Args:
+                policy - policy to feed
+                speeds - dictionary of worker_id -> download speed in bytes/sec
+                seconds - number of seconds to feed
+                t - time to start at
+        """
+        for _ in range(0, seconds):
+            t = t + 1.0
+            for worker_id, speed in speeds.items():
+                policy.on_speed(worker_id, speed, t)
+        return t
+
+    def test_kill_policy(self):
+        """ tests that the base policy never kills a worker """
+        policy = KillPolicy()
+        policy.start('0', 0.0)
+        t = self._run(policy, {'0': 0}, 100)
+        self.assertEqual(policy.select(now=t), [])
+
+    def test_absolute(self):
+        """ tests that a worker is killed once its last speeds are all below the kill speed after the warm-up """
+        policy = AbsoluteKillPolicy(1.0)
+        policy.start('0', 0.0)
+        policy.start('1', 0.0)
+        t = self._run(policy, {'0': 512 * 1024, '1': 2 * 1024 * 1024}, 10)
+        self.assertEqual(policy.select(now=t), [])
+        t = self._run(policy, {'0': 512 * 1024, '1': 2 * 1024 * 1024}, 15, t)
+        self.assertEqual(policy.select(now=t), ['0'])
+        self.assertEqual(policy.select(['0'], now=t), [])
+
+        # a worker which was restarted is given the warm-up again
+        policy.stop('0')
+        policy.start('0', t)
+        self.assertEqual(policy.select(now=self._run(policy, {'0': 512 * 1024}, 4, t)), [])
+
+    def test_relative(self):
+        """ tests that only the slowest worker much slower than the median is killed once the warm-up has passed """
+        policy = RelativeKillPolicy(fraction=0.5, max_warm_up=20.0)
+        for worker_id in ('0', '1', '2', '3'):
+            policy.start(worker_id, 0.0)
+
+        # the warm-up adapts to the workers, which reach their speed after 2 seconds and are seen to have ramped up
+        # by the sample after
+        speeds = {'0': 1000.0, '1': 1000.0, '2': 300.0, '3': 100.0}
+        t = self._run(policy, {'0': 500.0, '1': 500.0, '2': 150.0, '3': 50.0}, 1)
+        self.assertEqual(policy.select(now=t), [])
+        self.assertEqual(policy.warm_up, 20.0)
+        t = self._run(policy, speeds, 2, t)
+        self.assertAlmostEqual(policy.warm_up, 6.0)
+        self.assertEqual(policy.select(now=t), [])
+        t = self._run(policy, speeds, 3, t)
+        self.assertEqual(policy.select(now=t), ['3'])
+        policy.stop('3')
+        self.assertEqual(policy.select(now=t), ['2'])
+
+        # the median is not used with too few workers
+        policy.stop('0')
+        policy.stop('2')
+        self.assertEqual(policy.select(now=t), [])
+
+    def test_stall(self):
+        """ tests that a worker which has stopped receiving data is killed after a few of its usual gaps """
+        policy = RelativeKillPolicy(stall_seconds=0.5)
+        policy.start('0', 0.0)
+        policy.start('1', 0.0)
+
+        # a worker which has not received anything yet gets the whole warm-up
+        self.assertEqual(policy.select(now=19.0), [])
+        self.assertEqual(sorted(policy.select(now=21.0)), ['0', '1'])
+
+        # data arrives every 0.05 seconds on worker 0 and every 0.5 seconds on worker 1
+        t = 21.0
+        for _ in range(0, 20):
+            t = t + 0.05
+            policy.on_data('0', t)
+        for k in range(0, 5):
+            policy.on_data('1', 21.0 + 0.5 * k)
+        self.assertEqual(policy.select(now=t + 0.4), [])
+        self.assertEqual(policy.select(now=t + 0.6), ['0'])
+
+        # the gap of worker 1 is much longer, and waiting for the buffer budget is not a stall
+        self.assertEqual(policy.select(now=24.9), ['0'])
+        self.assertEqual(policy.select(['1'], now=25.1), ['0'])
+        self.assertEqual(policy.select(now=27.0), ['0'])
+        self.assertEqual(sorted(policy.select(now=27.2)), ['0', '1'])
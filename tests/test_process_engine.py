@@ -0,0 +1,126 @@
+""" tests for the process download engine """
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import os
+import unittest
+
+from superftp.channels import Channel, Message
+from superftp.ftp_file_download_manager import FtpFileDownloader
+from superftp.process_engine import ProcessEngine
+from test_utils import setup_ftp_server, teardown_ftp_server
+
+
+# --------------------------------------------------
+#    Test Classes
+# --------------------------------------------------
+class _Job:
+    """ the fields of a _FileJob which the engine uses """
+    def __init__(self, local_path):
+        self.local_path = local_path
+        self.writer_channel = Channel()
+
+
+class TestProcessEngine(unittest.TestCase):
+    """ tests for the process download engine """
+    def setUp(self):
+        self._ftp_thread = None
+        self._com_queue = None
+        self._results_dir = 'results_process_engine'
+        self._test_dir = None
+        (self._com_queue, self._results_dir,
+         self._test_dir, self._ftp_thread) = setup_ftp_server(self._ftp_thread, self._com_queue,
+                                                              self._results_dir)
+
+    def tearDown(self):
+        teardown_ftp_server(self._ftp_thread, self._com_queue)
+        self._ftp_thread = None
+
+    def _run_task(self, engine, target, args, job=None):
+        """ start a task, wait for it to finish and return the messages it sent to the manager """
+        task = engine.task(target, args)
+        task.private_job = job
+        task.start()
+        task.join(30)
+        self.assertFalse(task.is_alive())
+        messages = []
+        msg = task.channel_out.get_nowait()
+        while msg is not None:
+            messages.append(msg)
+            msg = task.channel_out.get_nowait()
+        return messages
+
+    def test_download_segment(self):
+        """ tests that a worker process writes the blocks of a segment to the file and reports the written runs """
+        local_path = os.path.join(self._results_dir, 'segment.bin')
+        with open(local_path, 'wb') as _:
+            pass
+        job = _Job(local_path)
+        engine = ProcessEngine('localhost', 2121, 'user', '12345', False, 1024, FtpFileDownloader, processes=2)
+        messages = self._run_task(engine, engine.download_segment,
+                                  ('testfile.txt', local_path, 20971520 - 65536, 2, 65536, '3', Channel(), Channel(),
+                                   None), job)
+        self.assertEqual(messages[-1].kind, Message.THREAD_FINISHED)
+        self.assertEqual(messages[-1].worker_id, '3')
+
+        # the runs arrive on the writer channel of the file, and the data is at its offset in the file
+        saved = []
+        msg = job.writer_channel.get_nowait()
+        while msg is not None:
+            saved.append((msg.byte_offset, msg.value))
+            msg = job.writer_channel.get_nowait()
+        self.assertEqual(sorted(saved), [(20971520 - 65536, 1), (20971520, 1)])
+        self.assertEqual(engine._writer_channels, {})
+        with open(os.path.join(self._test_dir, 'testfile.txt'), 'rb') as f:
+            f.seek(20971520 - 65536)
+            expected = f.read()
+        with open(local_path, 'rb') as f:
+            f.seek(20971520 - 65536)
+            self.assertEqual(f.read(), expected)
+
+        # a small file is fetched whole, and an error is reported like a download thread reports it
+        small_path = os.path.join(self._results_dir, 'small.txt')
+        messages = self._run_task(engine, engine.download_small_files,
+                                  ([('nonexist.txt', small_path, None)], '4', Channel(), Channel()))
+        self.assertEqual([m.kind for m in messages], [Message.ERROR])
+        self.assertEqual(messages[0].worker_id, '4')
+        engine.close()
+        self.assertFalse(any(p[0].is_alive() for p in engine._processes))
+
+    def test_shared_writer(self):
+        """ tests that a task which shares the file writer with another task only finishes once its blocks are saved,
+            and that a failed write is reported as an error without stopping the worker process """
+        local_path = os.path.join(self._results_dir, 'shared.bin')
+        with open(local_path, 'wb') as _:
+            pass
+        job = _Job(local_path)
+        engine = ProcessEngine('localhost', 2121, 'user', '12345', False, 1024, FtpFileDownloader, processes=1)
+        first = engine.task(engine.download_segment, ('testfile.txt', local_path, 0, 64, 65536, '0', Channel(),
+                                                      Channel(), None))
+        first.private_job = job
+        first.start()
+        messages = self._run_task(engine, engine.download_segment,
+                                  ('testfile.txt', local_path, 20971520 - 65536, 2, 65536, '1', Channel(), Channel(),
+                                   None), job)
+        self.assertEqual(messages[-1].kind, Message.THREAD_FINISHED)
+
+        # the blocks of the second task are on the writer channel as soon as it has finished
+        saved = []
+        msg = job.writer_channel.get_nowait()
+        while msg is not None:
+            saved.append(msg.byte_offset)
+            msg = job.writer_channel.get_nowait()
+        self.assertTrue(20971520 - 65536 in saved and 20971520 in saved)
+        first.join(30)
+        self.assertFalse(first.is_alive())
+
+        # a file which can not be written
+        if os.path.exists('/dev/full'):
+            messages = self._run_task(engine, engine.download_segment,
+                                      ('testfile.txt', '/dev/full', 0, 2, 65536, '2', Channel(), Channel(), None),
+                                      _Job('/dev/full'))
+            self.assertEqual(messages[-1].kind, Message.ERROR)
+            messages = self._run_task(engine, engine.download_segment,
+                                      ('testfile.txt', local_path, 0, 2, 65536, '3', Channel(), Channel(), None), job)
+            self.assertEqual(messages[-1].kind, Message.THREAD_FINISHED)
+        engine.close()
@@ -0,0 +1,80 @@
+""" tests for the token bucket class """
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import multiprocessing
+import threading
+import time
+import unittest
+
+from superftp.rate_limiter import TokenBucket
+
+
+# --------------------------------------------------
+#    Functions
+# --------------------------------------------------
+def _consume(bucket, count):
+    """ take tokens from a bucket in another process """
+    bucket.consume(count)
+
+
+# --------------------------------------------------
+#    Test Classes
+# --------------------------------------------------
+class TestTokenBucket(unittest.TestCase):
+    """ tests for token bucket class """
+    @staticmethod
+    def _receive(bucket, count, chunk):
+        """ take tokens for count bytes received in chunks, waiting whenever the bucket is empty """
+        while count > 0:
+            delay = bucket.delay()
+            if delay > 0:
+                time.sleep(delay)
+                continue
+            bucket.consume(chunk)
+            count = count - chunk
+
+    def test_no_limit(self):
+        """ tests that a bucket without a rate never waits """
+        bucket = TokenBucket()
+        bucket.consume(1 << 30)
+        self.assertEqual(bucket.delay(), 0)
+        self.assertFalse(bucket.limiting)
+
+    def test_rate(self):
+        """ tests that the total rate of several threads sharing the bucket is held at the rate """
+        bucket = TokenBucket(1000000)
+        threads = [threading.Thread(target=self._receive, args=(bucket, 250000, 65536)) for _ in range(0, 4)]
+        t = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - t
+        self.assertTrue(elapsed > 0.8, elapsed)
+        self.assertTrue(bucket.limiting)
+
+    def test_set_rate(self):
+        """ tests that the rate can be changed and removed while the bucket owes tokens """
+        bucket = TokenBucket(1000000)
+        bucket.consume(1000000)
+        self.assertTrue(0.8 < bucket.delay() < 1.0)
+        bucket.set_rate(10000000)
+        self.assertTrue(0.08 < bucket.delay() < 0.1)
+        bucket.set_rate(0)
+        self.assertEqual(bucket.delay(), 0)
+        self.assertEqual(bucket.rate, 0)
+
+        # after the rate is set again the bucket starts full
+        bucket.set_rate(1000000)
+        bucket.consume(50000)
+        self.assertEqual(bucket.delay(), 0)
+
+    def test_shared_state(self):
+        """ tests that a bucket in shared memory shares its tokens with another process """
+        context = multiprocessing.get_context('spawn')
+        bucket = TokenBucket(1000000, state=context.Array('d', 3, lock=False), lock=context.Lock())
+        process = context.Process(target=_consume, args=(bucket, 1000000))
+        process.start()
+        process.join(30)
+        self.assertTrue(0.5 < bucket.delay() < 1.1)
@@ -0,0 +1,117 @@
+""" tests for the segment state class """
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import unittest
+
+from superftp.channels import Channel, Message
+from superftp.rate_limiter import TokenBucket
+from superftp.segment_state import SegmentState, SmallFilesState
+
+
+# --------------------------------------------------
+#    Test Classes
+# --------------------------------------------------
+class TestSegmentState(unittest.TestCase):
+    """ tests for segment state class """
+    def test_control_messages(self):
+        """ tests that a truncate applies to the segment and to the next segment, and that a next segment is returned
+            to be started """
+        state = SegmentState('0', 0, 4, 10, TokenBucket(), Channel())
+        self.assertEqual(state.on_control_message(Message(Message.NEXT_SEGMENT, byte_offset=40, value=4)), (40, 80))
+        state.next_segment = ['ftp', 'conn', 40, 80]
+        self.assertTrue(state.on_control_message(Message(Message.TRUNCATE, byte_offset=60)) is None)
+        self.assertEqual((state.end_byte_offset, state.next_segment[3]), (40, 60))
+        state.on_control_message(Message(Message.TRUNCATE, byte_offset=20))
+        self.assertEqual((state.end_byte_offset, state.next_segment[3]), (20, 20))
+        self.assertFalse(state.killed)
+        state.on_control_message(Message(Message.KILL))
+        self.assertTrue(state.killed)
+        self.assertRaises(Exception, state.on_control_message, Message(Message.DATA_SAVED))
+
+    def test_blocks(self):
+        """ tests that a block is complete once it is full or at the end of the file, and that the download thread
+            moves on to its next segment """
+        channel_out = Channel()
+        state = SegmentState('0', 0, 2, 10, TokenBucket(), channel_out)
+        self.assertFalse(state.on_received(6))
+        self.assertTrue(state.on_received(4))
+        self.assertEqual(state.finish_block(), (0, 10))
+        self.assertFalse(state.on_received(3))
+        self.assertTrue(state.on_received(0))
+        self.assertEqual(state.finish_block(), (10, 3))
+        self.assertEqual(state.byte_offset, 20)
+        self.assertFalse(state.on_received(0))
+
+        # the manager is told about the next segment
+        state.next_segment = ['ftp', 'conn', 40, 60]
+        self.assertEqual(state.move_to_next_segment(), ('ftp', 'conn'))
+        self.assertEqual((state.byte_offset, state.end_byte_offset, state.next_segment), (40, 60, None))
+        msg = channel_out.get_nowait()
+        self.assertEqual((msg.kind, msg.byte_offset), (Message.SEGMENT_STARTED, 40))
+        state.finish()
+        self.assertEqual(channel_out.get_nowait().kind, Message.THREAD_FINISHED)
+
+    def test_throttle(self):
+        """ tests that a wait for the max rate is reported to the manager and does not count as a stall """
+        channel_out = Channel()
+        state = SegmentState('0', 0, 2, 10, TokenBucket(1000), channel_out)
+        self.assertEqual(state.throttle_delay(0.1), 0)
+        state.on_received(1000)
+        self.assertEqual(state.throttle_delay(0.1), 0.1)
+        msg = channel_out.get_nowait()
+        self.assertEqual((msg.kind, msg.worker_id, msg.value), (Message.THROTTLED, '0', 0.1))
+        state.last_data = state.last_data - 10
+        self.assertTrue(state.stalled(5))
+        state.on_wait()
+        self.assertFalse(state.stalled(5))
+
+    def test_poll_control_messages(self):
+        """ tests that the control messages waiting are applied, and that a truncate after a next segment message also
+            applies to the next segment which has not been started yet """
+        channel_in = Channel()
+        state = SegmentState('0', 0, 4, 10, TokenBucket(), Channel())
+        self.assertTrue(state.poll_control_messages(channel_in) is None)
+        channel_in.put(Message(Message.NEXT_SEGMENT, byte_offset=40, value=4))
+        channel_in.put(Message(Message.TRUNCATE, byte_offset=60))
+        self.assertEqual(state.poll_control_messages(channel_in), (40, 60))
+        self.assertEqual(state.end_byte_offset, 40)
+        self.assertTrue(channel_in.get_nowait() is None)
+
+    def test_send_block(self):
+        """ tests that a received block is passed to the manager with its buffer, and a block already in the local
+            file is reported as saved """
+        channel_out = Channel()
+        state = SegmentState('0', 0, 2, 10, TokenBucket(), channel_out)
+        state.on_received(10)
+        state.send_block(b'0123456789')
+        msg = channel_out.get_nowait()
+        self.assertEqual((msg.kind, msg.byte_offset, msg.data, msg.length), (Message.DATA_RECEIVED, 0, b'0123456789',
+                                                                             10))
+        state.on_received(10)
+        state.send_block(None)
+        msg = channel_out.get_nowait()
+        self.assertEqual((msg.kind, msg.byte_offset, msg.value), (Message.DATA_SAVED, 10, 1))
+        state.fail(ValueError())
+        msg = channel_out.get_nowait()
+        self.assertEqual((msg.kind, msg.value), (Message.ERROR, 'ValueError()'))
+
+    def test_small_files(self):
+        """ tests that the files which are not small are handed back, and that no more files are fetched once the
+            download thread has been killed """
+        channel_in = Channel()
+        channel_out = Channel()
+        state = SmallFilesState('0', [('a', 'a', 5), ('b', 'b', None), ('c', 'c', 5)], 10, TokenBucket(), channel_out)
+        fetched = []
+        for remote_path, local_path, size in state.pending_files(channel_in):
+            fetched.append(remote_path)
+            if not state.deferred(remote_path, local_path, size):
+                state.file_done(remote_path, local_path, size)
+                channel_in.put(Message(Message.KILL))
+        self.assertEqual(fetched, ['a'])
+        state.finish()
+        self.assertEqual([channel_out.get_nowait().kind for _ in range(0, 2)], [Message.FILE_DONE, Message.ABORTED])
+
+        state = SmallFilesState('0', [('b', 'b', None), ('c', 'c', 11)], 10, TokenBucket(), channel_out)
+        self.assertEqual([state.deferred(*f) for f in state.pending_files(channel_in)], [True, True])
+        self.assertEqual([channel_out.get_nowait().value for _ in range(0, 2)], [('b', 'b', None), ('c', 'c', 11)])
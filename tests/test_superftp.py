@@ -36,7 +36,7 @@ class TestSuperFTP(unittest.TestCase):
         blockmap = create_blockmap(self._results_dir, 1024 * 1024 * 32)
         blockmap.init_blockmap()
         blockmap.change_block_range_status(1024 * 1024 * 15, 2, Blockmap.DOWNLOADED)
-        blockmap.change_block_range_status(1024 * 1024 * 6, 2, Blockmap.PENDING)
+        blockmap.change_block_range_status(1024 * 1024 * 6, 2, Blockmap.PENDING[0])
         blockmap.change_block_range_status(1024 * 1024 * 1, 2, Blockmap.SAVING)
 
         # check the display_compact
@@ -45,7 +45,7 @@ class TestSuperFTP(unittest.TestCase):
         s = err.getvalue()
         self.assertEqual(s, '')
         s = out.getvalue()
-        truth = ('\rETA:infinite        3.2%  0.000MB/sec  \remote\test                              ')
+        truth = ('\rETA:infinite        6.2%  0.000MB/sec  \remote\test                              ')
         self.assertEqual(s, truth)
 
     def test_display_full(self):
@@ -59,7 +59,7 @@ class TestSuperFTP(unittest.TestCase):
         blockmap = create_blockmap(self._results_dir, 1024 * 1024 * 32)
         blockmap.init_blockmap()
         blockmap.change_block_range_status(1024 * 1024 * 2, 2, Blockmap.DOWNLOADED)
-        blockmap.change_block_range_status(1024 * 1024 * 24, 2, Blockmap.PENDING)
+        blockmap.change_block_range_status(1024 * 1024 * 24, 2, Blockmap.PENDING[0])
         blockmap.change_block_range_status(1024 * 1024 * 30, 2, Blockmap.SAVING)
 
         # check the display_compact
@@ -68,10 +68,10 @@ class TestSuperFTP(unittest.TestCase):
         s = err.getvalue()
         self.assertEqual(s, '')
         s = out.getvalue()
-        truth = ('\x1b[1;0H\x1b[37mETA:infinite        3.2%  0.000MB/sec  \remote\test\x1b[K\x1b[2;0H\x1b[K\x1b[3;0H' +
+        truth = ('\x1b[1;0H\x1b[37mETA:infinite        6.2%  0.000MB/sec  \remote\test\x1b[K\x1b[2;0H\x1b[K\x1b[3;0H' +
                  '\x1b[37m[0.000][0.000][0.000][0.000]\x1b[K\n[0.000][0.000][0.000][0.000]\x1b[K\n[0.000][0.000]' +
                  '[0.000][0.000]\x1b[K\n[0.000][0.000][0.000][0.000]\x1b[K\n\x1b[7;0H\x1b[K\x1b[8;0H\x1b[37m..\x1b' +
-                 '[92m**\x1b[37m....................\x1b[93m001234__789ABCDEF23456789ABCDEF\x1b[37m.......\x1b[K\r\n' +
+                 '[92m**\x1b[37m....................\x1b[93m00\x1b[37m....\x1b[93m__\x1b[K\r\n' +
                  '\x1b[K\r\n\x1b[K\r\n\x1b[K\r\n\x1b[K\r\n\x1b[K\r\n\x1b[K\r\n\x1b[K\r\n\x1b[K\r\n\x1b[K\r\n\x1b[K\r' +
                  '\n\x1b[K\r\n\x1b[K\r\n\x1b[K\r\n\x1b[K\r\n\x1b[J')
         self.assertEqual(s, truth)
@@ -92,14 +92,14 @@ class TestSuperFTP(unittest.TestCase):
         blockmap = create_blockmap(self._results_dir, 1024 * 1024 * 32)
         blockmap.init_blockmap()
         blockmap.change_block_range_status(1024 * 1024 * 5, 2, Blockmap.DOWNLOADED)
-        blockmap.change_block_range_status(1024 * 1024 * 9, 2, Blockmap.PENDING)
+        blockmap.change_block_range_status(1024 * 1024 * 9, 2, Blockmap.PENDING[0])
         blockmap.change_block_range_status(1024 * 1024 * 12, 2, Blockmap.SAVING)
 
         s = superftp._pretty_blockmap(blockmap, 5, 20)
         # print s.encode('string_escape')
 
-        truth = ('\x1b[37m.....\x1b[92m**\x1b[37m..\x1b[93m001__456789\x1b[K\r\nABCDEF23456789ABCDEF\x1b[K\r\n\x1b[37' +
-                 'm....................\x1b[K\r\n..\x1b[K\r\n\x1b[K\r\n')
+        truth = ('\x1b[37m.....\x1b[92m**\x1b[37m..\x1b[93m00\x1b[37m.\x1b[93m__\x1b[37m......\x1b[K\r\n' +
+                 '............\x1b[K\r\n\x1b[K\r\n\x1b[K\r\n\x1b[K\r\n')
         self.assertEqual(s, truth)
 
     def test_pretty_dl_speed_fifo(self):
@@ -137,6 +137,11 @@ class TestSuperFTP(unittest.TestCase):
         s = superftp._pretty_summary_line(ftp, blockmap, '\remote\test')
         self.assertEqual(s, 'ETA:infinite        0.0%  0.000MB/sec  \remote\test')
 
+        # the number of files is shown when a directory is downloaded
+        ftp._tree_progress = {'files_done': 1, 'files_total': 3, 'bytes_done': 0}
+        s = superftp._pretty_summary_line(ftp, blockmap, '\remote\test')
+        self.assertEqual(s, 'ETA:infinite        0.0%  0.000MB/sec  1/3 files  \remote\test')
+
 
 class TestSuperFTPRun(unittest.TestCase):
     """ tests for superftp class run method"""
@@ -168,8 +173,25 @@ class TestSuperFTPRun(unittest.TestCase):
                        'max_blocks_per_segment': 8,
                        'blocksize': 1048576,
                        'kill_speed': 1.0,
+                       'kill_policy': 'relative',
+                       'kill_percent': 30,
+                       'stall_seconds': 0.5,
+                       'max_rate': 0,
                        'clean': True,
                        'enable_tls': False,
+                       'durability': 'checkpoint',
+                       'endgame_blocks': 0,
+                       'auto_connections': False,
+                       'max_connections': 32,
+                       'max_buffer_mb': 256,
+                       'standby_connections': 0,
+                       'pipeline_seconds': 0,
+                       'max_open_files': 8,
+                       'small_file_size': 1048576,
+                       'listing_cache': None,
+                       'listing_cache_ttl': 3600,
+                       'engine': 'threads',
+                       'zero_copy': False,
                        'display_mode': 'compact',
                        'remote_path': '/',
                        'local_path': self._results_dir})
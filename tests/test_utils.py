@@ -136,8 +136,8 @@ def start_ftp_server(com_queue, ftp_root_dir, port=2121):
         handler = FTPHandler
         handler.authorizer = authorizer
         server = MultiprocessFTPServer(('', port), handler)
-        server.max_cons = 256
-        server.max_cons_per_ip = 10
+        server.max_cons = 512
+        server.max_cons_per_ip = 300
 
         # start ftp server
         while com_queue.empty():